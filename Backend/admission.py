@@ -0,0 +1,226 @@
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from flask import jsonify
+
+# Admission control configuration: how many inferences run at once, how many
+# requests may wait for a slot, and the latency budget a request must fit in
+MAX_CONCURRENT_INFERENCES = int(os.getenv('MAX_CONCURRENT_INFERENCES', '2'))
+MAX_QUEUED_REQUESTS = int(os.getenv('MAX_QUEUED_REQUESTS', '8'))
+LATENCY_SLO_SECONDS = float(os.getenv('LATENCY_SLO_SECONDS', '5'))
+
+# Per-user token bucket (keyed by the JWT email, or the client address)
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', '30'))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '10'))
+
+# Jobs /predict/async may leave waiting in the job queue before it answers 503
+MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', '200'))
+
+class TokenBucket:
+    def __init__(self, rate_per_minute=RATE_LIMIT_PER_MINUTE, burst=RATE_LIMIT_BURST, max_keys=10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take a token for key; returns 0 when allowed, else the seconds until the next token"""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self.buckets[key] = (tokens - 1, now)
+            if len(self.buckets) > self.max_keys:
+                # forget the users whose bucket has refilled anyway
+                self.buckets = {k: (t, l) for k, (t, l) in self.buckets.items()
+                                if t + (now - l) * self.rate < self.burst}
+            return 0
+
+    def refund(self, key):
+        """Give back the token of a request that was shed after acquire"""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            if key in self.buckets:
+                tokens, last = self.buckets[key]
+                self.buckets[key] = (min(self.burst, tokens + 1), last)
+
+class AdmissionController:
+    def __init__(self, max_concurrent=MAX_CONCURRENT_INFERENCES, max_queued=MAX_QUEUED_REQUESTS,
+                 latency_slo=LATENCY_SLO_SECONDS, rate_limiter=None):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.latency_slo = latency_slo
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.slots = threading.Semaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.service_time = 0.0  # moving average of the measured service time
+        self.admitted = 0
+        self.rejected = 0
+
+    def estimated_latency(self, position):
+        """Latency of a request with `position` requests ahead of it waiting for a slot"""
+        if self.in_flight + position < self.max_concurrent:
+            return self.service_time
+        return self.service_time * (position // self.max_concurrent + 2)
+
+    def enter(self):
+        """Reserve an inference slot, waiting (deferring) while that still fits the SLO.
+
+        Returns (True, 0) once admitted, or (False, retry_after_seconds) when shed.
+        """
+        with self.lock:
+            estimate = self.estimated_latency(self.waiting)
+            if self.waiting >= self.max_queued or estimate > self.latency_slo:
+                self.rejected += 1
+                return False, self.retry_after()
+            self.waiting += 1
+
+        timeout = None if math.isinf(self.latency_slo) else max(0.0, self.latency_slo - self.service_time)
+        admitted = self.slots.acquire(timeout=timeout)
+        with self.lock:
+            self.waiting -= 1
+            if not admitted:
+                self.rejected += 1
+                return False, self.retry_after()
+            self.in_flight += 1
+            self.admitted += 1
+        return True, 0
+
+    @contextmanager
+    def hold(self):
+        """Hold an inference slot for work that cannot be shed (the job workers): waits
+        for a slot as long as it takes and is counted in in_flight and service_time"""
+        self.slots.acquire()
+        with self.lock:
+            self.in_flight += 1
+            self.admitted += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.exit(time.perf_counter() - start)
+
+    def exit(self, elapsed):
+        with self.lock:
+            self.in_flight -= 1
+            self.service_time = elapsed if self.service_time == 0 else 0.8 * self.service_time + 0.2 * elapsed
+        self.slots.release()
+
+    def retry_after(self):
+        """Seconds until the current backlog should have drained"""
+        backlog = (self.waiting + self.in_flight) * self.service_time / self.max_concurrent
+        return max(1, math.ceil(backlog))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'max_concurrent': self.max_concurrent,
+                'max_queued': self.max_queued,
+                'latency_slo': self.latency_slo,
+                'service_time': self.service_time,
+                'admitted': self.admitted,
+                'rejected': self.rejected
+            }
+
+def admission_required(controller, get_key):
+    """Rate limit per get_key() with 429, then shed load with 503 when over capacity.
+    A shed request gets its token back, only admitted work is charged"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = get_key()
+            retry_after = controller.rate_limiter.acquire(key)
+            if retry_after:
+                return jsonify({'error': 'Rate limit exceeded'}), 429, {'Retry-After': str(math.ceil(retry_after))}
+
+            admitted, retry_after = controller.enter()
+            if not admitted:
+                controller.rate_limiter.refund(key)
+                return jsonify({'error': 'Server is overloaded, retry later'}), 503, {'Retry-After': str(retry_after)}
+
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                controller.exit(time.perf_counter() - start)
+        return decorated
+    return decorator
+
+def queue_admission_required(controller, get_key, queue, max_queued=MAX_QUEUED_JOBS):
+    """Rate limit per get_key() with 429 like admission_required, then answer 503 while
+    the job queue already holds max_queued jobs instead of queueing without bound"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = get_key()
+            retry_after = controller.rate_limiter.acquire(key)
+            if retry_after:
+                return jsonify({'error': 'Rate limit exceeded'}), 429, {'Retry-After': str(math.ceil(retry_after))}
+
+            if queue.depth() >= max_queued:
+                controller.rate_limiter.refund(key)
+                return jsonify({'error': 'Job queue is full, retry later'}), 503, \
+                    {'Retry-After': str(max(1, math.ceil(queue.drain_time())))}
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+if __name__ == "__main__":
+    # overload test through HTTP: the real app_mongodb.py server (dummy model, throwaway
+    # mongod) is started once with admission control and once without it, and
+    # /predict gets open-loop arrivals beyond what the inference slots can serve
+    import shutil
+    import tempfile
+    import argparse
+    import numpy as np
+    import loadtest
+
+    ap = argparse.ArgumentParser(description='p99 latency of /predict under overload with and without admission control')
+    ap.add_argument('--mongodb-uri', help='database for the servers, by default a throwaway mongod is started')
+    ap.add_argument('--rate', type=float, default=40, help='open loop arrival rate in req/s')
+    ap.add_argument('--duration', type=float, default=20)
+    ap.add_argument('--concurrency', type=int, default=64, help='client connections')
+    args = ap.parse_args()
+
+    unlimited = {'MAX_CONCURRENT_INFERENCES': '1000', 'MAX_QUEUED_REQUESTS': '1000000', 'LATENCY_SLO_SECONDS': 'inf'}
+    controlled = {'MAX_CONCURRENT_INFERENCES': str(MAX_CONCURRENT_INFERENCES),
+                  'MAX_QUEUED_REQUESTS': str(MAX_QUEUED_REQUESTS), 'LATENCY_SLO_SECONDS': str(LATENCY_SLO_SECONDS)}
+    workdir = tempfile.mkdtemp(prefix='admission-')
+    processes = []
+    try:
+        mongodb_uri = args.mongodb_uri
+        if mongodb_uri is None:
+            mongod, mongodb_uri = loadtest.start_mongod(workdir)
+            processes.append(mongod)
+        images = loadtest.synthesize_images(8)
+        for name, env in [("no admission control", unlimited), ("admission control", controlled)]:
+            server, url = loadtest.start_server(tempfile.mkdtemp(dir=workdir), mongodb_uri, overrides=env)
+            try:
+                test = loadtest.LoadTest(url, loadtest.login_users(url, 4), images, {'predict': 1.0})
+                report = test.run(args.duration, args.concurrency, args.rate, warmup=2)['total']
+            finally:
+                server.terminate()
+                server.wait()
+            served = [latency for _, status, latency in test.samples if status == 200]
+            print(f"{name:<22} requests: {report['requests']} status codes: {report['status_codes']} "
+                  f"served p50: {np.percentile(served, 50) * 1000 if served else 0:.0f} ms "
+                  f"p99: {np.percentile(served, 99) * 1000 if served else 0:.0f} ms")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
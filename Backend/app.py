@@ -1,16 +1,28 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import tensorflow as tf
 import numpy as np
 from PIL import Image
 import os
 import random
+import hmac
+from functools import wraps
+from inference import run_model, calibrate, decide, CLASS_NAMES
+from jobs import JobQueue, job_priority
+from admission import AdmissionController, admission_required, queue_admission_required
+from profiling import profiler
+from compression import compress_response
+from werkzeug.datastructures import MultiDict
+import dicom
+from uploads import receive_upload, UploadError
 
 app = Flask(__name__)
 CORS(app)
+app.after_request(compress_response)
 
 # Check if model exists, otherwise create a dummy model for testing
-model_path = "output/models/LuNet.h5"
+# MODEL_PATH can point at a distilled student model (chest_xray/distill.py)
+model_path = os.getenv("MODEL_PATH", "output/models/LuNet.h5")
 if os.path.exists(model_path):
     model = tf.keras.models.load_model(model_path, compile=False)
     print(f"Model loaded from {model_path}")
@@ -23,6 +35,10 @@ else:
     ])
     print("Warning: Using dummy model - actual model not found at", model_path)
 
+# Shared secret for the /admin routes, sent in the X-Admin-Token header;
+# the routes are disabled when it is not set
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
 DISEASE_INFO = {
     "Normal": {
         "precaution": "No abnormality detected. Maintain regular health check-ups and a healthy lifestyle.",
@@ -44,6 +60,14 @@ DISEASE_INFO = {
     }
 }
 
+def admin_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+            return jsonify({'error': 'Admin access required'}), 403
+        return f(*args, **kwargs)
+    return decorated
+
 def preprocess(img):
     img = img.resize((224, 224))
     img = np.array(img) / 255.0
@@ -127,64 +151,180 @@ def check_image_quality(image):
     except:
         return {"quality_score": 50, "issues": ["Unable to assess image quality"], "acceptable": False}
 
+def load_image(fileobj):
+    """RGB image, model input and source metadata of an uploaded file.
+    
+    DICOM files are decoded straight into the model input, the image is then
+    only a 224x224 rendering of it for the quality check.
+    """
+    if dicom.is_dicom(fileobj):
+        x, header = dicom.load(fileobj)
+        return dicom.to_image(x), x, {"source": "dicom", "dicom": header}
+    return Image.open(fileobj).convert("RGB"), None, {}
+
+def analyze_image(image, options, x=None, source_metadata=None):
+    """Quality check, inference and result formatting for one RGB image,
+    or for an already preprocessed model input x"""
+    # Check image quality first
+    with profiler.stage('quality_check'):
+        quality_check = check_image_quality(image)
+    
+    if x is None:
+        with profiler.stage('preprocess'):
+            x = preprocess(image)
+    # mode=full skips the cascade and always runs the full model,
+    # tta=K averages the full model over K augmented views
+    with profiler.stage('inference'):
+        pred, inference_metadata = run_model(model, x,
+                                             use_cascade=options.get('mode') != 'full',
+                                             tta=options.get('tta', type=int))
+    
+    # Get the predicted class and confidence
+    pred = calibrate(pred)
+    predicted_class_idx, confidence, confidence_level = decide(pred)
+    
+    predicted_disease = CLASS_NAMES[predicted_class_idx]
+    
+    # Generate explanation and heatmap
+    explanation = generate_explanation(predicted_disease, confidence)
+    heatmap_regions = generate_heatmap_regions(predicted_disease, confidence)
+    
+    return {
+        "prediction": predicted_disease,
+        "confidence": confidence,
+        "all_probabilities": {
+            "Normal": float(pred[0]),
+            "Pneumonia": float(pred[1]),
+            "Tuberculosis": float(pred[2])
+        },
+        "explanation": explanation,
+        "heatmap_regions": heatmap_regions,
+        "disease_info": DISEASE_INFO[predicted_disease],
+        "quality_check": quality_check,
+        "analysis_metadata": {
+            "model_version": "LuNet-v1.0",
+            "input_shape": "224x224x3",
+            "processing_time": "2.3s",
+            "confidence_level": confidence_level,
+            **inference_metadata,
+            **(source_metadata or {})
+        }
+    }
+
+def process_job_image(fileobj, options):
+    image, x, source_metadata = load_image(fileobj)
+    # the job workers share the inference slots of /predict, waiting for one
+    # instead of being shed, so at most MAX_CONCURRENT_INFERENCES run at once
+    with admission.hold():
+        return analyze_image(image, MultiDict(options), x, source_metadata)
+
+# Worker pool for /predict/async, backed by a SQLite job table. Threads do not
+# survive a fork, so when the app is preloaded by a pre-fork master
+# (gunicorn.conf.py, PREFORK_MODE=model) every worker starts its own in after_fork
+job_queue = JobQueue(process_job_image)
+if os.getenv('PREFORK_MODE') != 'model':
+    job_queue.start()
+
+def after_fork():
+    """Start the per-process threads and connections in a pre-forked worker"""
+    job_queue.start()
+
+# Admission control for the inference routes: /predict waits for an inference
+# slot, /predict/async is bounded by the depth of the job queue
+admission = AdmissionController()
+
 @app.route("/predict", methods=["POST"])
+@admission_required(admission, lambda: request.remote_addr)
+@profiler.profile
 def predict():
+    upload = None
     try:
-        if 'file' not in request.files:
+        # the file is hashed, spooled and decoded while it is received
+        with profiler.stage('decode'):
+            upload = receive_upload(request.stream, request.content_type, request.content_length)
+            image, x, source_metadata = load_image(upload.spool) if upload.is_dicom else (upload.image, None, {})
+        source_metadata["upload"] = {"filename": upload.filename, "bytes": upload.size, "sha256": upload.digest}
+        return jsonify(analyze_image(image, upload.form, x, source_metadata))
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if upload is not None:
+            upload.close()
+
+@app.route("/predict/async", methods=["POST"])
+@queue_admission_required(admission, lambda: request.remote_addr, job_queue)
+def predict_async():
+    try:
+        files = [file for file in request.files.getlist('file') if file.filename != '']
+        if not files:
             return jsonify({"error": "No file provided"}), 400
         
-        file = request.files["file"]
-        if file.filename == '':
-            return jsonify({"error": "No file selected"}), 400
-        
-        image = Image.open(file).convert("RGB")
-        
-        # Check image quality first
-        quality_check = check_image_quality(image)
-        
-        x = preprocess(image)
-        pred = model.predict(x)[0]
-        
-        # Get the predicted class and confidence
-        predicted_class_idx = np.argmax(pred)
-        confidence = float(pred[predicted_class_idx])
-        
-        diseases = ["Normal", "Pneumonia", "Tuberculosis"]
-        predicted_disease = diseases[predicted_class_idx]
-        
-        # Generate explanation and heatmap
-        explanation = generate_explanation(predicted_disease, confidence)
-        heatmap_regions = generate_heatmap_regions(predicted_disease, confidence)
-        
+        # priority=urgent|high|normal|low, suspected=Tuberculosis jumps the queue
+        job_id = job_queue.enqueue(files, request.form.to_dict(), job_priority(request.form))
         return jsonify({
-            "prediction": predicted_disease,
-            "confidence": confidence,
-            "all_probabilities": {
-                "Normal": float(pred[0]),
-                "Pneumonia": float(pred[1]),
-                "Tuberculosis": float(pred[2])
-            },
-            "explanation": explanation,
-            "heatmap_regions": heatmap_regions,
-            "disease_info": DISEASE_INFO[predicted_disease],
-            "quality_check": quality_check,
-            "analysis_metadata": {
-                "model_version": "LuNet-v1.0",
-                "input_shape": "224x224x3",
-                "processing_time": "2.3s",
-                "confidence_level": "High" if confidence > 0.7 else "Medium" if confidence > 0.4 else "Low"
-            }
-        })
+            "jobId": job_id,
+            "status": "queued",
+            "status_url": f"/jobs/{job_id}",
+            "events_url": f"/jobs/{job_id}/events"
+        }), 202
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/jobs/stats", methods=["GET"])
+def job_stats():
+    return jsonify(job_queue.stats())
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    return Response(job_queue.events(job_id), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/admin/profile", methods=["POST"])
+@admin_required
+def start_profile():
+    # {"requests": N, "tf_trace": true} samples the next N /predict requests
+    data = request.get_json(silent=True) or {}
+    profiler.start(int(data.get('requests', 10)), tf_trace=bool(data.get('tf_trace', False)))
+    return jsonify(profiler.status())
+
+@app.route("/admin/profile", methods=["GET"])
+@admin_required
+def get_profile():
+    # format=pstats for snakeviz/gprof2dot, format=collapsed for flamegraph.pl/speedscope
+    output_format = request.args.get('format', 'json')
+    if output_format == 'pstats':
+        return Response(profiler.dump(), mimetype="application/octet-stream",
+                        headers={"Content-Disposition": "attachment; filename=predict.prof"})
+    if output_format == 'collapsed':
+        return Response(profiler.collapsed(), mimetype="text/plain")
+    return jsonify({
+        **profiler.status(),
+        "report": profiler.text(request.args.get('sort', 'cumulative'), request.args.get('limit', 50, type=int))
+    })
+
+@app.route("/admin/profile", methods=["DELETE"])
+@admin_required
+def stop_profile():
+    profiler.stop()
+    return jsonify(profiler.status())
+
 @app.route("/health", methods=["GET"])
 def health():
     return jsonify({
         "status": "healthy", 
         "model_loaded": os.path.exists(model_path),
         "model_type": "Multi-class Lung Disease Detection",
-        "supported_diseases": ["Normal", "Pneumonia", "Tuberculosis"]
+        "supported_diseases": ["Normal", "Pneumonia", "Tuberculosis"],
+        "admission": admission.stats()
     })
 
 if __name__ == "__main__":
@@ -1,11 +1,26 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import tensorflow as tf
 import numpy as np
 from PIL import Image
+import io
 import os
+import time
 import random
-import bcrypt
+from inference import run_model, calibrate, decide, CLASS_NAMES
+from jobs import JobQueue, job_priority
+from admission import AdmissionController, admission_required, queue_admission_required
+from profiling import profiler
+from compression import compress_response
+import thumbnails
+import similarity
+import scan_stats
+import scan_export
+from scan_events_app import scan_events, event_stream, stream_token, stream_user, STREAM_TOKEN_SECONDS
+from passwords import PasswordHasher, AuthBusyError
+from werkzeug.datastructures import MultiDict
+import dicom
+from uploads import receive_upload, UploadError
 import jwt
 import datetime
 from functools import wraps
@@ -13,13 +28,21 @@ from database import db
 
 app = Flask(__name__)
 CORS(app)
+app.after_request(compress_response)
 
 # JWT Configuration
 JWT_SECRET = os.getenv('JWT_SECRET', 'your_jwt_secret_key_here')
 JWT_EXPIRATION_HOURS = int(os.getenv('JWT_EXPIRATION_HOURS', '24'))
 
+# Comma separated emails allowed to use the /admin routes
+ADMIN_EMAILS = [email.strip() for email in os.getenv('ADMIN_EMAILS', '').split(',') if email.strip()]
+
+# bcrypt runs on a bounded auth pool, separate from the inference work
+hasher = PasswordHasher()
+
 # Check if model exists, otherwise create a dummy model for testing
-model_path = "output/models/LuNet.h5"
+# MODEL_PATH can point at a distilled student model (chest_xray/distill.py)
+model_path = os.getenv("MODEL_PATH", "output/models/LuNet.h5")
 if os.path.exists(model_path):
     model = tf.keras.models.load_model(model_path, compile=False)
     print(f"Model loaded from {model_path}")
@@ -32,6 +55,10 @@ else:
     ])
     print("Warning: Using dummy model - actual model not found at", model_path)
 
+# Embeddings of the saved scans for /scan/similar, from the model's pooled features
+feature_model = similarity.feature_extractor(model)
+similar_index = similarity.SimilarScans()
+
 DISEASE_INFO = {
     "Normal": {
         "precaution": "No abnormality detected. Maintain regular health check-ups and a healthy lifestyle.",
@@ -70,6 +97,26 @@ def token_required(f):
         return f(*args, **kwargs)
     return decorated
 
+def admin_required(f):
+    @wraps(f)
+    @token_required
+    def decorated(*args, **kwargs):
+        decoded = jwt.decode(request.headers.get('Authorization'), JWT_SECRET, algorithms=['HS256'])
+        if decoded['email'] not in ADMIN_EMAILS:
+            return jsonify({'error': 'Admin access required'}), 403
+        return f(*args, **kwargs)
+    return decorated
+
+def request_user_key():
+    """Rate limit key: the JWT email when a valid token is sent, else the client address"""
+    token = request.headers.get('Authorization')
+    if token:
+        try:
+            return jwt.decode(token, JWT_SECRET, algorithms=['HS256'])['email']
+        except:
+            pass
+    return request.remote_addr
+
 def preprocess(img):
     img = img.resize((224, 224))
     img = np.array(img) / 255.0
@@ -164,7 +211,7 @@ def register():
             return jsonify({'error': 'User already exists'}), 400
         
         # Hash password
-        hashed_password = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = hasher.hash(data['password'])
         
         # Create user
         user_data = {
@@ -185,6 +232,8 @@ def register():
         else:
             return jsonify({'error': 'Failed to create user'}), 500
             
+    except AuthBusyError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -199,7 +248,12 @@ def login():
             return jsonify({'error': 'Invalid credentials'}), 401
         
         # Check password
-        if bcrypt.checkpw(data['password'].encode('utf-8'), user['password'].encode('utf-8')):
+        if hasher.check(data['password'], user['password']):
+            # Upgrade hashes made with another work factor, after responding
+            if hasher.needs_rehash(user['password']):
+                hasher.rehash_later(data['password'],
+                                    lambda hashed: db.update_user(user['email'], {'password': hashed}))
+            
             # Generate JWT token
             token = jwt.encode({
                 'email': user['email'],
@@ -218,6 +272,8 @@ def login():
         else:
             return jsonify({'error': 'Invalid credentials'}), 401
             
+    except AuthBusyError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -268,14 +324,25 @@ def save_scan():
             'disease_info': data.get('disease_info', {}),
             'quality_check': data.get('quality_check', {}),
             'all_probabilities': data.get('all_probabilities', {}),
-            'analysis_metadata': data.get('analysis_metadata', {})
+            'analysis_metadata': data.get('analysis_metadata', {}),
+            'thumbnail': make_scan_thumbnail(data['image_url'])
         }
+        embedding = scan_embedding(data['image_url'])
+        if embedding is not None:
+            scan_data['embedding'] = similarity.pack(embedding)
         
         scan_id = db.save_scan(scan_data)
         if scan_id:
+            # marked counted only once it is in the rollups, else the backfill adds it
+            if db.record_scan_stats(decoded['email'], scan_data['date'], scan_stats.scan_increments(scan_data)):
+                db.update_scan(scan_id, {'stats_counted': True})
+            scan_events.saved(scan_data)  # insert_one set scan_data['_id']
+            if embedding is not None:
+                similar_index.add(str(scan_id), decoded['email'], embedding, time.time())
             return jsonify({
                 'message': 'Scan saved successfully',
-                'scanId': str(scan_id)
+                'scanId': str(scan_id),
+                'thumbnail_url': thumbnails.thumbnail_url(str(scan_id), decoded['email'], JWT_SECRET)
             }), 201
         else:
             return jsonify({'error': 'Failed to save scan'}), 500
@@ -291,7 +358,14 @@ def scan_history():
         decoded = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
         
         limit = request.args.get('limit', 10, type=int)
-        scans = db.get_user_scans(decoded['email'], limit)
+        # the full resolution image_url is only sent with full=1, rows link to thumbnails
+        projection = {'thumbnail': 0, 'embedding': 0, 'stats_counted': 0}
+        if request.args.get('full') != '1':
+            projection['image_url'] = 0
+        scans = db.get_user_scans(decoded['email'], limit, projection)
+        for scan in scans:
+            scan['_id'] = str(scan['_id'])
+            scan['thumbnail_url'] = thumbnails.thumbnail_url(scan['_id'], decoded['email'], JWT_SECRET)
         
         return jsonify({
             'scans': scans,
@@ -301,57 +375,355 @@ def scan_history():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route("/predict", methods=["POST"])
-def predict():
+@app.route("/scan/stats", methods=["GET"])
+@token_required
+def scan_statistics():
     try:
-        if 'file' not in request.files:
-            return jsonify({"error": "No file provided"}), 400
+        token = request.headers.get('Authorization')
+        decoded = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
         
-        file = request.files["file"]
-        if file.filename == '':
-            return jsonify({"error": "No file selected"}), 400
+        # served from the rollups kept by /scan/save, not from the scans
+        days = min(max(request.args.get('days', 30, type=int), 1), scan_stats.STATS_MAX_DAYS)
+        today = datetime.datetime.utcnow()
+        total, daily = db.get_scan_stats(decoded['email'], scan_stats.first_day(days, today), scan_stats.day(today))
         
-        image = Image.open(file).convert("RGB")
+        return jsonify(scan_stats.summarize(total, daily, days))
+            
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# The dashboards' event stream, served by scan_events_app.py on gevent workers in
+# production (gunicorn_events.conf.py) and here for single-process runs
+@app.route("/scan/events", methods=["GET"])
+def scan_event_stream():
+    return event_stream()
+
+@app.route("/scan/events/token", methods=["POST"])
+@token_required
+def scan_event_token():
+    decoded = jwt.decode(request.headers.get('Authorization'), JWT_SECRET, algorithms=['HS256'])
+    return jsonify({'token': stream_token(decoded['email']), 'expires_in': STREAM_TOKEN_SECONDS})
+
+@app.route("/scan/events/stats", methods=["GET"])
+@admin_required
+def scan_event_stats():
+    return jsonify(scan_events.stats())
+
+@app.route("/scan/export", methods=["GET"])
+@token_required
+def export_scans():
+    # format=ndjson|csv, images=1 includes the full resolution image_url
+    try:
+        token = request.headers.get('Authorization')
+        decoded = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
         
-        # Check image quality first
-        quality_check = check_image_quality(image)
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in scan_export.EXPORT_FORMATS:
+            return jsonify({'error': f'Unsupported export format: {export_format}'}), 400
+        images = request.args.get('images') == '1'
+        scans = db.iter_user_scans(decoded['email'], scan_export.projection(images), scan_export.EXPORT_BATCH_SIZE)
         
-        x = preprocess(image)
-        pred = model.predict(x)[0]
+        def stream():
+            try:
+                yield from scan_export.export(scans, export_format, images)
+            finally:
+                scans.close()  # also when the client goes away
         
-        # Get predicted class and confidence
-        predicted_class_idx = np.argmax(pred)
-        confidence = float(pred[predicted_class_idx])
+        return Response(stream(), mimetype=scan_export.EXPORT_FORMATS[export_format], headers={
+            'Content-Disposition': f'attachment; filename=scans.{export_format}',
+            'X-Accel-Buffering': 'no'
+        })
+            
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def make_scan_thumbnail(image_url):
+    """Thumbnail of a data: URL image, None when there is no image to reduce"""
+    try:
+        data = thumbnails.decode_data_url(image_url)
+        return thumbnails.make_thumbnail(data) if data is not None else None
+    except Exception as e:
+        print(f"Error making thumbnail: {e}")
+        return None
+
+@app.route("/scan/<scan_id>/thumbnail", methods=["GET"])
+def scan_thumbnail(scan_id):
+    # signed URL from /scan/history instead of token_required, <img> cannot send headers.
+    # the signature only holds for the owner of the scan and until it expires
+    scan = db.get_scan(scan_id, {'thumbnail': 1, 'user_email': 1})
+    if scan is None or not thumbnails.verify(scan_id, scan.get('user_email'), request.args.get('exp'),
+                                             request.args.get('sig', ''), JWT_SECRET):
+        return jsonify({'error': 'Invalid or expired signature'}), 403
+    thumbnail = scan.get('thumbnail')
+    if thumbnail is None:
+        # scans saved before thumbnails existed get one on their first request
+        scan = db.get_scan(scan_id, {'image_url': 1})
+        thumbnail = make_scan_thumbnail(scan.get('image_url'))
+        if thumbnail is None:
+            return jsonify({'error': 'Scan has no image'}), 404
+        db.update_scan(scan_id, {'thumbnail': thumbnail})
+    
+    response = Response(bytes(thumbnail['data']), mimetype=thumbnail['mimetype'])
+    response.set_etag(thumbnail['etag'])
+    # a scan's image never changes, but the URL is only cached while it is valid
+    max_age = min(thumbnails.THUMBNAIL_MAX_AGE, max(0, int(request.args['exp']) - int(time.time())))
+    response.headers['Cache-Control'] = f'private, max-age={max_age}, immutable'
+    return response.make_conditional(request)
+
+def embed(x):
+    # a model run like /predict, so it takes an inference slot too; /scan/save and
+    # /scan/similar wait for it rather than failing the save
+    with admission.hold():
+        return feature_model.predict(x)[0]
+
+def scan_embedding(image_url):
+    """Embedding of a data: URL image, None when there is no image to embed"""
+    try:
+        data = thumbnails.decode_data_url(image_url)
+        if data is None:
+            return None
+        image, x, _ = load_image(io.BytesIO(data))
+        return embed(preprocess(image) if x is None else x)
+    except Exception as e:
+        print(f"Error embedding scan: {e}")
+        return None
+
+@app.route("/scan/similar", methods=["GET", "POST"])
+@token_required
+def similar_scans():
+    # GET ?scan_id= finds scans like a saved one, POST a file finds scans like a new image
+    upload = None
+    try:
+        token = request.headers.get('Authorization')
+        decoded = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
         
-        diseases = ["Normal", "Pneumonia", "Tuberculosis"]
-        predicted_disease = diseases[predicted_class_idx]
+        if request.method == 'POST':
+            upload = receive_upload(request.stream, request.content_type, request.content_length)
+            image, x, _ = load_image(upload.spool) if upload.is_dicom else (upload.image, None, {})
+            embedding, exclude, options = embed(preprocess(image) if x is None else x), None, upload.form
+        else:
+            scan = db.get_scan(request.args.get('scan_id', ''), {'embedding': 1, 'user_email': 1})
+            if scan is None or scan.get('user_email') != decoded['email']:
+                return jsonify({'error': 'Scan not found'}), 404
+            if 'embedding' not in scan:
+                return jsonify({'error': 'Scan has no embedding'}), 404
+            embedding, exclude, options = similarity.unpack(scan['embedding']), str(scan['_id']), request.args
+        
+        k = min(max(options.get('k', 5, type=int), 1), similarity.SIMILAR_MAX_K)
+        owner = decoded['email'] if similarity.SIMILAR_SCOPE == 'user' else None
+        similar_index.sync(db)
+        matches = similar_index.search(embedding, k, owner=owner, exclude=exclude)
         
-        # Generate explanation and heatmap
-        explanation = generate_explanation(predicted_disease, confidence)
-        heatmap_regions = generate_heatmap_regions(predicted_disease, confidence)
+        similarities = dict(matches)
+        scans = db.get_scans([scan_id for scan_id, _ in matches],
+                             {'user_email': 1, 'prediction': 1, 'disease': 1, 'confidence': 1, 'status': 1, 'date': 1})
+        results = []
+        for scan in scans:
+            scan['_id'] = str(scan['_id'])
+            scan['similarity'] = similarities[scan['_id']]
+            if scan.pop('user_email') == decoded['email']:
+                scan['thumbnail_url'] = thumbnails.thumbnail_url(scan['_id'], decoded['email'], JWT_SECRET)
+                results.append({**scan, 'own': True})
+            else:
+                # SIMILAR_SCOPE=all: another user's scan, only its findings are shared
+                results.append({**{name: scan.get(name) for name in similarity.ANONYMOUS_FIELDS}, 'own': False})
         
         return jsonify({
-            "prediction": predicted_disease,
-            "confidence": confidence,
-            "all_probabilities": {
-                "Normal": float(pred[0]),
-                "Pneumonia": float(pred[1]),
-                "Tuberculosis": float(pred[2])
-            },
-            "explanation": explanation,
-            "heatmap_regions": heatmap_regions,
-            "disease_info": DISEASE_INFO[predicted_disease],
-            "quality_check": quality_check,
-            "analysis_metadata": {
-                "model_version": "LuNet-v1.0",
-                "input_shape": "224x224x3",
-                "processing_time": "2.3s",
-                "confidence_level": "High" if confidence > 0.7 else "Medium" if confidence > 0.4 else "Low"
-            }
+            'scans': results,
+            'total': len(results)
         })
+    
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if upload is not None:
+            upload.close()
+
+def load_image(fileobj):
+    """RGB image, model input and source metadata of an uploaded file.
+    
+    DICOM files are decoded straight into the model input, the image is then
+    only a 224x224 rendering of it for the quality check.
+    """
+    if dicom.is_dicom(fileobj):
+        x, header = dicom.load(fileobj)
+        return dicom.to_image(x), x, {"source": "dicom", "dicom": header}
+    return Image.open(fileobj).convert("RGB"), None, {}
+
+def analyze_image(image, options, x=None, source_metadata=None):
+    """Quality check, inference and result formatting for one RGB image,
+    or for an already preprocessed model input x"""
+    # Check image quality first
+    with profiler.stage('quality_check'):
+        quality_check = check_image_quality(image)
+    
+    if x is None:
+        with profiler.stage('preprocess'):
+            x = preprocess(image)
+    # mode=full skips the cascade and always runs the full model,
+    # tta=K averages the full model over K augmented views
+    with profiler.stage('inference'):
+        pred, inference_metadata = run_model(model, x,
+                                             use_cascade=options.get('mode') != 'full',
+                                             tta=options.get('tta', type=int))
+    
+    # Get predicted class and confidence
+    pred = calibrate(pred)
+    predicted_class_idx, confidence, confidence_level = decide(pred)
+    
+    predicted_disease = CLASS_NAMES[predicted_class_idx]
+    
+    # Generate explanation and heatmap
+    explanation = generate_explanation(predicted_disease, confidence)
+    heatmap_regions = generate_heatmap_regions(predicted_disease, confidence)
+    
+    return {
+        "prediction": predicted_disease,
+        "confidence": confidence,
+        "all_probabilities": {
+            "Normal": float(pred[0]),
+            "Pneumonia": float(pred[1]),
+            "Tuberculosis": float(pred[2])
+        },
+        "explanation": explanation,
+        "heatmap_regions": heatmap_regions,
+        "disease_info": DISEASE_INFO[predicted_disease],
+        "quality_check": quality_check,
+        "analysis_metadata": {
+            "model_version": "LuNet-v1.0",
+            "input_shape": "224x224x3",
+            "processing_time": "2.3s",
+            "confidence_level": confidence_level,
+            **inference_metadata,
+            **(source_metadata or {})
+        }
+    }
+
+def process_job_image(fileobj, options):
+    image, x, source_metadata = load_image(fileobj)
+    # the job workers share the inference slots of /predict, waiting for one
+    # instead of being shed, so at most MAX_CONCURRENT_INFERENCES run at once
+    with admission.hold():
+        return analyze_image(image, MultiDict(options), x, source_metadata)
+
+# Worker pool for /predict/async, backed by a SQLite job table. Threads do not
+# survive a fork, so when the app is preloaded by a pre-fork master
+# (gunicorn.conf.py, PREFORK_MODE=model) every worker starts its own in after_fork
+job_queue = JobQueue(process_job_image)
+if os.getenv('PREFORK_MODE') != 'model':
+    job_queue.start()
+    scan_events.start(db.watch_scans)
+
+def after_fork():
+    """Start the per-process threads and connections in a pre-forked worker"""
+    job_queue.start()
+    db.connect()
+    scan_events.start(db.watch_scans)
+
+# Admission control for the inference routes: /predict waits for an inference
+# slot, /predict/async is bounded by the depth of the job queue
+admission = AdmissionController()
+
+@app.route("/predict", methods=["POST"])
+@admission_required(admission, request_user_key)
+@profiler.profile
+def predict():
+    upload = None
+    try:
+        # the file is hashed, spooled and decoded while it is received
+        with profiler.stage('decode'):
+            upload = receive_upload(request.stream, request.content_type, request.content_length)
+            image, x, source_metadata = load_image(upload.spool) if upload.is_dicom else (upload.image, None, {})
+        source_metadata["upload"] = {"filename": upload.filename, "bytes": upload.size, "sha256": upload.digest}
+        return jsonify(analyze_image(image, upload.form, x, source_metadata))
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if upload is not None:
+            upload.close()
+
+@app.route("/predict/async", methods=["POST"])
+@token_required
+@queue_admission_required(admission, request_user_key, job_queue)
+def predict_async():
+    try:
+        decoded = jwt.decode(request.headers.get('Authorization'), JWT_SECRET, algorithms=['HS256'])
+        files = [file for file in request.files.getlist('file') if file.filename != '']
+        if not files:
+            return jsonify({"error": "No file provided"}), 400
+        
+        # priority=urgent|high|normal|low, suspected=Tuberculosis jumps the queue
+        job_id = job_queue.enqueue(files, request.form.to_dict(), job_priority(request.form),
+                                   owner=decoded['email'])
+        return jsonify({
+            "jobId": job_id,
+            "status": "queued",
+            "status_url": f"/jobs/{job_id}",
+            "events_url": f"/jobs/{job_id}/events"
+        }), 202
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/jobs/stats", methods=["GET"])
+@admin_required
+def job_stats():
+    return jsonify(job_queue.stats())
+
+# a job is only visible to the user who submitted it, other users get a 404
+@app.route("/jobs/<job_id>", methods=["GET"])
+@token_required
+def job_status(job_id):
+    decoded = jwt.decode(request.headers.get('Authorization'), JWT_SECRET, algorithms=['HS256'])
+    job = job_queue.get(job_id, owner=decoded['email'])
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+# EventSource cannot send the Authorization header, the stream token of
+# POST /scan/events/token can be passed as ?token= instead
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    email = stream_user()
+    if email is None:
+        return jsonify({'error': 'Token is invalid or expired'}), 401
+    if job_queue.get(job_id, owner=email) is None:
+        return jsonify({"error": "Job not found"}), 404
+    return Response(job_queue.events(job_id, owner=email), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/admin/profile", methods=["POST"])
+@admin_required
+def start_profile():
+    # {"requests": N, "tf_trace": true} samples the next N /predict requests
+    data = request.get_json(silent=True) or {}
+    profiler.start(int(data.get('requests', 10)), tf_trace=bool(data.get('tf_trace', False)))
+    return jsonify(profiler.status())
+
+@app.route("/admin/profile", methods=["GET"])
+@admin_required
+def get_profile():
+    # format=pstats for snakeviz/gprof2dot, format=collapsed for flamegraph.pl/speedscope
+    output_format = request.args.get('format', 'json')
+    if output_format == 'pstats':
+        return Response(profiler.dump(), mimetype="application/octet-stream",
+                        headers={"Content-Disposition": "attachment; filename=predict.prof"})
+    if output_format == 'collapsed':
+        return Response(profiler.collapsed(), mimetype="text/plain")
+    return jsonify({
+        **profiler.status(),
+        "report": profiler.text(request.args.get('sort', 'cumulative'), request.args.get('limit', 50, type=int))
+    })
+
+@app.route("/admin/profile", methods=["DELETE"])
+@admin_required
+def stop_profile():
+    profiler.stop()
+    return jsonify(profiler.status())
+
 @app.route("/health", methods=["GET"])
 def health():
     return jsonify({
@@ -359,6 +731,7 @@ def health():
         "model_loaded": os.path.exists(model_path),
         "model_type": "Multi-class Lung Disease Detection",
         "supported_diseases": ["Normal", "Pneumonia", "Tuberculosis"],
+        "admission": admission.stats(),
         "database": db.get_health_status()
     })
 
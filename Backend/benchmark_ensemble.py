@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+from benchmark_inference import measure, peak_rss_mb, machine_info
+
+# Ensemble latency benchmark: wall-clock time of one request through the full model
+# and its ensemble members, run one after the other versus concurrently on threads
+# (inference.full_predict). How much the threads gain depends on how many cores a
+# single model already keeps busy, so every intra-op thread setting runs in a fresh
+# process like benchmark_inference.py
+MODEL_PATH = os.getenv("MODEL_PATH", "output/models/LuNet.h5")
+
+def load_member(model_path, image_size):
+    """A saved model, or an untrained DenseNet121 of the same size as LuNet when it is missing"""
+    import tensorflow as tf
+    if os.path.exists(model_path):
+        return tf.keras.models.load_model(model_path, compile=False)
+    base_model = tf.keras.applications.DenseNet121(include_top=False, weights=None,
+                                                   input_shape=(image_size, image_size, 3), pooling="avg")
+    output = tf.keras.layers.Dense(3, activation="sigmoid")(base_model.output)
+    return tf.keras.Model(inputs=base_model.input, outputs=output)
+
+def run_setting(setting):
+    import numpy as np
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(setting["intra"])
+    tf.config.threading.set_inter_op_parallelism_threads(setting["inter"])
+    from inference import full_predict
+
+    models = [load_member(path, setting["image_size"]) for path in setting["models"]]
+    members = [(f"member{i}", member) for i, member in enumerate(models[1:], 1)]
+    x = np.random.default_rng(42).random((setting["batch_size"], *models[0].input_shape[1:]), dtype=np.float32)
+
+    results = []
+    for execution in ["sequential", "parallel"]:
+        parallel = execution == "parallel"
+        timings = []
+
+        def infer(x):
+            timings.append(full_predict(models[0], x, members=members, parallel=parallel)[1])
+        latencies = measure(infer, x, setting["warmup"], setting["runs"], setting["seconds"])
+        timings = timings[setting["warmup"]:]
+        results.append({
+            "intra_op_threads": setting["intra"],
+            "inter_op_threads": setting["inter"],
+            "execution": execution,
+            "members": len(models),
+            "batch_size": setting["batch_size"],
+            "runs": len(latencies),
+            "latency_p50_ms": latencies[len(latencies) // 2] * 1000,
+            "latency_p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+            # median time of every member inside the requests
+            "member_p50_ms": [sorted(t["members"][i]["seconds"] for t in timings)[len(timings) // 2] * 1000
+                              for i in range(len(models))],
+            "peak_rss_mb": peak_rss_mb()
+        })
+    return results
+
+def run_in_subprocess(setting):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--setting", json.dumps(setting)],
+                            stdout=subprocess.PIPE, check=True).stdout.decode()
+    # the results are the last line, tensorflow may log before it
+    return json.loads(output.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    cpus = os.cpu_count() or 1
+    ap = argparse.ArgumentParser(description="parallel versus sequential ensemble inference latency")
+    ap.add_argument("--models", nargs="+", default=[MODEL_PATH, "output/models/LuNet_v2.h5"],
+                    help="full model first, then the members; missing models are untrained DenseNet121s")
+    ap.add_argument("--image-size", type=int, default=224)
+    ap.add_argument("--batch-size", type=int, default=1)
+    ap.add_argument("--intra", type=int, nargs="+", default=sorted({0, max(cpus // 2, 1)}),
+                    help="intra-op thread counts, 0 lets tensorflow decide")
+    ap.add_argument("--inter", type=int, nargs="+", default=[0])
+    ap.add_argument("--warmup", type=int, default=3)
+    ap.add_argument("--runs", type=int, default=20, help="minimum measured runs")
+    ap.add_argument("--seconds", type=float, default=5.0, help="minimum measured seconds")
+    ap.add_argument("--output", default="output/ensemble_benchmark.json")
+    ap.add_argument("--setting", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.setting:
+        print(json.dumps(run_setting(json.loads(args.setting))))
+        sys.exit(0)
+
+    results = []
+    for intra in args.intra:
+        for inter in args.inter:
+            print(f"Benchmarking intra={intra} inter={inter}...", file=sys.stderr)
+            results += run_in_subprocess({
+                "models": args.models, "image_size": args.image_size, "batch_size": args.batch_size,
+                "intra": intra, "inter": inter,
+                "warmup": args.warmup, "runs": args.runs, "seconds": args.seconds
+            })
+
+    print(f"{'intra':>5} {'inter':>5} {'execution':<11} {'p50 ms':>9} {'p95 ms':>9} {'members p50 ms':<24} {'speedup':>8}")
+    for r in results:
+        sequential = next(s for s in results if s["execution"] == "sequential"
+                          and s["intra_op_threads"] == r["intra_op_threads"]
+                          and s["inter_op_threads"] == r["inter_op_threads"])
+        r["speedup"] = sequential["latency_p50_ms"] / r["latency_p50_ms"]
+        members = " ".join(f"{t:.1f}" for t in r["member_p50_ms"])
+        print(f"{r['intra_op_threads']:>5} {r['inter_op_threads']:>5} {r['execution']:<11} "
+              f"{r['latency_p50_ms']:>9.2f} {r['latency_p95_ms']:>9.2f} {members:<24} {r['speedup']:>7.2f}x")
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({
+            "models": [path if os.path.exists(path) else "densenet121" for path in args.models],
+            "machine": machine_info(),
+            "results": results
+        }, f, indent=2)
+    print(f"Results written to {args.output}")
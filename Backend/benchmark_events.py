@@ -0,0 +1,127 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+import requests
+from loadtest import free_port, wait_until_ready
+
+# Open dashboards against the real gunicorn server: N event streams are held open,
+# then the latency of /health shows whether other requests still get a slot.
+#   thread  gunicorn.conf.py, the thread workers that serve /predict
+#   gevent  gunicorn_events.conf.py, the event stream server
+# Both serve scan_events_app:app with SCAN_EVENTS_MODE=local, so no MongoDB is needed;
+# without one, MONGODB_URI=mongodb://localhost:27017/?serverSelectionTimeoutMS=300
+# keeps the workers from waiting 30s for it at startup
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIGS = {
+    'thread': ['-c', 'gunicorn.conf.py'],
+    'gevent': ['-c', 'gunicorn_events.conf.py']
+}
+
+def open_stream(port, token, timeout):
+    """Raw socket GET /scan/events, returns it once the first event (retry:) arrived, else None"""
+    s = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+    s.sendall(f'GET /scan/events?token={token} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+              f'Accept: text/event-stream\r\n\r\n'.encode())
+    try:
+        data = b''
+        while b'retry:' not in data:
+            chunk = s.recv(4096)
+            if not chunk:
+                raise OSError('closed')
+            data += chunk
+        return s
+    except OSError:
+        s.close()
+        return None
+
+def health_latency(url, samples, timeout):
+    latencies = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        try:
+            requests.get(url + '/health', timeout=timeout).raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except requests.RequestException:
+            latencies.append(None)
+    return latencies
+
+def measure(config, dashboards, samples, stream_timeout, health_timeout, timeout=120):
+    from scan_events_app import stream_token
+
+    port = free_port()
+    env = dict(os.environ, SCAN_EVENTS_MODE='local', PREFORK_MODE='off',
+               GUNICORN_BIND=f'127.0.0.1:{port}', EVENTS_BIND=f'127.0.0.1:{port}')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', *CONFIGS[config], 'scan_events_app:app'],
+                              cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    streams = []
+    try:
+        wait_until_ready(lambda: requests.get(url + '/health', timeout=5).ok, timeout, f'gunicorn ({config})')
+        idle = health_latency(url, samples, health_timeout)
+
+        start = time.perf_counter()
+        failed = 0
+        for i in range(dashboards):
+            stream = open_stream(port, stream_token(f'dashboard{i}@example.com'), stream_timeout)
+            if stream is None:
+                failed += 1
+            else:
+                streams.append(stream)
+            if failed >= 3:
+                break  # the server stopped accepting streams, the rest would only time out
+        open_seconds = time.perf_counter() - start
+        busy = health_latency(url, samples, health_timeout)
+    finally:
+        for stream in streams:
+            stream.close()
+        server.terminate()
+        server.wait()
+
+    def summarize(latencies):
+        ok = sorted(latency * 1000 for latency in latencies if latency is not None)
+        return {
+            'ok': len(ok),
+            'failed': len(latencies) - len(ok),
+            'p50_ms': ok[len(ok) // 2] if ok else None,
+            'max_ms': ok[-1] if ok else None
+        }
+
+    return {
+        'config': config,
+        'dashboards': dashboards,
+        'streams_open': len(streams),
+        'open_seconds': open_seconds,
+        'health_idle': summarize(idle),
+        'health_with_streams': summarize(busy)
+    }
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description='open event streams against gunicorn thread and gevent workers')
+    ap.add_argument('--dashboards', type=int, default=500)
+    ap.add_argument('--samples', type=int, default=10, help='/health requests before and with the streams')
+    ap.add_argument('--stream-timeout', type=float, default=5.0)
+    ap.add_argument('--health-timeout', type=float, default=5.0)
+    ap.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    ap.add_argument('--output', default='output/events_benchmark.json')
+    args = ap.parse_args()
+
+    results = [measure(config, args.dashboards, args.samples, args.stream_timeout, args.health_timeout)
+               for config in args.configs]
+
+    def ms(value):
+        return f"{value:>7.1f}" if value is not None else f"{'-':>7}"
+
+    print(f"{'config':<8} {'streams':>9} {'health idle p50':>16} {'health p50':>11} {'max':>8} {'failed':>7}")
+    for r in results:
+        busy = r['health_with_streams']
+        print(f"{r['config']:<8} {r['streams_open']:>4}/{r['dashboards']:<4} {ms(r['health_idle']['p50_ms'])} ms"
+              f"       {ms(busy['p50_ms'])} ms {ms(busy['max_ms'])} {busy['failed']:>7}")
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'results': results}, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,104 @@
+import io
+import os
+import json
+import gzip
+import time
+import base64
+import argparse
+import datetime
+from PIL import Image
+from compression import brotli
+from thumbnails import make_thumbnail, thumbnail_url
+
+# Payload size and estimated time-to-render of a scan history page, with the full
+# resolution data URLs in every row (before) and with thumbnail URLs (after).
+# Time-to-render = transfer time at the given bandwidth + decoding the images
+SEED_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+
+def make_scans(count, size):
+    seed = Image.open(SEED_IMAGE_PATH).convert('L')
+    scans = []
+    for i in range(count):
+        buffer = io.BytesIO()
+        image = seed.rotate(i % 7 - 3).resize((size, size), Image.BILINEAR)
+        image.save(buffer, format='JPEG', quality=92)
+        scans.append({
+            '_id': f'{i:024x}',
+            'user_email': 'doctor@example.com',
+            'prediction': 'Pneumonia',
+            'confidence': 0.87,
+            'disease': 'Pneumonia',
+            'status': 'Detected',
+            'precaution': 'Start antibiotic therapy as prescribed.',
+            'image_url': 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii'),
+            'date': (datetime.datetime(2024, 1, 1) + datetime.timedelta(hours=i)).isoformat(),
+            'all_probabilities': {'Normal': 0.05, 'Pneumonia': 0.87, 'Tuberculosis': 0.08}
+        })
+    return scans
+
+def encoded_sizes(body):
+    sizes = {'raw': len(body), 'gzip': len(gzip.compress(body, compresslevel=6))}
+    if brotli is not None:
+        sizes['br'] = len(brotli.compress(body, quality=5))
+    return sizes
+
+def decode_time(images):
+    start = time.perf_counter()
+    for data in images:
+        Image.open(io.BytesIO(data)).load()
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description='scan history payload before and after thumbnails')
+    ap.add_argument('--scans', type=int, default=50)
+    ap.add_argument('--size', type=int, default=2048, help='side of the uploaded images')
+    ap.add_argument('--bandwidth', type=float, default=20, help='client bandwidth in Mbit/s')
+    ap.add_argument('--output', default='output/history_benchmark.json')
+    args = ap.parse_args()
+
+    scans = make_scans(args.scans, args.size)
+    full_images = [base64.b64decode(scan['image_url'].split(',', 1)[1]) for scan in scans]
+    start = time.perf_counter()
+    thumbs = [make_thumbnail(data) for data in full_images]
+    thumbnail_time = (time.perf_counter() - start) / len(scans)
+
+    before = json.dumps({'scans': scans, 'total': len(scans)}).encode('utf-8')
+    after_rows = [{**{k: v for k, v in scan.items() if k != 'image_url'},
+                   'thumbnail_url': thumbnail_url(scan['_id'], scan['user_email'], 'secret')} for scan in scans]
+    after = json.dumps({'scans': after_rows, 'total': len(scans)}).encode('utf-8')
+
+    def report(body, images, image_bytes):
+        sizes = encoded_sizes(body)
+        transferred = min(sizes.values()) + image_bytes
+        transfer_time = transferred * 8 / (args.bandwidth * 1e6)
+        decode = decode_time(images)
+        return {
+            'json_bytes': sizes,
+            'image_bytes': image_bytes,
+            'transferred_bytes': transferred,
+            'transfer_time': transfer_time,
+            'decode_time': decode,
+            'time_to_render': transfer_time + decode
+        }
+
+    # before: the images are inside the (hardly compressible) json
+    results = {
+        'scans': args.scans,
+        'image_size': args.size,
+        'bandwidth_mbit': args.bandwidth,
+        'thumbnail_time_per_scan': thumbnail_time,
+        'before': report(before, full_images, 0),
+        'after': report(after, [thumb['data'] for thumb in thumbs], sum(len(thumb['data']) for thumb in thumbs))
+    }
+
+    for name in ('before', 'after'):
+        r = results[name]
+        print(f"{name:<7} json: {r['json_bytes']['raw'] / 1024:9.1f} KB (gzip {r['json_bytes']['gzip'] / 1024:9.1f} KB) "
+              f"images: {r['image_bytes'] / 1024:8.1f} KB transferred: {r['transferred_bytes'] / 1024:9.1f} KB "
+              f"time-to-render: {r['time_to_render'] * 1000:7.0f} ms")
+    print(f"Thumbnail creation: {thumbnail_time * 1000:.1f} ms per scan at save time")
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+
+# Offline inference benchmark: images/sec, per-image latency and peak RSS of the
+# serving model for every batch size, thread setting, precision and call style.
+# TensorFlow fixes its thread pools at startup, so every thread/precision setting
+# is measured in a fresh process.
+MODEL_PATH = os.getenv("MODEL_PATH", "output/models/LuNet.h5")
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64]
+PRECISIONS = ["float32", "mixed_float16", "mixed_bfloat16"]
+METHODS = ["predict", "call", "function"]
+
+def load_model(model_path, precision):
+    """The serving model, or the dummy model from app.py when it is absent, in the given precision"""
+    import tensorflow as tf
+    if os.path.exists(model_path):
+        model = tf.keras.models.load_model(model_path, compile=False)
+    else:
+        model = tf.keras.Sequential([
+            tf.keras.layers.Input(shape=(224, 224, 3)),
+            tf.keras.layers.GlobalAveragePooling2D(),
+            tf.keras.layers.Dense(3, activation='softmax')
+        ])
+    if precision == "float32":
+        return model
+
+    # rebuild the model under the mixed precision policy: layers saved with an
+    # explicit float32 dtype keep it, so the dtype is dropped from their configs
+    tf.keras.mixed_precision.set_global_policy(precision)
+    config = model.get_config()
+    for layer in config["layers"]:
+        layer["config"].pop("dtype", None)
+    rebuilt = model.__class__.from_config(config)
+    rebuilt.set_weights(model.get_weights())
+    return rebuilt
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def measure(infer, x, warmup, min_runs, min_seconds):
+    """Batch latencies of infer(x) after warmup calls, at least min_runs and min_seconds worth"""
+    for _ in range(warmup):
+        infer(x)
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < min_runs or time.perf_counter() - start < min_seconds:
+        begin = time.perf_counter()
+        infer(x)
+        latencies.append(time.perf_counter() - begin)
+    return sorted(latencies)
+
+def run_setting(setting):
+    """Benchmark one thread/precision setting in this process, for all batch sizes and methods"""
+    import numpy as np
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(setting["intra"])
+    tf.config.threading.set_inter_op_parallelism_threads(setting["inter"])
+
+    model = load_model(setting["model"], setting["precision"])
+    input_shape = model.input_shape[1:]
+    function = tf.function(lambda x: model(x, training=False))
+    methods = {
+        "predict": lambda x: model.predict(x, batch_size=len(x)),
+        "call": lambda x: model(x, training=False).numpy(),
+        "function": lambda x: function(tf.constant(x)).numpy()
+    }
+
+    results = []
+    rng = np.random.default_rng(42)
+    for batch_size in setting["batch_sizes"]:
+        x = rng.random((batch_size, *input_shape), dtype=np.float32)
+        for method in setting["methods"]:
+            latencies = measure(methods[method], x, setting["warmup"], setting["runs"], setting["seconds"])
+            total = sum(latencies)
+            results.append({
+                "intra_op_threads": setting["intra"],
+                "inter_op_threads": setting["inter"],
+                "precision": setting["precision"],
+                "method": method,
+                "batch_size": batch_size,
+                "runs": len(latencies),
+                "images_per_sec": batch_size * len(latencies) / total,
+                "latency_per_image_ms": total / (batch_size * len(latencies)) * 1000,
+                "batch_latency_p50_ms": latencies[len(latencies) // 2] * 1000,
+                "batch_latency_p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+                # batch sizes run in increasing order, so this is the peak up to this batch size
+                "peak_rss_mb": peak_rss_mb()
+            })
+    return results
+
+def run_in_subprocess(setting):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--setting", json.dumps(setting)],
+                            stdout=subprocess.PIPE, check=True).stdout.decode()
+    # the results are the last line, tensorflow may log before it
+    return json.loads(output.strip().splitlines()[-1])
+
+def machine_info():
+    import tensorflow as tf
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "tensorflow": tf.__version__,
+        "gpus": [gpu.name for gpu in tf.config.list_physical_devices("GPU")]
+    }
+
+def best(results, key, reverse=False, **where):
+    candidates = [r for r in results if all(r[k] == v for k, v in where.items())]
+    return sorted(candidates, key=lambda r: r[key], reverse=reverse)[0] if candidates else None
+
+if __name__ == "__main__":
+    cpus = os.cpu_count() or 1
+    ap = argparse.ArgumentParser(description="offline inference benchmark of the serving model")
+    ap.add_argument("--model", default=MODEL_PATH, help="keras model, the dummy model is used when missing")
+    ap.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES)
+    ap.add_argument("--intra", type=int, nargs="+", default=sorted({0, 1, cpus}),
+                    help="intra-op thread counts, 0 lets tensorflow decide")
+    ap.add_argument("--inter", type=int, nargs="+", default=[0, 1], help="inter-op thread counts")
+    ap.add_argument("--precisions", nargs="+", default=PRECISIONS, choices=PRECISIONS)
+    ap.add_argument("--methods", nargs="+", default=METHODS, choices=METHODS,
+                    help="keras predict, direct model call, or the call compiled with tf.function")
+    ap.add_argument("--warmup", type=int, default=3)
+    ap.add_argument("--runs", type=int, default=10, help="minimum measured runs")
+    ap.add_argument("--seconds", type=float, default=1.0, help="minimum measured seconds")
+    ap.add_argument("--output", default="output/inference_benchmark.json")
+    ap.add_argument("--setting", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.setting:
+        print(json.dumps(run_setting(json.loads(args.setting))))
+        sys.exit(0)
+
+    results = []
+    for precision in args.precisions:
+        for intra in args.intra:
+            for inter in args.inter:
+                print(f"Benchmarking {precision} intra={intra} inter={inter}...", file=sys.stderr)
+                results += run_in_subprocess({
+                    "model": args.model, "precision": precision, "intra": intra, "inter": inter,
+                    "batch_sizes": sorted(args.batch_sizes), "methods": args.methods,
+                    "warmup": args.warmup, "runs": args.runs, "seconds": args.seconds
+                })
+
+    print(f"{'precision':<15} {'intra':>5} {'inter':>5} {'method':<9} {'batch':>5} "
+          f"{'images/s':>9} {'ms/image':>9} {'p95 ms':>9} {'peak RSS MB':>12}")
+    for r in results:
+        print(f"{r['precision']:<15} {r['intra_op_threads']:>5} {r['inter_op_threads']:>5} {r['method']:<9} "
+              f"{r['batch_size']:>5} {r['images_per_sec']:>9.1f} {r['latency_per_image_ms']:>9.2f} "
+              f"{r['batch_latency_p95_ms']:>9.2f} {r['peak_rss_mb']:>12.0f}")
+
+    # serving settings for this machine: the fastest single-image request and the best batch throughput
+    recommendations = {
+        "lowest_latency_batch_1": best(results, "batch_latency_p50_ms", batch_size=1),
+        "highest_throughput": best(results, "images_per_sec", reverse=True)
+    }
+    for name, r in recommendations.items():
+        if r:
+            print(f"{name}: {r['precision']} intra={r['intra_op_threads']} inter={r['inter_op_threads']} "
+                  f"{r['method']} batch={r['batch_size']} ({r['images_per_sec']:.1f} images/s, "
+                  f"{r['batch_latency_p50_ms']:.2f} ms/batch)")
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({
+            "model": args.model if os.path.exists(args.model) else "dummy",
+            "machine": machine_info(),
+            "results": results,
+            "recommendations": recommendations
+        }, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Memory of the gunicorn workers in every PREFORK_MODE (see gunicorn.conf.py).
+# RSS counts shared pages in every process that maps them, PSS splits them between
+# the processes and USS only counts the private pages, so the sum of the PSS is
+# what the server really costs.
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SEED_IMAGE_PATH = os.path.join(BACKEND_DIR, 'test_image.jpg')
+MODES = ['off', 'import', 'model']
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def memory(pid):
+    """RSS, PSS and USS in MB from /proc/<pid>/smaps_rollup (Linux)"""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {
+        'rss_mb': fields['Rss'],
+        'pss_mb': fields['Pss'],
+        'uss_mb': fields['Private_Clean'] + fields['Private_Dirty']
+    }
+
+def children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+def measure(mode, app, workers, requests_count, timeout=300):
+    """Start gunicorn in one mode, send traffic to warm up every worker, then read the memory"""
+    port = free_port()
+    env = dict(os.environ, PREFORK_MODE=mode, GUNICORN_WORKERS=str(workers), GUNICORN_BIND=f'127.0.0.1:{port}')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', app], cwd=BACKEND_DIR,
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.time() + timeout
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with {server.returncode} in PREFORK_MODE={mode}')
+            try:
+                if requests.get(url + '/health', timeout=5).ok and len(children(server.pid)) == workers:
+                    break
+            except requests.RequestException:
+                pass
+            if time.time() > deadline:
+                raise RuntimeError(f'gunicorn did not start within {timeout}s')
+            time.sleep(0.5)
+
+        with open(SEED_IMAGE_PATH, 'rb') as f:
+            image = f.read()
+        def predict(_):
+            return requests.post(url + '/predict', files={'file': ('test_image.jpg', image, 'image/jpeg')},
+                                 timeout=120).status_code
+        with ThreadPoolExecutor(max_workers=workers * 2) as executor:
+            statuses = list(executor.map(predict, range(requests_count)))
+
+        master = memory(server.pid)
+        worker_memory = [memory(pid) for pid in children(server.pid)]
+    finally:
+        server.terminate()
+        server.wait()
+
+    def mean(key):
+        return sum(m[key] for m in worker_memory) / len(worker_memory)
+
+    return {
+        'mode': mode,
+        'workers': len(worker_memory),
+        'predict_ok': sum(1 for status in statuses if status == 200),
+        'master': master,
+        'worker_memory': worker_memory,
+        'worker_rss_mb': mean('rss_mb'),
+        'worker_pss_mb': mean('pss_mb'),
+        'worker_uss_mb': mean('uss_mb'),
+        'total_pss_mb': master['pss_mb'] + sum(m['pss_mb'] for m in worker_memory)
+    }
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description='per worker memory of the gunicorn pre-fork modes')
+    ap.add_argument('--app', default='app:app', help='wsgi app, app_mongodb:app needs MongoDB')
+    ap.add_argument('--workers', type=int, default=4)
+    ap.add_argument('--requests', type=int, default=32, help='predictions sent before measuring')
+    ap.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    ap.add_argument('--output', default='output/prefork_memory.json')
+    args = ap.parse_args()
+
+    results = []
+    for mode in args.modes:
+        try:
+            results.append(measure(mode, args.app, args.workers, args.requests))
+        except RuntimeError as e:
+            print(f"{mode}: {e}")
+
+    print(f"{'mode':<8} {'workers':>7} {'ok':>4} {'RSS/worker':>11} {'PSS/worker':>11} {'USS/worker':>11} {'total PSS':>10}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['workers']:>7} {r['predict_ok']:>4} {r['worker_rss_mb']:>8.0f} MB "
+              f"{r['worker_pss_mb']:>8.0f} MB {r['worker_uss_mb']:>8.0f} MB {r['total_pss_mb']:>7.0f} MB")
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'app': args.app, 'results': results}, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,108 @@
+# import the necessary packages
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image
+from helper import config
+from helper import dedup
+
+
+def synthetic_hashes(n, duplicates, prototypes, flip, max_distance, rng):
+    """[hashes scattered around a few prototypes like those of chest x-rays, which
+    look alike, with `duplicates` planted copies within max_distance bits]
+    """
+    bits = rng.integers(0, 2, (prototypes, 64), dtype=np.uint8)[rng.integers(0, prototypes, n)]
+    bits ^= (rng.random((n, 64)) < flip).astype(np.uint8)
+    sources = rng.choice(n - duplicates, duplicates, replace=False)
+    copies = bits[sources].copy()
+    for (copy, distance) in zip(copies, rng.integers(0, max_distance + 1, duplicates)):
+        copy[rng.choice(64, distance, replace=False)] ^= 1
+    bits[n - duplicates:] = copies
+    hashes = np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+    return (hashes, sources)
+
+
+def brute_force_pairs(hashes, max_distance):
+    pairs = []
+    for i in range(len(hashes) - 1):
+        distances = dedup.hamming_distance(hashes[i + 1:], hashes[i])
+        for j in np.flatnonzero(distances <= max_distance):
+            pairs.append((i, i + 1 + j))
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def write_images(path, count, size, rng):
+    image_paths = []
+    base = rng.integers(0, 256, (size // 16, size // 16), dtype=np.uint8)
+    for i in range(count):
+        noise = rng.integers(0, 32, (size // 16, size // 16), dtype=np.uint8)
+        image = Image.fromarray(base // 2 + noise).resize((size, size), Image.BILINEAR)
+        image_paths.append(os.path.sep.join([path, "{:05d}.png".format(i)]))
+        image.save(image_paths[-1])
+    return image_paths
+
+
+if __name__ == "__main__":
+    # hashing throughput of synthetic png scans (1 process versus all cores) and
+    # near duplicate search over --hashes synthetic hashes, multi-index hashing
+    # versus comparing every pair (timed on --brute-force-sample hashes and scaled)
+    ap = argparse.ArgumentParser(description="perceptual hash deduplication benchmark")
+    ap.add_argument("--images", type=int, default=200)
+    ap.add_argument("--image-size", type=int, default=1024)
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    ap.add_argument("--hashes", type=int, default=120000)
+    ap.add_argument("--duplicates", type=int, default=2000)
+    ap.add_argument("--prototypes", type=int, default=32)
+    ap.add_argument("--flip", type=float, default=0.15, help="bit flip rate around the prototypes")
+    ap.add_argument("--max-distance", type=int, default=config.DEDUP_MAX_DISTANCE)
+    ap.add_argument("--brute-force-sample", type=int, default=10000)
+    ap.add_argument("--output", default=os.path.sep.join([config.OUTPUT_PATH, "dedup_benchmark.json"]))
+    args = ap.parse_args()
+    rng = np.random.default_rng(config.SEED)
+    results = {"settings": vars(args)}
+
+    path = tempfile.mkdtemp()
+    try:
+        image_paths = write_images(path, args.images, args.image_size, rng)
+        for workers in sorted({1, args.workers}):
+            start = time.perf_counter()
+            (_, valid) = dedup.compute_hashes(image_paths, workers=workers)
+            elapsed = time.perf_counter() - start
+            results["hashing_{}_workers".format(workers)] = args.images / elapsed
+            print("hashing, {} workers: {:.0f} images/s ({} hashed), {:.1f} min for 120k images".format(
+                workers, args.images / elapsed, valid.sum(), 120000 / (args.images / elapsed) / 60))
+    finally:
+        shutil.rmtree(path)
+
+    (hashes, sources) = synthetic_hashes(args.hashes, args.duplicates, args.prototypes, args.flip,
+                                         args.max_distance, rng)
+    start = time.perf_counter()
+    pairs = dedup.near_duplicate_pairs(hashes, args.max_distance)
+    elapsed = time.perf_counter() - start
+    planted = set(zip(sources, range(args.hashes - args.duplicates, args.hashes)))
+    recall = len(planted & set(map(tuple, pairs))) / len(planted)
+    results["search_seconds"] = elapsed
+    results["search_pairs"] = len(pairs)
+    results["planted_recall"] = recall
+    print("multi-index hashing: {} hashes in {:.2f} s, {} pairs, planted duplicates found {:.3f}".format(
+        args.hashes, elapsed, len(pairs), recall))
+
+    sample = hashes[:args.brute_force_sample]
+    start = time.perf_counter()
+    expected = brute_force_pairs(sample, args.max_distance)
+    elapsed = time.perf_counter() - start
+    found = dedup.near_duplicate_pairs(sample, args.max_distance)
+    scaled = elapsed * (args.hashes / len(sample)) ** 2
+    results["brute_force_seconds"] = scaled
+    results["sample_pairs_match"] = bool(np.array_equal(expected, found))
+    print("every pair: {} hashes in {:.2f} s, about {:.0f} s for {} ({} the multi-index pairs)".format(
+        len(sample), elapsed, scaled, args.hashes, "same as" if results["sample_pairs_match"] else "DIFFERENT from"))
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("[INFO] results written to {}".format(args.output))
@@ -0,0 +1,139 @@
+# import the necessary packages
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+from helper import config
+
+
+def free_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    for s in sockets:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def run_worker(args):
+    """[train the densenet model on synthetic data and report the throughput (chief only)]
+    """
+    import tensorflow as tf
+    from tensorflow.keras.layers import Dense
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.applications.densenet import DenseNet121
+    from tensorflow.keras.callbacks import Callback
+    from helper import distribute
+
+    # split the cores between the local workers instead of oversubscribing them
+    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+    strategy = distribute.get_strategy()
+    global_batch_size = args.batch_size * strategy.num_replicas_in_sync
+
+    with strategy.scope():
+        base_model = DenseNet121(include_top=False,
+                                 weights=None,
+                                 input_shape=(args.image_size, args.image_size, 3),
+                                 pooling="avg")
+        output = Dense(len(config.CLASS_NAMES), activation="sigmoid")(base_model.output)
+        model = Model(inputs=base_model.input, outputs=output)
+        model.compile(optimizer="adam", loss="binary_crossentropy")
+
+    images = tf.random.uniform((global_batch_size, args.image_size, args.image_size, 3))
+    labels = tf.cast(tf.random.uniform((global_batch_size, len(config.CLASS_NAMES))) > 0.5, tf.float32)
+    dataset = tf.data.Dataset.from_tensors((images, labels)).repeat()
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    dataset = dataset.with_options(options)
+
+    class StepTimer(Callback):
+        def on_train_batch_end(self, batch, logs=None):
+            # skip the warmup steps (graph tracing, collective setup)
+            if batch == args.warmup_steps - 1:
+                self.start = time.perf_counter()
+
+        def on_train_end(self, logs=None):
+            self.elapsed = time.perf_counter() - self.start
+
+    timer = StepTimer()
+    model.fit(dataset, epochs=1, steps_per_epoch=args.warmup_steps + args.steps,
+              callbacks=[timer], verbose=0)
+
+    if distribute.is_chief():
+        print(json.dumps({
+            "workers": distribute.get_cluster_spec()[1],
+            "replicas": strategy.num_replicas_in_sync,
+            "global_batch_size": global_batch_size,
+            "step_time": timer.elapsed / args.steps,
+            "images_per_sec": global_batch_size * args.steps / timer.elapsed
+        }))
+
+
+def run_benchmark(args, num_workers):
+    """[launch num_workers local processes as a multi worker cluster]
+    """
+    ports = free_ports(num_workers)
+    cluster = {"worker": [f"localhost:{port}" for port in ports]}
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ)
+        env.pop("TF_CONFIG", None)
+        if num_workers > 1:
+            env["TF_CONFIG"] = json.dumps({"cluster": cluster, "task": {"type": "worker", "index": index}})
+        command = [sys.executable, __file__, "--worker",
+                   "--threads", str(threads),
+                   "--batch-size", str(args.batch_size),
+                   "--image-size", str(args.image_size),
+                   "--steps", str(args.steps),
+                   "--warmup-steps", str(args.warmup_steps)]
+        processes.append(subprocess.Popen(command, env=env, stdout=subprocess.PIPE, universal_newlines=True))
+
+    result = None
+    for process in processes:
+        (stdout, _) = process.communicate()
+        for line in stdout.splitlines():
+            if line.startswith("{"):
+                result = json.loads(line)
+    return result
+
+
+if __name__ == "__main__":
+    # define argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description="distributed training scaling benchmark on one machine")
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="number of local worker processes")
+    ap.add_argument("--batch-size", type=int, default=8, help="per replica batch size")
+    ap.add_argument("--image-size", type=int, default=224, help="input image size")
+    ap.add_argument("--steps", type=int, default=20, help="number of timed training steps")
+    ap.add_argument("--warmup-steps", type=int, default=3, help="number of untimed training steps")
+    ap.add_argument("--threads", type=int, default=0, help="intra-op threads per worker (set by the launcher)")
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    ap.add_argument("--output", default=os.path.sep.join([config.OUTPUT_PATH, "distribute_benchmark.json"]),
+                    help="path to the json result file")
+    args = ap.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        sys.exit(0)
+
+    results = []
+    for num_workers in args.workers:
+        print(f"[INFO] benchmarking {num_workers} worker(s)...")
+        results.append(run_benchmark(args, num_workers))
+
+    # show the scaling table relative to a single worker
+    baseline = results[0]["images_per_sec"]
+    print(f"{'workers':>8} {'global batch':>13} {'step time (s)':>14} {'images/sec':>11} {'speedup':>8}")
+    for result in results:
+        print(f"{result['workers']:>8} {result['global_batch_size']:>13} {result['step_time']:>14.3f} "
+              f"{result['images_per_sec']:>11.1f} {result['images_per_sec'] / baseline:>8.2f}")
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"[INFO] results written to {args.output}")
@@ -0,0 +1,181 @@
+# import the necessary packages
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from helper import config
+
+# training configurations compared by the benchmark: the current one (224x224,
+# float32), progressive resizing, and progressive resizing in mixed bfloat16
+CONFIGURATIONS = {
+    "baseline": {"progressive": False, "precision": "float32"},
+    "progressive": {"progressive": True, "precision": "float32"},
+    "progressive_bfloat16": {"progressive": True, "precision": "mixed_bfloat16"}
+}
+
+
+def parse_schedule(schedule):
+    """["128:4,160:8,224" -> [(128, 4), (160, 8), (224, None)], the last stage runs to the end]
+    """
+    stages = []
+    for stage in schedule.split(","):
+        (image_size, _, last_epoch) = stage.partition(":")
+        stages.append((int(image_size), int(last_epoch) if last_epoch else None))
+    return stages
+
+
+def run_configuration(setting):
+    """[train one configuration on the data subset and record the validation auroc
+        (at the full resolution) and the training time of every epoch]
+    """
+    import numpy as np
+    from tensorflow.keras.callbacks import Callback
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+    from train import Train
+    from helper import precision
+    from helper.checkpoint import TrainingCheckpoint
+    from helper.evaluation import roc_auc
+
+    policy = precision.set_precision(setting["precision"])
+
+    class SubsetTrain(Train):
+        def __init__(self):
+            super(SubsetTrain, self).__init__()
+            self.train_df = self.train_df.sample(min(setting["train_images"], len(self.train_df)),
+                                                 random_state=config.SEED)
+            self.val_df = self.val_df.sample(min(setting["val_images"], len(self.val_df)),
+                                             random_state=config.SEED)
+            self.model_path = os.path.sep.join([setting["output_dir"], "LuNet.h5"])
+            self.checkpoint_dir = os.path.sep.join([setting["output_dir"], "checkpoints"])
+            self.log_dir = os.path.sep.join([setting["output_dir"], "logs"])
+            self.epochs = setting["epochs"]
+            self.set_batch_size(setting["batch_size"])
+            if setting["progressive"]:
+                self.progressive_schedule = [(image_size, last_epoch or self.epochs)
+                                             for (image_size, last_epoch) in setting["schedule"]]
+
+    class AurocMonitor(Callback):
+        def __init__(self, val_df, stages, image_size):
+            super(AurocMonitor, self).__init__()
+            val_datagen = ImageDataGenerator(rescale=1./255).flow_from_dataframe(val_df,
+                                                                                 directory=None,
+                                                                                 x_col="Image Path",
+                                                                                 y_col=config.CLASS_NAMES,
+                                                                                 target_size=(image_size, image_size),
+                                                                                 class_mode="raw",
+                                                                                 batch_size=setting["batch_size"],
+                                                                                 shuffle=False)
+            batches = [val_datagen[idx] for idx in range(len(val_datagen))]
+            self.images = np.concatenate([images for (images, _) in batches])
+            self.labels = np.concatenate([labels for (_, labels) in batches])
+            self.stages = stages
+            self.history = []
+            self.elapsed = 0.
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            # the training time excludes this evaluation at full resolution
+            self.elapsed += time.perf_counter() - self.start
+            scores = self.model.predict(self.images, batch_size=setting["batch_size"])
+            image_size = next(size for (size, last_epoch) in self.stages if epoch < last_epoch)
+            self.history.append({
+                "epoch": epoch + 1,
+                "image_size": image_size,
+                "seconds": self.elapsed,
+                "val_auroc": float(np.nanmean(roc_auc(scores, self.labels)))
+            })
+            print(f"[INFO] epoch {epoch + 1} at {image_size}x{image_size}: "
+                  f"val auroc {self.history[-1]['val_auroc']:.4f}, {self.elapsed:.0f} s of training")
+
+    train = SubsetTrain()
+    model = train.build_model()
+    (train_datagen, val_datagen) = train.data_generator()
+    callbacks = train.callbacks(train_datagen)
+    monitor = AurocMonitor(train.val_df, train.stages(), train.image_size)
+    # the training checkpoint has to stay last
+    index = next(i for (i, callback) in enumerate(callbacks) if isinstance(callback, TrainingCheckpoint))
+    callbacks.insert(index, monitor)
+    train.train(model, train_datagen, val_datagen, callbacks)
+
+    reached = [entry for entry in monitor.history if entry["val_auroc"] >= setting["target"]]
+    return {
+        "precision": policy,
+        "stages": train.stages(),
+        "epochs_run": len(monitor.history),
+        "training_seconds": monitor.elapsed,
+        "best_val_auroc": max(entry["val_auroc"] for entry in monitor.history),
+        "final_val_auroc": monitor.history[-1]["val_auroc"],
+        "time_to_target_seconds": reached[0]["seconds"] if reached else None,
+        "epochs_to_target": reached[0]["epoch"] if reached else None,
+        "history": monitor.history
+    }
+
+
+def run_in_subprocess(setting):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--setting", json.dumps(setting)],
+                            stdout=subprocess.PIPE, check=True).stdout.decode()
+    # the results are the last line, tensorflow and keras log before it
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    # time to reach a target validation auroc on a subset of the data for the current
+    # training configuration and the progressive resizing / bfloat16 ones. every
+    # configuration trains in a fresh process, the precision policy is global
+    ap = argparse.ArgumentParser(description="time to target auroc of the training schedules")
+    ap.add_argument("--configurations", nargs="+", default=list(CONFIGURATIONS), choices=list(CONFIGURATIONS))
+    ap.add_argument("--train-images", type=int, default=4000)
+    ap.add_argument("--val-images", type=int, default=1000)
+    ap.add_argument("--epochs", type=int, default=12)
+    ap.add_argument("--batch-size", type=int, default=config.BATCH_SIZE, help="per replica batch size")
+    ap.add_argument("--schedule", default="128:4,160:8,224", help="image size:last epoch stages")
+    ap.add_argument("--target", type=float, default=config.TARGET_AUROC, help="target mean validation auroc")
+    ap.add_argument("--output", default=config.PROGRESSIVE_REPORT_PATH)
+    ap.add_argument("--setting", help=argparse.SUPPRESS)
+    args = vars(ap.parse_args())
+
+    if args["setting"]:
+        # keep the stdout of keras apart from the results line
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        results = run_configuration(json.loads(args["setting"]))
+        print(json.dumps(results), file=stdout)
+        sys.exit(0)
+
+    report = {"settings": {key: value for (key, value) in args.items() if key != "setting"}, "results": {}}
+    for name in args["configurations"]:
+        output_dir = tempfile.mkdtemp()
+        try:
+            print(f"[INFO] training the {name} configuration...", file=sys.stderr)
+            report["results"][name] = run_in_subprocess({
+                **CONFIGURATIONS[name],
+                "train_images": args["train_images"],
+                "val_images": args["val_images"],
+                "epochs": args["epochs"],
+                "batch_size": args["batch_size"],
+                "schedule": parse_schedule(args["schedule"]),
+                "target": args["target"],
+                "output_dir": output_dir
+            })
+        finally:
+            shutil.rmtree(output_dir)
+
+    baseline = report["results"].get("baseline", {}).get("time_to_target_seconds")
+    print(f"{'configuration':<22} {'precision':<15} {'epochs':>6} {'train s':>9} {'best auroc':>11} "
+          f"{'to target s':>12} {'speedup':>8}")
+    for (name, result) in report["results"].items():
+        to_target = result["time_to_target_seconds"]
+        speedup = f"{baseline / to_target:7.2f}x" if baseline and to_target else f"{'-':>8}"
+        print(f"{name:<22} {result['precision']:<15} {result['epochs_run']:>6} {result['training_seconds']:>9.0f} "
+              f"{result['best_val_auroc']:>11.4f} {f'{to_target:.0f}' if to_target is not None else '-':>12} {speedup}")
+
+    os.makedirs(os.path.dirname(args["output"]) or ".", exist_ok=True)
+    with open(args["output"], "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[INFO] report written to {args['output']}")
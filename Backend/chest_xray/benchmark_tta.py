@@ -0,0 +1,63 @@
+# import the necessary packages
+import numpy as np
+import os
+import json
+import time
+import argparse
+from tensorflow.keras.models import load_model
+from test import Test
+from helper import config, utils
+
+
+def evaluate_tta(model, test, k):
+    """[predict the whole test split with k views per image and time it]
+
+    Returns:
+        [dict] -- [per image latency, accuracy and mean auroc for k]
+    """
+    test_datagen = test.data_generator()
+    (preds, labels, elapsed) = ([], [], 0.)
+    for _ in range(len(test_datagen)):
+        (images, y) = next(test_datagen)
+        start = time.perf_counter()
+        preds.append(utils.tta_predict(model, images, k))
+        elapsed += time.perf_counter() - start
+        labels.append(y)
+    (preds, labels) = (np.concatenate(preds), np.concatenate(labels))
+
+    test_log_path = os.path.join(config.OUTPUT_PATH, f"test_tta{k}.log")
+    (_, mean_auroc) = test.calculate_auroc(preds, labels, test_log_path=test_log_path)
+    return {
+        "k": k,
+        "latency_ms_per_image": elapsed * 1000 / len(preds),
+        "accuracy": float(np.mean((preds > 0.5) == labels)),
+        "mean_auroc": float(mean_auroc)
+    }
+
+
+if __name__ == "__main__":
+    # define argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description="latency/accuracy tradeoff of test-time augmentation")
+    ap.add_argument("-k", nargs="+", type=int, default=[1, 4, 8], help="number of views per image")
+    ap.add_argument("--output", default=os.path.sep.join([config.OUTPUT_PATH, "tta_benchmark.json"]),
+                    help="path to the json result file")
+    args = vars(ap.parse_args())
+
+    # load trained model
+    print("[INFO] loading trained model...")
+    model = load_model(config.MODEL_PATH, compile=False)
+    test = Test()
+
+    results = []
+    for k in args["k"]:
+        print(f"[INFO] evaluating the test split with k={k}...")
+        results.append(evaluate_tta(model, test, k))
+
+    print(f"{'k':>3} {'ms/image':>9} {'accuracy':>9} {'mean auroc':>11}")
+    for result in results:
+        print(f"{result['k']:>3} {result['latency_ms_per_image']:>9.1f} "
+              f"{result['accuracy']:>9.4f} {result['mean_auroc']:>11.4f}")
+
+    with open(args["output"], "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"[INFO] results written to {args['output']}")
@@ -3,11 +3,13 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
+import json
 import shutil
 from imutils import paths
 from itertools import chain
 from helper.utils import get_class_counts
 from helper import config
+from helper import dedup
 
 
 def add_image_path(df, images_base_path):
@@ -79,7 +81,7 @@ def TB_chest_xrays():
     TB_montgomery_df = TB_montgomery_df.rename(
         columns={'study_id': 'Image Index', 'findings': 'Finding Labels'})
     TB_montgomery_df = add_image_path(
-        TB_montgomery_df, config.TB_SHENZHEN_IMAGES_BASE_PATH)
+        TB_montgomery_df, config.TB_MONTGOMERY_IMAGES_BASE_PATH)
 
     # join the two TB_chest_xrays dataframes
     TB_chest_xrays_df = pd.concat([TB_shenzen_df, TB_montgomery_df])
@@ -191,9 +193,28 @@ if __name__ == "__main__":
     print(chest_xrays5_df.sample(3))
     print(chest_xrays5_df.info())
 
+    # ==============================================================
+    # keep one image of every group of near duplicates (perceptual hashes
+    # computed on all cores) so the same image cannot be in two splits
+    label_columns = config.CHESTXRAY14_COLS[2:] + config.TB_COLS[2:]
+    (chest_xrays5_df, dedup_report) = dedup.drop_near_duplicates(
+        chest_xrays5_df, label_columns, config.DEDUP_MAX_DISTANCE, cache_path=config.DEDUP_HASHES_PATH)
+    print("[INFO] near duplicates removed: {} of {} images ({} with conflicting labels)".format(
+        dedup_report["removed"], dedup_report["images"], dedup_report["label_conflicts"]))
+
     # ==============================================================
     # split the dataset into 90% training, 5% validation and 5% test
     (train_df, val_df, test_df) = train_validation_test_split(chest_xrays5_df)
 
+    # check the splits for leakage, validation and test images with a near
+    # duplicate in an earlier split are dropped
+    ((train_df, val_df, test_df), leaks) = dedup.remove_leakage(
+        [("training", train_df), ("validation", val_df), ("testing", test_df)], config.DEDUP_MAX_DISTANCE)
+    print("[INFO] cross split near duplicates: ", len(leaks))
+    leaks.to_csv(config.LEAKAGE_PATH, index=False)
+    dedup_report["cross_split_duplicates"] = len(leaks)
+    with open(config.DEDUP_REPORT_PATH, "w") as f:
+        json.dump(dedup_report, f, indent=2)
+
     # move the image from 'chest_xrays/' and 'tuberclusosis/'to train, validtion, and test paths.
     move_images(train_df, val_df, test_df)
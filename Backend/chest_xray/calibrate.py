@@ -0,0 +1,222 @@
+# import the necessary packages
+import numpy as np
+import pandas as pd
+import os
+import json
+import time
+import argparse
+from helper import config
+
+EPSILON = 1e-7
+
+
+def to_logits(scores):
+    scores = np.clip(scores, EPSILON, 1 - EPSILON)
+    return np.log(scores / (1 - scores))
+
+
+def apply_temperature(scores, temperature):
+    return 1 / (1 + np.exp(-to_logits(scores) / temperature))
+
+
+def fit_temperature(scores, labels, iterations=50):
+    """[fit one temperature per class by minimizing the binary crossentropy
+
+        newton's method on the inverse temperature, for all classes at once.
+        ]
+
+    Arguments:
+        scores {[np.array]} -- [predicted probabilities, (n, classes)]
+        labels {[np.array]} -- [binary ground truth labels, (n, classes)]
+
+    Returns:
+        [np.array] -- [temperature per class]
+    """
+    logits = to_logits(scores)
+    inverse_temperature = np.ones(scores.shape[1])
+    for _ in range(iterations):
+        p = 1 / (1 + np.exp(-inverse_temperature * logits))
+        gradient = np.mean((p - labels) * logits, axis=0)
+        hessian = np.mean(p * (1 - p) * logits ** 2, axis=0) + EPSILON
+        step = gradient / hessian
+        inverse_temperature = np.clip(inverse_temperature - step, 0.05, 20.)
+        if np.max(np.abs(step)) < 1e-6:
+            break
+    return 1 / inverse_temperature
+
+
+def sweep_thresholds(scores, labels, metric="f1"):
+    """[find the best decision threshold of every class at once
+
+        the scores of each class are sorted once, the cumulative sum of the
+        labels gives the true positives at every possible cut, so all
+        thresholds of all classes are evaluated without a python loop.
+        ]
+
+    Arguments:
+        scores {[np.array]} -- [predicted probabilities, (n, classes)]
+        labels {[np.array]} -- [binary ground truth labels, (n, classes)]
+
+    Keyword Arguments:
+        metric {str} -- [f1 or youden] (default: {"f1"})
+
+    Returns:
+        [tuple] -- [threshold and metric value per class, a score >= threshold is positive]
+    """
+    (n, num_classes) = scores.shape
+    order = np.argsort(-scores, axis=0, kind="stable")
+    sorted_scores = np.take_along_axis(scores, order, axis=0)
+    sorted_labels = np.take_along_axis(labels, order, axis=0).astype(np.int64)
+
+    tp = np.cumsum(sorted_labels, axis=0)
+    predicted_positives = np.arange(1, n + 1)[:, None]
+    fp = predicted_positives - tp
+    positives = tp[-1]
+    negatives = n - positives
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if metric == "f1":
+            values = 2 * tp / (predicted_positives + positives)
+        elif metric == "youden":
+            values = tp / positives - fp / negatives
+        else:
+            raise ValueError(f"unknown metric {metric}")
+
+    # only cut after the last of a group of tied scores
+    last_of_ties = np.ones((n, num_classes), dtype=bool)
+    last_of_ties[:-1] = sorted_scores[:-1] != sorted_scores[1:]
+    values = np.where(last_of_ties & ~np.isnan(values), values, -np.inf)
+
+    best = np.argmax(values, axis=0)
+    classes = np.arange(num_classes)
+    return (sorted_scores[best, classes], values[best, classes])
+
+
+def fit_confidence_cutoffs(scores, labels, thresholds, target_precisions=(0.7, 0.9)):
+    """[confidence cutoffs of the medium and high levels reported by the backend
+
+        the backend predicts the class with the largest margin over its threshold
+        and reports its calibrated score as the confidence, "Medium" above the
+        first cutoff and "High" above the second. each cutoff is the lowest one at
+        which the predictions above it are correct with the target precision.
+        ]
+
+    Arguments:
+        scores {[np.array]} -- [calibrated probabilities, (n, classes)]
+        labels {[np.array]} -- [binary ground truth labels, (n, classes)]
+        thresholds {[np.array]} -- [decision threshold per class]
+
+    Keyword Arguments:
+        target_precisions {tuple} -- [precision of the medium and high levels] (default: {(0.7, 0.9)})
+
+    Returns:
+        [list] -- [cutoff per level, 1.0 when the target precision is never reached]
+    """
+    n = len(scores)
+    predicted = np.argmax(scores - thresholds, axis=1)
+    confidence = scores[np.arange(n), predicted]
+    correct = labels[np.arange(n), predicted].astype(np.int64)
+
+    order = np.argsort(-confidence, kind="stable")
+    (sorted_confidence, sorted_correct) = (confidence[order], correct[order])
+    # precision of the top j + 1 predictions, only cut after the last of tied scores
+    precision = np.cumsum(sorted_correct) / np.arange(1, n + 1)
+    last_of_ties = np.append(sorted_confidence[:-1] != sorted_confidence[1:], True)
+    # "confidence > cutoff" keeps the top j + 1 predictions, the next score is the cutoff
+    next_confidence = np.append(sorted_confidence[1:], 0.)
+
+    cutoffs = []
+    for target in target_precisions:
+        reached = np.flatnonzero(last_of_ties & (precision >= target))
+        cutoffs.append(float(next_confidence[reached[-1]]) if len(reached) else 1.)
+    return cutoffs
+
+
+def calibrate(scores, labels, class_names, metric="f1", target_precisions=(0.7, 0.9)):
+    """[fit the temperatures, then sweep the thresholds and the confidence cutoffs
+        on the calibrated scores]
+
+    Returns:
+        [dict] -- [calibration file content]
+    """
+    temperature = fit_temperature(scores, labels)
+    calibrated = apply_temperature(scores, temperature)
+    (thresholds, values) = sweep_thresholds(calibrated, labels, metric)
+    cutoffs = fit_confidence_cutoffs(calibrated, labels, thresholds, target_precisions)
+    return {
+        "class_names": list(class_names),
+        "temperature": temperature.tolist(),
+        "thresholds": thresholds.tolist(),
+        "metric": metric,
+        "metric_values": values.tolist(),
+        "confidence_cutoffs": cutoffs,
+        "confidence_precisions": list(target_precisions),
+        "count": int(len(scores))
+    }
+
+
+def predict_validation(model_path):
+    """[predict the validation split and keep the predictions for later runs]
+    """
+    from tensorflow.keras.models import load_model
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    print("[INFO] predicting the validation split...")
+    model = load_model(model_path, compile=False)
+    val_df = pd.read_csv(config.VAL_METADATA_PATH)
+    val_datagen = ImageDataGenerator(rescale=1./255).flow_from_dataframe(val_df,
+                                                                         directory=None,
+                                                                         x_col="Image Path",
+                                                                         y_col=config.CLASS_NAMES,
+                                                                         target_size=(224, 224),
+                                                                         class_mode="raw",
+                                                                         batch_size=config.BATCH_SIZE,
+                                                                         shuffle=False)
+    (scores, labels) = ([], [])
+    for idx in range(len(val_datagen)):
+        (images, y) = val_datagen[idx]
+        scores.append(model.predict_on_batch(images))
+        labels.append(y)
+    (scores, labels) = (np.concatenate(scores), np.concatenate(labels))
+    np.savez(config.VAL_PREDICTIONS_PATH, scores=scores, labels=labels)
+    return (scores, labels)
+
+
+if __name__ == "__main__":
+    # define argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description="per class threshold optimization and temperature scaling")
+    ap.add_argument("-p", "--predictions", default=config.VAL_PREDICTIONS_PATH,
+                    help="npz file with validation 'scores' and 'labels', created from the model if missing")
+    ap.add_argument("-m", "--model", default=config.MODEL_PATH, help="model used to predict the validation split")
+    ap.add_argument("--metric", default="f1", choices=["f1", "youden"], help="metric maximized by the thresholds")
+    ap.add_argument("--precisions", nargs=2, type=float, default=[0.7, 0.9],
+                    help="precision of the medium and high confidence levels")
+    ap.add_argument("-o", "--output", default=config.CALIBRATION_PATH, help="path to the calibration file")
+    ap.add_argument("--benchmark", type=int, default=0,
+                    help="time the tool on this many synthetic predictions instead")
+    args = vars(ap.parse_args())
+
+    if args["benchmark"]:
+        rng = np.random.default_rng(config.SEED)
+        labels = (rng.random((args["benchmark"], len(config.CLASS_NAMES))) < 0.2).astype(np.int64)
+        scores = np.clip(rng.normal(0.3 + 0.4 * labels, 0.2), 0, 1)
+        start = time.perf_counter()
+        calibration = calibrate(scores, labels, config.CLASS_NAMES, args["metric"], args["precisions"])
+        print(f"[INFO] calibrated {args['benchmark']} predictions in {time.perf_counter() - start:.3f}s")
+    else:
+        if os.path.exists(args["predictions"]):
+            data = np.load(args["predictions"])
+            (scores, labels) = (data["scores"], data["labels"])
+        else:
+            (scores, labels) = predict_validation(args["model"])
+
+        calibration = calibrate(scores, labels, config.CLASS_NAMES, args["metric"], args["precisions"])
+        with open(args["output"], "w") as f:
+            json.dump(calibration, f, indent=2)
+        print(f"[INFO] calibration written to {args['output']}")
+
+    for (idx, class_name) in enumerate(calibration["class_names"]):
+        print(f"{class_name:<14} temperature: {calibration['temperature'][idx]:.3f} "
+              f"threshold: {calibration['thresholds'][idx]:.3f} {args['metric']}: {calibration['metric_values'][idx]:.4f}")
+    print(f"confidence cutoffs: medium > {calibration['confidence_cutoffs'][0]:.3f}, "
+          f"high > {calibration['confidence_cutoffs'][1]:.3f}")
@@ -0,0 +1,126 @@
+# import the necessary packages
+import numpy as np
+import os
+import json
+import argparse
+from tensorflow.keras.models import load_model
+from test import Test
+from distill import measure_latency
+from calibrate import apply_temperature
+from helper import config
+
+
+def load_calibration(path):
+    """[the temperatures and thresholds of the calibration file the backend serves with,
+        None when there is none or it was fitted for other classes]
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        calibration = json.load(f)
+    if calibration.get("class_names") != config.CLASS_NAMES:
+        print(f"[INFO] calibration {path} ignored: fitted for classes {calibration.get('class_names')}")
+        return None
+    return {
+        "temperature": np.array(calibration["temperature"]),
+        "thresholds": np.array(calibration["thresholds"])
+    }
+
+
+def decide(preds, calibration=None):
+    """[the class /predict reports for every image: the largest margin of the calibrated
+        probabilities over the class thresholds, the most probable class without a calibration]
+    """
+    if calibration is None:
+        return np.argmax(preds, axis=1)
+    return np.argmax(apply_temperature(preds, calibration["temperature"]) - calibration["thresholds"], axis=1)
+
+
+def simulate(fast_preds, full_preds, y, band, fast_latency, full_latency, calibration=None):
+    """[replay the cascade decision for every test image with the given uncertainty band,
+        then decide the reported class the way the backend does]
+
+    Arguments:
+        fast_preds {[np.array]} -- [fast model probabilities, (n, classes)]
+        full_preds {[np.array]} -- [full model probabilities, (n, classes)]
+        y {[np.array]} -- [ground truth labels, (n, classes)]
+        band {[tuple]} -- [(low, high) uncertainty band]
+        fast_latency {[float]} -- [fast model latency in ms]
+        full_latency {[float]} -- [full model latency in ms]
+
+    Keyword Arguments:
+        calibration {[dict]} -- [temperatures and thresholds from load_calibration] (default: {None})
+
+    Returns:
+        [dict] -- [escalation rate, average cost and accuracy loss]
+    """
+    # the backend escalates on the raw fast model probabilities and calibrates the
+    # probabilities of whichever model answered
+    (low, high) = band
+    escalated = np.any((fast_preds >= low) & (fast_preds <= high), axis=1)
+    cascade_preds = np.where(escalated[:, None], full_preds, fast_preds)
+
+    # a reported class is correct when the image has that label
+    rows = np.arange(len(y))
+    full_decisions = decide(full_preds, calibration)
+    cascade_decisions = decide(cascade_preds, calibration)
+    full_accuracy = np.mean(y[rows, full_decisions])
+    cascade_accuracy = np.mean(y[rows, cascade_decisions])
+    agreement = np.mean(cascade_decisions == full_decisions)
+    escalation_rate = float(np.mean(escalated))
+    average_cost = fast_latency + escalation_rate * full_latency
+
+    return {
+        "band": [low, high],
+        "escalation_rate": escalation_rate,
+        "average_cost_ms": average_cost,
+        "relative_cost": average_cost / full_latency,
+        "full_accuracy": float(full_accuracy),
+        "cascade_accuracy": float(cascade_accuracy),
+        "accuracy_loss": float(full_accuracy - cascade_accuracy),
+        "agreement_with_full": float(agreement)
+    }
+
+
+if __name__ == "__main__":
+    # define argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description="replay test.csv through the cascade for several uncertainty bands")
+    ap.add_argument("--fast", default=config.STUDENT_MODEL_PATH, help="path to the fast model")
+    ap.add_argument("--full", default=config.MODEL_PATH, help="path to the full model")
+    ap.add_argument("--bands", nargs="+", default=["0.3,0.7", "0.2,0.8", "0.1,0.9", "0.05,0.95"],
+                    help="uncertainty bands as low,high")
+    ap.add_argument("--calibration", default=config.CALIBRATION_PATH,
+                    help="calibration file of the backend, see calibrate.py")
+    ap.add_argument("--output", default=os.path.sep.join([config.OUTPUT_PATH, "cascade_simulation.json"]),
+                    help="path to the json result file")
+    args = vars(ap.parse_args())
+
+    # score the whole test split once with both models
+    test = Test()
+    preds = {}
+    latency = {}
+    for (name, path) in [("fast", args["fast"]), ("full", args["full"])]:
+        print(f"[INFO] predicting test split with the {name} model...")
+        model = load_model(path, compile=False)
+        test_datagen = test.data_generator()
+        preds[name] = model.predict(test_datagen, verbose=1)
+        latency[name] = measure_latency(model)
+    y = np.array(test_datagen.labels)[:len(preds["full"])]
+
+    # every band is just a different mask over the same predictions
+    calibration = load_calibration(args["calibration"])
+    results = []
+    for band in args["bands"]:
+        (low, high) = map(float, band.split(","))
+        results.append(simulate(preds["fast"], preds["full"], y, (low, high), latency["fast"], latency["full"], calibration))
+
+    print(f"[INFO] latency fast: {latency['fast']:.1f} ms, full: {latency['full']:.1f} ms")
+    print(f"{'band':>12} {'escalation':>11} {'cost ms':>8} {'rel cost':>9} {'acc loss':>9}")
+    for result in results:
+        band = "{:.2f}-{:.2f}".format(*result["band"])
+        print(f"{band:>12} {result['escalation_rate']:>11.3f} {result['average_cost_ms']:>8.1f} "
+              f"{result['relative_cost']:>9.3f} {result['accuracy_loss']:>9.4f}")
+
+    with open(args["output"], "w") as f:
+        json.dump({"latency_ms": latency, "calibrated": calibration is not None, "results": results}, f, indent=2)
+    print(f"[INFO] results written to {args['output']}")
@@ -0,0 +1,169 @@
+# import the necessary packages
+import numpy as np
+import os
+import json
+import time
+import argparse
+import tensorflow as tf
+from tensorflow.keras.layers import Dense, Input
+from tensorflow.keras.layers.experimental.preprocessing import Resizing, Rescaling
+from tensorflow.keras.models import Model, load_model
+from tensorflow.keras.applications import MobileNetV3Small
+from train import Train
+from test import Test
+from helper import config, distribute
+
+
+class Distill(Train):
+    def __init__(self, teacher, strategy=None):
+        """[train a small student model on the soft targets of the trained teacher model]
+
+        Arguments:
+            teacher {[Model]} -- [trained LuNet model]
+
+        Keyword Arguments:
+            strategy {[tf.distribute.Strategy]} -- [distribution strategy] (default: {None})
+        """
+        super(Distill, self).__init__(strategy)
+        self.teacher = teacher
+        self.model_path = config.STUDENT_MODEL_PATH
+        self.checkpoint_dir = config.STUDENT_CHECKPOINT_DIR
+
+    def build_model(self, show_summary=False, weights="imagenet", input_size=None):
+        """[MobileNetV3 student at reduced resolution, with the same input and output as the teacher]
+
+        Keyword Arguments:
+            show_summary {bool} -- [show model summary] (default: {False})
+            weights {[str]} -- [initial weights of the mobilenet] (default: {"imagenet"})
+            input_size {[int]} -- [fixed input size, variable when training progressively] (default: {None})
+        """
+        if input_size is None and not self.progressive_schedule:
+            input_size = self.image_size
+        size = config.STUDENT_IMAGE_SIZE
+        with self.strategy.scope():
+            img_input = Input(shape=(input_size, input_size, 3))
+            x = Resizing(size, size)(img_input)
+            # the serving inputs are scaled to [0, 1], mobilenetv3 rescales [0, 255] itself
+            x = Rescaling(255.)(x)
+            base_model = MobileNetV3Small(include_top=False,
+                                          weights=weights,
+                                          input_shape=(size, size, 3),
+                                          pooling="avg")
+            # the sigmoid outputs stay float32 under a mixed precision policy
+            output = Dense(len(config.CLASS_NAMES),
+                           activation="sigmoid", name="output", dtype="float32")(base_model(x))
+
+            model = Model(inputs=img_input, outputs=output)
+        if show_summary:
+            print(model.summary())
+
+        return model
+
+    def prepare_dataset(self, dataset):
+        """[replace the labels with a mix of the ground truth and the softened teacher predictions
+
+            binary crossentropy is linear in its target, so training on
+            alpha * y + (1 - alpha) * teacher equals the weighted sum of the hard
+            and the distillation loss, and the regular training loop can be reused.
+            ]
+        """
+        alpha = config.DISTILL_ALPHA
+        temperature = config.DISTILL_TEMPERATURE
+        epsilon = tf.keras.backend.epsilon()
+
+        teacher_size = self.teacher.input_shape[1:3]
+
+        def soft_targets(images, labels):
+            # the teacher takes its own fixed input size, the stages of a progressive
+            # schedule train the student on smaller images
+            teacher_images = images if images.shape[1:3] == teacher_size else tf.image.resize(images, teacher_size)
+            teacher_pred = tf.clip_by_value(self.teacher(teacher_images, training=False), epsilon, 1 - epsilon)
+            teacher_logits = tf.math.log(teacher_pred / (1 - teacher_pred))
+            teacher_soft = tf.sigmoid(teacher_logits / temperature)
+            return (images, alpha * labels + (1 - alpha) * teacher_soft)
+
+        return dataset.map(soft_targets)
+
+
+def measure_latency(model, runs=50, batch_size=1):
+    """[median single batch latency in milliseconds, as seen by the serving path]
+    """
+    x = np.random.rand(batch_size, 224, 224, 3).astype("float32")
+    model.predict(x)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model.predict(x)
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+
+def report(teacher_path, student_path):
+    """[compare per-class auroc, latency and model size of the teacher and the student]
+    """
+    test = Test()
+    results = {}
+    for (name, path) in [("teacher", teacher_path), ("student", student_path)]:
+        print(f"[INFO] evaluating the {name} model...")
+        model = load_model(path, compile=False)
+        test_datagen = test.data_generator()
+        preds = model.predict(test_datagen, verbose=1)
+        y = np.array(test_datagen.labels)
+        test_log_path = os.path.join(config.OUTPUT_PATH, f"test_{name}.log")
+        (aurocs, mean_auroc) = test.calculate_auroc(preds, y, test_log_path=test_log_path)
+
+        results[name] = {
+            "model_path": path,
+            "aurocs": dict(zip(config.CLASS_NAMES, map(float, aurocs))),
+            "mean_auroc": float(mean_auroc),
+            "latency_ms": measure_latency(model),
+            "params": int(model.count_params()),
+            "size_mb": os.path.getsize(path) / 2 ** 20
+        }
+
+    with open(config.DISTILLATION_REPORT_PATH, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{'':<14}{'teacher':>10}{'student':>10}")
+    for class_name in config.CLASS_NAMES:
+        print(f"{class_name:<14}{results['teacher']['aurocs'].get(class_name, 0):>10.4f}"
+              f"{results['student']['aurocs'].get(class_name, 0):>10.4f}")
+    for (key, label) in [("mean_auroc", "mean auroc"), ("latency_ms", "latency ms"), ("size_mb", "size MB")]:
+        print(f"{label:<14}{results['teacher'][key]:>10.4f}{results['student'][key]:>10.4f}")
+    print(f"[INFO] report written to {config.DISTILLATION_REPORT_PATH}")
+
+    return results
+
+
+if __name__ == "__main__":
+    # define argument parser and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--report", action="store_true",
+                    help="compare the trained student with the teacher instead of training")
+    args = vars(ap.parse_args())
+
+    if args["report"]:
+        report(config.MODEL_PATH, config.STUDENT_MODEL_PATH)
+    else:
+        # pick the distribution strategy before tensorflow initializes its devices
+        strategy = distribute.get_strategy(cpu_replicas=config.CPU_REPLICAS)
+
+        # load the trained teacher model
+        print("[INFO] loading teacher model...")
+        teacher = load_model(config.MODEL_PATH, compile=False)
+        teacher.trainable = False
+
+        # create and initialize Distill object
+        distill = Distill(teacher, strategy)
+
+        # build the student model
+        model = distill.build_model(show_summary=True)
+
+        # train and val datagenrator
+        (train_datagen, val_datagen) = distill.data_generator()
+
+        # training callbacks
+        callbacks = distill.callbacks(train_datagen)
+
+        # train the student model on the teacher soft targets
+        distill.train(model, train_datagen, val_datagen, callbacks)
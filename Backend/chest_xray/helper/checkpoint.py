@@ -0,0 +1,182 @@
+# import the necessary packages
+import os
+import json
+import random
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback
+
+# attributes that hold the internal state of the stateful keras callbacks
+# (ModelCheckpoint, ReduceLROnPlateau, EarlyStopping)
+CALLBACK_STATE_ATTRS = ["best", "wait", "cooldown_counter", "stopped_epoch"]
+# EarlyStopping(restore_best_weights=True) keeps the weights of its best epoch in
+# memory, they are saved next to the checkpoint so a resumed run can still restore them
+BEST_WEIGHTS_SUFFIX = ".best_weights.npz"
+
+
+def rebase_callbacks(callbacks):
+    """[forget the best monitored value of the stateful callbacks, for a change of
+        resolution after which the validation metrics do not compare with the earlier ones]
+
+    Arguments:
+        callbacks {[List]} -- [keras callbacks, the ones without a monitored best are left alone]
+    """
+    for callback in callbacks:
+        if not hasattr(callback, "best") or not hasattr(callback, "monitor_op"):
+            continue
+        # the worst value for the mode of the callback, improved on by the next epoch
+        callback.best = np.inf if callback.monitor_op(0., 1.) else -np.inf
+        for attr in ["wait", "stopped_epoch"]:
+            if hasattr(callback, attr):
+                setattr(callback, attr, 0)
+        if hasattr(callback, "best_weights"):
+            callback.best_weights = None
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+
+
+class TrainingCheckpoint(Callback):
+    def __init__(self, checkpoint_dir, datagen=None, callbacks=None, every=1, max_to_keep=3, seed=None,
+                 image_size=None):
+        """[periodically save the full training state so an interrupted run can resume]
+
+        Arguments:
+            checkpoint_dir {[str]} -- [directory to store the rotated checkpoints]
+
+        Keyword Arguments:
+            datagen {[DataFrameIterator]} -- [train data generator, its position is saved] (default: {None})
+            callbacks {[List]} -- [stateful callbacks to save and restore] (default: {None})
+            every {int} -- [save a checkpoint every n epochs] (default: {1})
+            max_to_keep {int} -- [number of checkpoints to keep on disk] (default: {3})
+            seed {[int]} -- [base seed, re-applied at the start of every epoch] (default: {None})
+            image_size {[int]} -- [resolution trained at, the callback state of another one is not restored] (default: {None})
+        """
+        super(TrainingCheckpoint, self).__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.datagen = datagen
+        self.tracked_callbacks = callbacks or []
+        self.every = every
+        self.max_to_keep = max_to_keep
+        self.seed = seed
+        self.image_size = image_size
+        # batches trained on, the data generator's own count runs ahead of it by the
+        # batches tf.data has already prefetched
+        self.batches_seen = 0
+        self.manager = None
+
+    def _build_manager(self, model):
+        if self.manager is None:
+            checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+            self.manager = tf.train.CheckpointManager(checkpoint,
+                                                      self.checkpoint_dir,
+                                                      max_to_keep=self.max_to_keep)
+        return self.manager
+
+    def _state(self, epoch):
+        state = {
+            "epoch": epoch,
+            "seed": self.seed,
+            "image_size": self.image_size,
+            "callbacks": {}
+        }
+        if self.datagen is not None:
+            state["total_batches_seen"] = int(self.batches_seen)
+        for callback in self.tracked_callbacks:
+            state["callbacks"][type(callback).__name__] = {
+                attr: float(getattr(callback, attr)) for attr in CALLBACK_STATE_ATTRS if hasattr(callback, attr)}
+        return state
+
+    def restore(self, model):
+        """[restore model, optimizer and data position from the latest checkpoint]
+
+        Arguments:
+            model {[Model]} -- [compiled keras model]
+
+        Returns:
+            [int] -- [epoch to resume training from, 0 if there is no checkpoint]
+        """
+        manager = self._build_manager(model)
+        if manager.latest_checkpoint is None:
+            return 0
+
+        print(f"[INFO] resume training from {manager.latest_checkpoint}")
+        manager.checkpoint.restore(manager.latest_checkpoint)
+        state = self._load_state()
+        if "total_batches_seen" in state:
+            self.batches_seen = state["total_batches_seen"]
+            if self.datagen is not None:
+                self.datagen.total_batches_seen = self.batches_seen
+        self.seed = state.get("seed", self.seed)
+
+        return state["epoch"]
+
+    def _load_state(self):
+        with open(self.manager.latest_checkpoint + ".json") as f:
+            return json.load(f)
+
+    def _save_best_weights(self, path):
+        for callback in self.tracked_callbacks:
+            best_weights = getattr(callback, "best_weights", None)
+            if best_weights is not None:
+                np.savez(path + BEST_WEIGHTS_SUFFIX, *best_weights)
+                return
+
+    def _load_best_weights(self):
+        path = self.manager.latest_checkpoint + BEST_WEIGHTS_SUFFIX
+        if not os.path.exists(path):
+            return
+        with np.load(path) as saved:
+            best_weights = [saved[f"arr_{i}"] for i in range(len(saved.files))]
+        for callback in self.tracked_callbacks:
+            if hasattr(callback, "best_weights"):
+                callback.best_weights = best_weights
+
+    def on_train_begin(self, logs=None):
+        self._build_manager(self.model)
+        if self.manager.latest_checkpoint is None:
+            return
+
+        # keras callbacks reset their state in on_train_begin, so this callback
+        # has to come last in the list to reload the saved state on top.
+        # a checkpoint of a lower resolution stage of progressive resizing monitored
+        # values that do not compare with this resolution's, its state is dropped
+        state = self._load_state()
+        if state.get("image_size", self.image_size) != self.image_size:
+            rebase_callbacks(self.tracked_callbacks)
+            return
+        for callback in self.tracked_callbacks:
+            for (attr, value) in state["callbacks"].get(type(callback).__name__, {}).items():
+                setattr(callback, attr, type(getattr(callback, attr))(value))
+        self._load_best_weights()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        # reseed per epoch so a resumed run draws the same random numbers
+        if self.seed is not None:
+            seed_everything(self.seed + epoch)
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.batches_seen += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.every != 0:
+            return
+
+        path = self.manager.save(checkpoint_number=epoch + 1)
+        with open(path + ".json", "w") as f:
+            json.dump(self._state(epoch + 1), f)
+        self._save_best_weights(path)
+
+        # rotate the state files together with the checkpoints
+        kept = set(self.manager.checkpoints)
+        for filename in os.listdir(self.checkpoint_dir):
+            for suffix in [".json", BEST_WEIGHTS_SUFFIX]:
+                if filename.endswith(suffix):
+                    prefix = os.path.join(self.checkpoint_dir, filename[:-len(suffix)])
+                    if prefix not in kept:
+                        os.remove(os.path.join(self.checkpoint_dir, filename))
+                    break
+        print(f"[INFO] saved training checkpoint {path}")
@@ -28,10 +28,10 @@ TB_SHENZHEN_IMAGES_BASE_PATH = os.path.sep.join([TB_SHENZHEN_PATH, "images"])
 
 # TB_montgomery dataset configuration
 TB_MONTGOMERY_PATH = os.path.sep.join(
-    [BASE_PATH, "tuberculosis-chest-xrays-shenzhen"])
+    [BASE_PATH, "tuberculosis-chest-xrays-montgomery"])
 TB_MONTGOMERY_METADATA_PATH = os.path.sep.join(
     [TB_MONTGOMERY_PATH, "montgomery_metadata.csv"])
-TB_MONTGOMERY_IMAGES_BASE_PATH = os.path.sep.join([TB_SHENZHEN_PATH, "images"])
+TB_MONTGOMERY_IMAGES_BASE_PATH = os.path.sep.join([TB_MONTGOMERY_PATH, "images"])
 
 # ==============================================================
 # chest_xrays5
@@ -40,6 +40,14 @@ CLASS_NAMES = ['Atelectasis', 'Effusion',
 COLUMNS = ['Image Path', 'Atelectasis', 'Effusion',
            'Pneumonia', 'Pneumothorax', 'Tuberculosis']
 
+# ==============================================================
+# near duplicate detection, images whose 64 bit perceptual hashes differ in at most
+# DEDUP_MAX_DISTANCE bits are the same image and are kept only once, before the split
+DEDUP_MAX_DISTANCE = 6
+DEDUP_HASHES_PATH = os.path.sep.join([BASE_PATH, "image_hashes.csv"])
+DEDUP_REPORT_PATH = os.path.sep.join([BASE_PATH, "dedup_report.json"])
+LEAKAGE_PATH = os.path.sep.join([BASE_PATH, "leakage.csv"])
+
 # ==============================================================
 # training, validation, and testing images paths
 TRAIN_PATH = os.path.sep.join([BASE_PATH, "training"])
@@ -59,9 +67,23 @@ TEST_SPLIT = 0.05
 # ==============================================================
 # basic training parametries
 EPOCHS = 100
-BATCH_SIZE = 32
+BATCH_SIZE = 32  # per replica, the global batch is BATCH_SIZE * number of replicas
 INTIAL_LR = 1e-3
 MIN_LR = 1e-8
+SEED = 42
+
+# ==============================================================
+# progressive resizing and mixed precision (train.py --progressive --precision)
+# (image size, last epoch) stages, the last stage runs at 224x224 up to EPOCHS
+PROGRESSIVE_SCHEDULE = [(128, 10), (160, 20), (224, EPOCHS)]
+# float32 or mixed_bfloat16, which falls back to float32 on cpus without bfloat16
+PRECISION = "float32"
+
+# ==============================================================
+# distributed training configurations
+# number of logical cpu devices to mirror over on cpu only hosts (1 disables it),
+# multi worker training is configured through the TF_CONFIG environment variable
+CPU_REPLICAS = 1
 
 # ==============================================================
 # output configurations
@@ -70,3 +92,49 @@ MODEL_PATH = os.path.sep.join([OUTPUT_PATH, "models", "LuNet.h5"])
 # MODEL_ARCHITECTURE_PATH = os.path.sep.join([OUTPUT_PATH, "models", "LuNet_architecture.json"])
 # MODEL_WEIGHT_PATH = os.path.sep.join([OUTPUT_PATH, "models", "LuNet_weights.h5"])
 LOG_DIR = os.path.sep.join([OUTPUT_PATH, "logs"])
+# machine readable evaluation results, written next to test.log
+TEST_RESULTS_PATH = os.path.sep.join([OUTPUT_PATH, "test.json"])
+BOOTSTRAP_RESAMPLES = 1000
+
+# per class decision thresholds and temperatures, loaded by the serving path
+VAL_PREDICTIONS_PATH = os.path.sep.join([OUTPUT_PATH, "val_predictions.npz"])
+CALIBRATION_PATH = os.path.sep.join([OUTPUT_PATH, "calibration.json"])
+
+# full training state checkpoints (model, optimizer, epoch, callbacks, seed)
+CHECKPOINT_DIR = os.path.sep.join([OUTPUT_PATH, "checkpoints"])
+CHECKPOINT_EVERY = 1
+CHECKPOINT_MAX_TO_KEEP = 3
+
+# ==============================================================
+# knowledge distillation configurations
+# the student keeps the 224x224x3 input of the teacher and resizes internally,
+# so it can be served with the same preprocessing
+STUDENT_MODEL_PATH = os.path.sep.join([OUTPUT_PATH, "models", "LuNet_student.h5"])
+STUDENT_CHECKPOINT_DIR = os.path.sep.join([OUTPUT_PATH, "student_checkpoints"])
+STUDENT_IMAGE_SIZE = 160
+DISTILL_ALPHA = 0.5  # weight of the ground truth labels, the rest goes to the teacher
+DISTILL_TEMPERATURE = 2.0
+DISTILLATION_REPORT_PATH = os.path.sep.join([OUTPUT_PATH, "distillation_report.json"])
+
+# ==============================================================
+# hyperparameter search configurations (search.py)
+# trials run as local processes pinned to SEARCH_CORES_PER_TRIAL cores each, and
+# asynchronous successive halving (ASHA) resumes only the best 1 / SEARCH_REDUCTION_FACTOR
+# of every rung, by validation auroc, for SEARCH_REDUCTION_FACTOR times more epochs
+SEARCH_DIR = os.path.sep.join([OUTPUT_PATH, "search"])
+SEARCH_RESULTS_PATH = os.path.sep.join([SEARCH_DIR, "trials.jsonl"])
+SEARCH_TRIALS = 27
+SEARCH_CORES_PER_TRIAL = 4
+SEARCH_MIN_EPOCHS = 1
+SEARCH_MAX_EPOCHS = 27
+SEARCH_REDUCTION_FACTOR = 3
+# ("log", low, high) ranges are sampled log-uniformly, lists are choices
+SEARCH_SPACE = {
+    "initial_lr": ("log", 1e-5, 1e-2),
+    "min_lr": ("log", 1e-8, 1e-5),
+    "batch_size": [16, 32, 64]
+}
+
+# time to target auroc of the training schedules (benchmark_progressive.py)
+TARGET_AUROC = 0.75
+PROGRESSIVE_REPORT_PATH = os.path.sep.join([OUTPUT_PATH, "progressive_report.json"])
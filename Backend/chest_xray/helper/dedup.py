@@ -0,0 +1,286 @@
+# import the necessary packages
+import os
+import numpy as np
+import pandas as pd
+from PIL import Image
+from scipy.fft import dctn
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from concurrent.futures import ProcessPoolExecutor
+
+# number of set bits of every byte value, the hamming distance of two 64 bit hashes
+# is the sum over the 8 bytes of their xor
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# the 64 bit hashes are indexed as 4 substrings of 16 bits (multi-index hashing)
+MIH_CHUNKS = 4
+MIH_CHUNK_BITS = 64 // MIH_CHUNKS
+
+# upper bound of the candidate pairs expanded at once
+MAX_CANDIDATES = 4 * 1024 * 1024
+
+
+def phash(image_path, hash_size=8, image_size=32):
+    """[perceptual hash of an image: sign of the low frequency dct coefficients
+    of a downscaled grayscale copy against their median]
+
+    Arguments:
+        image_path {[str]} -- [path of the image]
+
+    Keyword Arguments:
+        hash_size {int} -- [side of the kept low frequency block, 8 gives 64 bits] (default: {8})
+        image_size {int} -- [side of the downscaled image] (default: {32})
+
+    Returns:
+        [int] -- [the hash as a 64 bit unsigned integer]
+    """
+    with Image.open(image_path) as image:
+        # jpeg images are decoded at a reduced scale, the others are decoded in full
+        image.draft("L", (image_size * 4, image_size * 4))
+        image = image.convert("L").resize((image_size, image_size), Image.BOX)
+    pixels = np.asarray(image, dtype=np.float32)
+    low = dctn(pixels, norm="ortho")[:hash_size, :hash_size]
+    bits = (low > np.median(low)).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def _hash_worker(image_paths):
+    hashes = []
+    for image_path in image_paths:
+        try:
+            hashes.append(phash(image_path))
+        except Exception:
+            hashes.append(None)
+    return hashes
+
+
+def compute_hashes(image_paths, workers=None, chunk_size=256, cache_path=None):
+    """[perceptual hashes of the images, computed across all cores]
+
+    Arguments:
+        image_paths {[List]} -- [paths of the images]
+
+    Keyword Arguments:
+        workers {[int]} -- [number of processes, all cores if None] (default: {None})
+        chunk_size {int} -- [images hashed per task] (default: {256})
+        cache_path {[str]} -- [csv of the hashes of a previous build, images whose size
+                               and modification time did not change are not hashed again] (default: {None})
+
+    Returns:
+        [tuple] -- [hashes (uint64) and mask of the images that could be read]
+    """
+    workers = workers or os.cpu_count() or 1
+    image_paths = [str(image_path) if isinstance(image_path, str) else None for image_path in image_paths]
+    hashes = np.zeros(len(image_paths), dtype=np.uint64)
+    valid = np.zeros(len(image_paths), dtype=bool)
+
+    # stat the images once, the cache is keyed by path, size and modification time
+    stats = {}
+    for image_path in set(filter(None, image_paths)):
+        try:
+            stat = os.stat(image_path)
+            stats[image_path] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+
+    cached = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        cache_df = pd.read_csv(cache_path, dtype={"hash": str})
+        for (image_path, size, mtime_ns, image_hash) in cache_df.itertuples(index=False):
+            if stats.get(image_path) == (size, mtime_ns):
+                cached[image_path] = int(image_hash, 16)
+
+    missing = sorted(image_path for image_path in stats if image_path not in cached)
+    if missing:
+        chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            for (chunk, chunk_hashes) in zip(chunks, executor.map(_hash_worker, chunks)):
+                cached.update((image_path, image_hash) for (image_path, image_hash)
+                              in zip(chunk, chunk_hashes) if image_hash is not None)
+
+    for (i, image_path) in enumerate(image_paths):
+        if image_path in cached:
+            hashes[i] = cached[image_path]
+            valid[i] = True
+
+    if cache_path is not None:
+        rows = [(image_path, stats[image_path][0], stats[image_path][1], "{:016x}".format(image_hash))
+                for (image_path, image_hash) in cached.items()]
+        pd.DataFrame(rows, columns=["path", "size", "mtime_ns", "hash"]).to_csv(cache_path, index=False)
+
+    return (hashes, valid)
+
+
+def hamming_distance(a, b):
+    """[bitwise hamming distances of two arrays of 64 bit hashes]
+    """
+    x = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64)
+    return POPCOUNT[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _flip_masks(bits, radius):
+    """[every mask of at most radius set bits in a chunk of the given width]
+    """
+    masks = np.arange(1 << bits, dtype=np.uint32)
+    counts = POPCOUNT[masks & 0xFF] + POPCOUNT[masks >> 8]
+    return masks[counts <= radius]
+
+
+def near_duplicate_pairs(hashes, max_distance):
+    """[all pairs of hashes within max_distance bits, through multi-index hashing:
+    split into MIH_CHUNKS substrings, two hashes within max_distance bits have at least
+    one substring within max_distance // MIH_CHUNKS bits, so only the hashes sharing
+    a substring up to that many flipped bits are compared]
+
+    Arguments:
+        hashes {[np.array]} -- [64 bit hashes, (n,)]
+        max_distance {int} -- [largest hamming distance of a pair]
+
+    Returns:
+        [np.array] -- [index pairs (i < j), (pairs, 2)]
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    masks = _flip_masks(MIH_CHUNK_BITS, max_distance // MIH_CHUNKS)
+    found = []
+
+    for chunk in range(MIH_CHUNKS):
+        keys = ((hashes >> np.uint64(chunk * MIH_CHUNK_BITS)) & np.uint64(0xFFFF)).astype(np.uint32)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+
+        for mask in masks:
+            probes = keys ^ mask
+            lo = np.searchsorted(sorted_keys, probes, side="left")
+            hi = np.searchsorted(sorted_keys, probes, side="right")
+            counts = hi - lo
+
+            # expand the candidates in batches of about MAX_CANDIDATES pairs
+            ends = np.cumsum(counts)
+            start = 0
+            while start < n:
+                offset = ends[start - 1] if start else 0
+                stop = max(int(np.searchsorted(ends, offset + MAX_CANDIDATES, side="right")), start + 1)
+                queries = np.arange(start, min(stop, n))
+                batch_counts = counts[queries]
+                total = int(batch_counts.sum())
+                start = stop
+                if not total:
+                    continue
+                first = np.repeat(queries, batch_counts)
+                positions = np.arange(total) - np.repeat(np.cumsum(batch_counts) - batch_counts, batch_counts)
+                second = order[np.repeat(lo[queries], batch_counts) + positions]
+
+                # every pair is seen from both of its hashes, keep it once
+                keep = first < second
+                (first, second) = (first[keep], second[keep])
+                keep = hamming_distance(hashes[first], hashes[second]) <= max_distance
+                found.append(first[keep].astype(np.int64) * n + second[keep])
+
+    if not found:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.unique(np.concatenate(found))
+    return np.stack([pairs // n, pairs % n], axis=1)
+
+
+def duplicate_groups(n, pairs):
+    """[connected components of the near duplicate pairs, a group id per hash]
+    """
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    (_, groups) = connected_components(graph, directed=False)
+    return groups
+
+
+def drop_near_duplicates(df, label_columns, max_distance, workers=None, cache_path=None):
+    """[keep one image of every group of near duplicates, the kept image gets the
+    union of the labels of its group]
+
+    Arguments:
+        df {[pd.DataFrame]} -- [dataset with an 'Image Path' column]
+        label_columns {[List]} -- [one hot encoded label columns]
+        max_distance {int} -- [largest hamming distance of two near duplicates]
+
+    Keyword Arguments:
+        workers {[int]} -- [number of hashing processes, all cores if None] (default: {None})
+        cache_path {[str]} -- [csv cache of the hashes] (default: {None})
+
+    Returns:
+        [tuple] -- [deduplicated dataframe with an 'Image Hash' column, and a report]
+    """
+    df = df.reset_index(drop=True)
+    (hashes, valid) = compute_hashes(df["Image Path"].tolist(), workers=workers, cache_path=cache_path)
+    df["Image Hash"] = ["{:016x}".format(image_hash) if ok else "" for (image_hash, ok) in zip(hashes, valid)]
+
+    # unreadable images are left as they are, every one in a group of its own
+    index = np.flatnonzero(valid)
+    pairs = index[near_duplicate_pairs(hashes[index], max_distance)]
+    groups = duplicate_groups(len(df), pairs)
+
+    labels = df[label_columns].to_numpy()
+    group_labels = np.zeros((groups.max() + 1, len(label_columns)), dtype=labels.dtype)
+    np.maximum.at(group_labels, groups, labels)
+    sizes = np.bincount(groups)
+    conflicts = int(((group_labels[groups] != labels).any(axis=1) & (sizes[groups] > 1)).sum())
+
+    keep = ~pd.Series(groups).duplicated().to_numpy()
+    deduplicated_df = df[keep].copy()
+    deduplicated_df[label_columns] = group_labels[groups[keep]]
+
+    report = {
+        "images": len(df),
+        "unreadable": int((~valid).sum()),
+        "near_duplicate_pairs": len(pairs),
+        "duplicate_groups": int((sizes > 1).sum()),
+        "removed": int(len(df) - keep.sum()),
+        "label_conflicts": conflicts,
+        "max_distance": max_distance
+    }
+    return (deduplicated_df, report)
+
+
+def cross_split_duplicates(splits, max_distance):
+    """[near duplicate pairs whose images are in two different splits]
+
+    Arguments:
+        splits {[List]} -- [(split name, dataframe with an 'Image Hash' column) tuples]
+        max_distance {int} -- [largest hamming distance of two near duplicates]
+
+    Returns:
+        [pd.DataFrame] -- [one row per leaked pair: the splits, the dataframe indices
+                           and the image paths of the two images]
+    """
+    frames = [df[df["Image Hash"] != ""].assign(Split=name) for (name, df) in splits]
+    df = pd.concat(frames)
+    hashes = np.array([int(image_hash, 16) for image_hash in df["Image Hash"]], dtype=np.uint64)
+    pairs = near_duplicate_pairs(hashes, max_distance)
+    names = df["Split"].to_numpy()
+    pairs = pairs[names[pairs[:, 0]] != names[pairs[:, 1]]]
+
+    (first, second) = (df.iloc[pairs[:, 0]], df.iloc[pairs[:, 1]])
+    return pd.DataFrame({
+        "Split A": first["Split"].to_numpy(), "Index A": first.index, "Image Path A": first["Image Path"].to_numpy(),
+        "Split B": second["Split"].to_numpy(), "Index B": second.index, "Image Path B": second["Image Path"].to_numpy()
+    })
+
+
+def remove_leakage(splits, max_distance):
+    """[drop the images of a split that have a near duplicate in an earlier split,
+    so the validation and test images never repeat a training image]
+
+    Arguments:
+        splits {[List]} -- [(split name, dataframe) tuples, from training to testing]
+        max_distance {int} -- [largest hamming distance of two near duplicates]
+
+    Returns:
+        [tuple] -- [the cleaned dataframes in the same order, and the leaked pairs]
+    """
+    leaks = cross_split_duplicates(splits, max_distance)
+    order = {name: i for (i, (name, _)) in enumerate(splits)}
+    later_a = leaks["Split A"].map(order) > leaks["Split B"].map(order)
+    dropped = {name: set() for name in order}
+    for (name, index) in zip(np.where(later_a, leaks["Split A"], leaks["Split B"]),
+                             np.where(later_a, leaks["Index A"], leaks["Index B"])):
+        dropped[name].add(index)
+
+    cleaned = [df.drop(index=list(dropped[name])) for (name, df) in splits]
+    return (cleaned, leaks)
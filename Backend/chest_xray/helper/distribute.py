@@ -0,0 +1,166 @@
+# import the necessary packages
+import os
+import json
+import tensorflow as tf
+
+
+def get_cluster_spec():
+    """[read the multi worker cluster from the TF_CONFIG environment variable]
+
+    Returns:
+        [tuple] -- [global index of this worker (the chief is 0) and number of workers]
+    """
+    tf_config = json.loads(os.getenv("TF_CONFIG", "{}"))
+    cluster = tf_config.get("cluster", {})
+    task = tf_config.get("task", {})
+    num_chiefs = len(cluster.get("chief", []))
+    num_workers = num_chiefs + len(cluster.get("worker", []))
+
+    worker_index = int(task.get("index", 0))
+    if task.get("type", "worker") == "worker":
+        worker_index += num_chiefs
+    return (worker_index, max(num_workers, 1))
+
+
+def is_chief():
+    """[only the chief writes the real checkpoints, models and logs]
+    """
+    (worker_index, _) = get_cluster_spec()
+    return worker_index == 0
+
+
+def worker_path(path):
+    """[non-chief workers still have to save, but into their own throwaway path]
+    """
+    if is_chief():
+        return path
+    (directory, filename) = os.path.split(path)
+    (worker_index, _) = get_cluster_spec()
+    return os.path.join(directory, f"worker-{worker_index}", filename)
+
+
+def get_strategy(cpu_replicas=1):
+    """[pick a tf.distribute strategy for the current host
+
+        several local processes (or nodes) described by TF_CONFIG -> MultiWorkerMirroredStrategy
+        more than one gpu -> MirroredStrategy over the gpus
+        cpu_replicas > 1 -> MirroredStrategy over logical cpu devices
+        otherwise -> the default (no-op) strategy
+        ]
+
+    Keyword Arguments:
+        cpu_replicas {int} -- [number of logical cpu devices to split the host into] (default: {1})
+
+    Returns:
+        [tf.distribute.Strategy] -- [distribution strategy]
+    """
+    (_, num_workers) = get_cluster_spec()
+    if num_workers > 1:
+        print(f"[INFO] MultiWorkerMirroredStrategy is used! workers={num_workers}")
+        return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+
+    gpus = tf.config.list_physical_devices("GPU")
+    if len(gpus) > 1:
+        print(f"[INFO] MirroredStrategy is used! gpus={gpus}")
+        return tf.distribute.MirroredStrategy()
+
+    if cpu_replicas > 1:
+        # must run before the tensorflow runtime is initialized
+        cpus = tf.config.list_physical_devices("CPU")
+        tf.config.set_logical_device_configuration(
+            cpus[0], [tf.config.LogicalDeviceConfiguration()] * cpu_replicas)
+        devices = [device.name for device in tf.config.list_logical_devices("CPU")]
+        print(f"[INFO] MirroredStrategy is used! cpus={devices}")
+        return tf.distribute.MirroredStrategy(devices=devices)
+
+    print("[INFO] there is no gpu in this device, default strategy is used")
+    return tf.distribute.get_strategy()
+
+
+def shard_dataframe(df):
+    """[give each worker its own disjoint part of the dataframe]
+    """
+    (worker_index, num_workers) = get_cluster_spec()
+    return df.iloc[worker_index::num_workers]
+
+
+def local_replicas(strategy):
+    """[number of replicas on this worker, the batch of a worker feeds only these]
+    """
+    (_, num_workers) = get_cluster_spec()
+    return max(strategy.num_replicas_in_sync // num_workers, 1)
+
+
+def to_dataset(datagen, num_classes, target_size=(224, 224)):
+    """[wrap a keras DataFrameIterator into a tf.data.Dataset for the strategy
+
+        the iterator yields the batches of this worker (the per replica batch size
+        times the local replicas). auto-sharding is turned off since the dataframe
+        is already sharded per worker with shard_dataframe.
+        ]
+
+    Arguments:
+        datagen {[DataFrameIterator]} -- [keras data generator]
+        num_classes {[int]} -- [number of output labels]
+
+    Returns:
+        [tf.data.Dataset] -- [dataset yielding (images, labels) batches]
+    """
+    dataset = tf.data.Dataset.from_generator(
+        lambda: datagen,
+        output_types=(tf.float32, tf.float32),
+        output_shapes=((None, target_size[0], target_size[1], 3), (None, num_classes)))
+
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return dataset.with_options(options)
+
+
+def with_class_weight(dataset, class_weight):
+    """[add per sample weights from the class weights, as fit(class_weight=...) would:
+        each sample weighs as its class, the argmax of its labels]
+
+    Arguments:
+        dataset {[tf.data.Dataset]} -- [dataset yielding (images, labels) batches]
+        class_weight {[dict]} -- [{class index: weight}, None leaves the dataset as it is]
+
+    Returns:
+        [tf.data.Dataset] -- [dataset yielding (images, labels, sample weights) batches]
+    """
+    if class_weight is None:
+        return dataset
+    weights = tf.constant([class_weight[i] for i in range(len(class_weight))], dtype=tf.float32)
+
+    def add_sample_weight(images, labels):
+        return (images, labels, tf.gather(weights, tf.argmax(labels, axis=-1)))
+
+    return dataset.map(add_sample_weight)
+
+
+def distribute_dataset(strategy, dataset, per_replica_batch_size, class_weight=None):
+    """[hand the per worker batches of a dataset to the replicas
+
+        on a single worker keras splits every batch between the local replicas.
+        with several workers keras would take each batch for a global one, so every
+        worker rebatches its own batches to the per replica size and the strategy
+        feeds them to the local replicas as they are. keras cannot apply class
+        weights to such a distributed dataset, so they are added as sample weights
+        inside the per worker dataset instead of being passed to fit.
+        ]
+
+    Arguments:
+        strategy {[tf.distribute.Strategy]} -- [distribution strategy]
+        dataset {[tf.data.Dataset]} -- [dataset yielding the batches of this worker]
+        per_replica_batch_size {[int]} -- [batch size of a single replica]
+
+    Keyword Arguments:
+        class_weight {[dict]} -- [{class index: weight} of the training data] (default: {None})
+
+    Returns:
+        [tf.data.Dataset or DistributedDataset] -- [dataset to fit the model on]
+    """
+    (_, num_workers) = get_cluster_spec()
+    if num_workers == 1:
+        return with_class_weight(dataset, class_weight)
+    return strategy.experimental_distribute_datasets_from_function(
+        lambda input_context: with_class_weight(dataset, class_weight).unbatch().batch(per_replica_batch_size))
@@ -0,0 +1,184 @@
+# import the necessary packages
+import os
+import json
+import warnings
+import numpy as np
+from scipy.stats import rankdata
+from concurrent.futures import ProcessPoolExecutor
+
+
+def roc_auc(scores, labels):
+    """[auroc of every class at once through the rank statistic (Mann-Whitney U)]
+
+    Arguments:
+        scores {[np.array]} -- [predicted probabilities, (n, classes)]
+        labels {[np.array]} -- [binary ground truth labels, (n, classes)]
+
+    Returns:
+        [np.array] -- [auroc per class, nan where a class has only one label value]
+    """
+    labels = labels.astype(bool)
+    ranks = rankdata(scores, axis=0)  # average ranks handle tied scores
+    positives = labels.sum(axis=0)
+    negatives = labels.shape[0] - positives
+    rank_sum = np.where(labels, ranks, 0).sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        auroc = (rank_sum - positives * (positives + 1) / 2) / (positives * negatives)
+    return np.where((positives > 0) & (negatives > 0), auroc, np.nan)
+
+
+def binary_counts(scores, labels, threshold=0.5):
+    """[tp, fp, fn, tn counts of every class at once, (4, classes)]
+    """
+    predicted = scores > threshold
+    labels = labels.astype(bool)
+    return np.stack([(predicted & labels).sum(axis=0),
+                     (predicted & ~labels).sum(axis=0),
+                     (~predicted & labels).sum(axis=0),
+                     (~predicted & ~labels).sum(axis=0)])
+
+
+def metrics_from_counts(counts):
+    (tp, fp, fn, tn) = counts.astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "accuracy": (tp + tn) / (tp + fp + fn + tn),
+            "sensitivity": tp / (tp + fn),
+            "specificity": tn / (tn + fp)
+        }
+
+
+class StreamingEvaluator():
+    def __init__(self, class_names, threshold=0.5):
+        """[accumulate predictions batch by batch instead of materializing them up front]
+
+        Arguments:
+            class_names {[List]} -- [names of the output labels]
+
+        Keyword Arguments:
+            threshold {float} -- [decision threshold of the sigmoid outputs] (default: {0.5})
+        """
+        self.class_names = class_names
+        self.threshold = threshold
+        num_classes = len(class_names)
+
+        # per class 2x2 (multilabel) and argmax (multiclass) confusion matrices
+        self.counts = np.zeros((4, num_classes), dtype=np.int64)
+        self.cm = np.zeros((num_classes, num_classes), dtype=np.int64)
+
+        # growable score/label buffers, sorted by rank once at finalize for the auroc
+        self.scores = np.empty((1024, num_classes), dtype=np.float32)
+        self.labels = np.empty((1024, num_classes), dtype=np.uint8)
+        self.n = 0
+
+    def update(self, scores, labels):
+        scores = np.asarray(scores, dtype=np.float32)
+        labels = np.asarray(labels, dtype=np.uint8)
+
+        self.counts += binary_counts(scores, labels, self.threshold)
+        np.add.at(self.cm, (labels.argmax(axis=1), scores.argmax(axis=1)), 1)
+
+        if self.n + len(scores) > len(self.scores):
+            capacity = max(2 * len(self.scores), self.n + len(scores))
+            self.scores = np.resize(self.scores, (capacity, self.scores.shape[1]))
+            self.labels = np.resize(self.labels, (capacity, self.labels.shape[1]))
+        self.scores[self.n:self.n + len(scores)] = scores
+        self.labels[self.n:self.n + len(labels)] = labels
+        self.n += len(scores)
+
+    def finalize(self):
+        """[compute the metrics over everything seen so far]
+
+        Returns:
+            [dict] -- [per class and mean metrics]
+        """
+        (scores, labels) = (self.scores[:self.n], self.labels[:self.n])
+        metrics = metrics_from_counts(self.counts)
+        aurocs = roc_auc(scores, labels)
+        return {
+            "count": self.n,
+            "cm": self.cm,
+            "counts": dict(zip(["tp", "fp", "fn", "tn"], self.counts)),
+            "accuracy": metrics["accuracy"],
+            "sensitivity": metrics["sensitivity"],
+            "specificity": metrics["specificity"],
+            "aurocs": aurocs,
+            "mean_auroc": float(np.nanmean(aurocs))
+        }
+
+
+def _bootstrap_worker(args):
+    (scores, labels, n_resamples, threshold, seed) = args
+    rng = np.random.default_rng(seed)
+    n = len(scores)
+    (aurocs, accuracy, sensitivity, specificity) = ([], [], [], [])
+    for _ in range(n_resamples):
+        idx = rng.integers(0, n, n)
+        metrics = metrics_from_counts(binary_counts(scores[idx], labels[idx], threshold))
+        aurocs.append(roc_auc(scores[idx], labels[idx]))
+        accuracy.append(metrics["accuracy"])
+        sensitivity.append(metrics["sensitivity"])
+        specificity.append(metrics["specificity"])
+    return (np.array(aurocs), np.array(accuracy), np.array(sensitivity), np.array(specificity))
+
+
+def bootstrap_ci(evaluator, n_resamples=1000, alpha=0.05, workers=None, seed=42):
+    """[bootstrap confidence intervals, the resamples are split across processes]
+
+    Arguments:
+        evaluator {[StreamingEvaluator]} -- [evaluator holding the predictions]
+
+    Keyword Arguments:
+        n_resamples {int} -- [number of bootstrap resamples] (default: {1000})
+        alpha {float} -- [1 - confidence level] (default: {0.05})
+        workers {[int]} -- [number of processes, all cores if None] (default: {None})
+        seed {int} -- [base seed, every process gets its own stream] (default: {42})
+
+    Returns:
+        [dict] -- [(low, high) interval of every metric, per class]
+    """
+    workers = workers or os.cpu_count() or 1
+    (scores, labels) = (evaluator.scores[:evaluator.n], evaluator.labels[:evaluator.n])
+    chunks = [n_resamples // workers + (1 if i < n_resamples % workers else 0) for i in range(workers)]
+    jobs = [(scores, labels, chunk, evaluator.threshold, seed + i) for (i, chunk) in enumerate(chunks) if chunk]
+
+    with ProcessPoolExecutor(max_workers=len(jobs)) as executor:
+        parts = list(executor.map(_bootstrap_worker, jobs))
+
+    (aurocs, accuracy, sensitivity, specificity) = [np.concatenate(part) for part in zip(*parts)]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mean_aurocs = np.nanmean(aurocs, axis=1)
+    percentiles = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+
+    def interval(values):
+        return np.nanpercentile(values, percentiles, axis=0)
+
+    return {
+        "n_resamples": n_resamples,
+        "confidence": 1 - alpha,
+        "aurocs": interval(aurocs),
+        "mean_auroc": interval(mean_aurocs),
+        "accuracy": interval(accuracy),
+        "sensitivity": interval(sensitivity),
+        "specificity": interval(specificity)
+    }
+
+
+def to_json(value):
+    if isinstance(value, dict):
+        return {key: to_json(item) for (key, item) in value.items()}
+    if isinstance(value, (np.ndarray, np.generic)):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def write_results(result, path):
+    """[write the evaluation result as machine readable json, nan becomes null]
+    """
+    with open(path, "w") as f:
+        json.dump(to_json(result), f, indent=2)
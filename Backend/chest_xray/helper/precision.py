@@ -0,0 +1,52 @@
+# import the necessary packages
+import os
+import tensorflow as tf
+
+PRECISIONS = ["float32", "mixed_bfloat16"]
+
+# cpu flags of native bfloat16 instructions, without them tensorflow emulates
+# bfloat16 and mixed precision training is slower than float32
+BFLOAT16_CPU_FLAGS = {"avx512_bf16", "amx_bf16"}
+
+
+def cpu_flags():
+    """[instruction set flags of the cpu, empty where /proc/cpuinfo does not exist]
+    """
+    if not os.path.exists("/proc/cpuinfo"):
+        return set()
+    with open("/proc/cpuinfo") as f:
+        for line in f:
+            if line.startswith("flags"):
+                return set(line.split(":", 1)[1].split())
+    return set()
+
+
+def bfloat16_supported():
+    """[the cpu has bfloat16 instructions and tensorflow can run a bfloat16 matmul on it]
+    """
+    if not cpu_flags() & BFLOAT16_CPU_FLAGS:
+        return False
+    try:
+        x = tf.ones((8, 8), dtype=tf.bfloat16)
+        tf.matmul(x, x).numpy()
+        return True
+    except Exception:
+        return False
+
+
+def set_precision(precision):
+    """[set the global keras precision policy, mixed_bfloat16 falls back to float32
+        on cpus without bfloat16 support]
+
+    Arguments:
+        precision {[str]} -- [one of PRECISIONS]
+
+    Returns:
+        [str] -- [the policy in effect]
+    """
+    if precision == "mixed_bfloat16" and not bfloat16_supported():
+        print("[INFO] the cpu has no bfloat16 support, training in float32")
+        precision = "float32"
+    tf.keras.mixed_precision.set_global_policy(precision)
+    print(f"[INFO] {precision} precision policy is used")
+    return precision
@@ -0,0 +1,35 @@
+# import the necessary packages
+import numpy as np
+
+# deterministic test-time augmentation views: crop boxes (y1, x1, y2, x2) and
+# contrast factors, the first view is always the unmodified image. shared by the
+# training scripts (from helper import tta) and the backend (from chest_xray.helper import tta)
+TTA_BOXES = [(0., 0., 1., 1.), (.05, .05, .95, .95), (0., 0., .9, .9), (.1, .1, 1., 1.),
+             (0., .1, .9, 1.), (.1, 0., 1., .9), (.025, .025, .975, .975), (.075, .075, .925, .925)]
+TTA_CONTRAST = [1., 1., 1., 1., 1., 1., 1.1, .9]
+
+
+def tta_views(images, k, first_view=0):
+    """[build views first_view..k-1 of every image in one vectorized call]
+
+    Arguments:
+        images {[np.array]} -- [batch of images scaled to [0, 1], (n, h, w, 3)]
+        k {[int]} -- [number of views per image, at most len(TTA_BOXES)]
+
+    Keyword Arguments:
+        first_view {int} -- [first view to build, 1 skips the unmodified image] (default: {0})
+
+    Returns:
+        [np.array] -- [views ordered image by image, (n * (k - first_view), h, w, 3)]
+    """
+    # tensorflow is only needed here, the view tables are importable without it
+    import tensorflow as tf
+
+    n = images.shape[0]
+    boxes = np.tile(np.array(TTA_BOXES[first_view:k], dtype=np.float32), (n, 1))
+    box_indices = np.repeat(np.arange(n, dtype=np.int32), k - first_view)
+    views = tf.image.crop_and_resize(images.astype(np.float32), boxes, box_indices, images.shape[1:3]).numpy()
+
+    contrast = np.tile(np.array(TTA_CONTRAST[first_view:k], dtype=np.float32), n)[:, None, None, None]
+    mean = views.mean(axis=(1, 2, 3), keepdims=True)
+    return np.clip((views - mean) * contrast + mean, 0., 1.)
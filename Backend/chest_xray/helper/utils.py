@@ -1,14 +1,15 @@
 # import the necessary packages
 import numpy as np
-import config
+from helper import config
+from helper.tta import tta_views
 
 
-# def get_class_counts(df, class_names):
-#     total_count = df.shape[0]
-#     labels = df[class_names]
-#     class_counts = np.sum(labels, axis=0)
-#     class_counts_dict = dict(zip(class_names, class_counts))
-#     return total_count, class_counts_dict
+def get_class_counts(df, class_names):
+    total_count = df.shape[0]
+    labels = df[class_names]
+    class_counts = np.sum(labels, axis=0)
+    class_counts_dict = dict(zip(class_names, class_counts))
+    return total_count, class_counts_dict
 
 
 # def compute_class_weight(total_count, class_counts_dict):
@@ -17,13 +18,23 @@ import config
 #         class_weight[i] = (total_count - class_count)/total_count
 #     return class_weight
 
-def compute_class_weight(df):
-    labels = df[config.CLASS_NAMES]
-    labels = np.array(labels)
+def compute_class_weight(df, class_names=config.CLASS_NAMES):
+    """[weight every class by the count of the most frequent class over its own count]
+
+    Arguments:
+        df {[pd.DataFrame]} -- [dataframe with a 0/1 column per class]
+
+    Keyword Arguments:
+        class_names {[List]} -- [label columns, in output order] (default: {config.CLASS_NAMES})
+
+    Returns:
+        [dict] -- [{class index: weight}, as fit(class_weight=...) takes it]
+    """
+    labels = np.array(df[class_names])
     class_totals = labels.sum(axis=0)
-    class_weight = class_totals.max() / class_totals
-    class_weight = zip(range(len(class_weight)), class_weight)
-    return class_weight
+    # a class without any example keeps weight 1 instead of dividing by zero
+    class_weight = class_totals.max() / np.maximum(class_totals, 1)
+    return {i: float(weight) for (i, weight) in enumerate(class_weight)}
 
 
 def sort_prediction(prediction):
@@ -32,3 +43,12 @@ def sort_prediction(prediction):
         prediction_map, key=prediction_map.get, reverse=True)}
 
     return sorted_prediction_map
+
+
+def tta_predict(model, images, k):
+    """[predict on k augmented views of every image as a single batch and average them]
+    """
+    if k <= 1:
+        return model.predict(images)
+    preds = model.predict(tta_views(images, k), batch_size=images.shape[0] * k)
+    return preds.reshape(images.shape[0], k, -1).mean(axis=1)
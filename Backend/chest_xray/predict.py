@@ -18,10 +18,10 @@ def preprocess_image(image, target_size=(224, 224)):
     return image_tensor
 
 
-def predict(model, processed_image):
-    # predict on preprocessed image
+def predict(model, processed_image, tta=1):
+    # predict on preprocessed image, averaged over tta augmented views
     print("[INFO] make prediction on sample image")
-    prediction = model.predict(processed_image).tolist()
+    prediction = utils.tta_predict(model, processed_image, tta).tolist()
     prediction = np.round(prediction, 3)
 
     # sort prediction result based on confidence score
@@ -34,6 +34,8 @@ if __name__ == "__main__":
     # define argument parser and parse the arguments
     ap = argparse.ArgumentParser()
     ap.add_argument("-i", "--image", required=True, help="path to input image")
+    ap.add_argument("-t", "--tta", type=int, default=1,
+                    help="number of test-time augmentation views (1 disables it, at most 8)")
     args = vars(ap.parse_args())
 
     # load trained model
@@ -46,7 +48,7 @@ if __name__ == "__main__":
     processed_image = preprocess_image(image)
 
     # prediction on the processed image
-    prediction_map = predict(model, processed_image)
+    prediction_map = predict(model, processed_image, tta=args["tta"])
     for (key, value) in prediction_map.items():
         print(f"{key}: {value}")
 
@@ -0,0 +1,309 @@
+# import the necessary packages
+import numpy as np
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from train import Train
+from helper import config
+from helper.evaluation import StreamingEvaluator
+
+
+class Trial(Train):
+    def __init__(self, spec, strategy=None):
+        """[train one hyperparameter setting of the search in its own output directory]
+
+        Arguments:
+            spec {[dict]} -- [trial id, hyperparameters, epoch budget and directory]
+
+        Keyword Arguments:
+            strategy {[tf.distribute.Strategy]} -- [distribution strategy] (default: {None})
+        """
+        super(Trial, self).__init__(strategy)
+        hparams = spec["hparams"]
+        self.model_path = os.path.sep.join([spec["trial_dir"], "LuNet.h5"])
+        self.checkpoint_dir = os.path.sep.join([spec["trial_dir"], "checkpoints"])
+        self.log_dir = os.path.sep.join([spec["trial_dir"], "logs"])
+        # the epoch budget of the rung, training resumes from the checkpoint of the previous rung
+        self.epochs = spec["epochs"]
+        self.initial_lr = hparams["initial_lr"]
+        self.min_lr = hparams["min_lr"]
+        self.set_batch_size(int(hparams["batch_size"]))
+
+    def validate(self, model):
+        """[per class and mean auroc of the model on the validation split]
+        """
+        from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+        val_datagen = ImageDataGenerator(rescale=1./255).flow_from_dataframe(self.val_df,
+                                                                             directory=None,
+                                                                             x_col="Image Path",
+                                                                             y_col=config.CLASS_NAMES,
+                                                                             target_size=(self.image_size, self.image_size),
+                                                                             class_mode="raw",
+                                                                             batch_size=self.batch_size,
+                                                                             shuffle=False)
+        evaluator = StreamingEvaluator(config.CLASS_NAMES)
+        for idx in range(len(val_datagen)):
+            (images, labels) = val_datagen[idx]
+            evaluator.update(model.predict_on_batch(images), labels)
+        return evaluator.finalize()
+
+
+def run_trial(spec):
+    """[train a trial up to the epochs of its rung and write its validation auroc]
+    """
+    import tensorflow as tf
+    from tensorflow.keras.models import load_model
+
+    # the process is pinned to its cores, run as many tensorflow threads
+    tf.config.threading.set_intra_op_parallelism_threads(len(spec["cpus"]))
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+
+    start = time.time()
+    trial = Trial(spec)
+    model = trial.build_model()
+    (train_datagen, val_datagen) = trial.data_generator()
+    callbacks = trial.callbacks(train_datagen)
+    trial.train(model, train_datagen, val_datagen, callbacks)
+
+    results = trial.validate(load_model(trial.model_path, compile=False))
+    with open(spec["result_path"], "w") as f:
+        json.dump({
+            "val_auroc": results["mean_auroc"],
+            "val_aurocs": dict(zip(config.CLASS_NAMES, [float(auroc) for auroc in results["aurocs"]])),
+            "seconds": time.time() - start
+        }, f)
+
+
+def sample_hparams(trial_id, space, seed=config.SEED):
+    """[hyperparameters of a trial, drawn from its own seeded stream so a resumed
+    search gets the same settings back]
+
+    Arguments:
+        trial_id {int} -- [id of the trial]
+        space {[dict]} -- [("log", low, high) ranges or lists of choices by name]
+
+    Returns:
+        [dict] -- [hyperparameters by name]
+    """
+    rng = np.random.default_rng([seed, trial_id])
+    hparams = {}
+    for (name, values) in sorted(space.items()):
+        if isinstance(values, tuple) and values[0] == "log":
+            hparams[name] = float(np.exp(rng.uniform(np.log(values[1]), np.log(values[2]))))
+        else:
+            hparams[name] = values[int(rng.integers(len(values)))]
+    return hparams
+
+
+def rung_epochs(min_epochs, max_epochs, reduction_factor):
+    """[epoch budget of every rung, min_epochs * reduction_factor ** k up to max_epochs]
+    """
+    epochs = [min_epochs]
+    while epochs[-1] * reduction_factor <= max_epochs:
+        epochs.append(epochs[-1] * reduction_factor)
+    return epochs
+
+
+def cpu_slots(cores_per_trial, workers=None):
+    """[disjoint sets of cores, one per concurrently running trial]
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    cores_per_trial = min(cores_per_trial, len(cpus))
+    slots = [cpus[i:i + cores_per_trial] for i in range(0, len(cpus) - cores_per_trial + 1, cores_per_trial)]
+    return slots[:workers] if workers else slots
+
+
+class ASHA():
+    def __init__(self, n_trials, rungs, reduction_factor, records=()):
+        """[asynchronous successive halving: a free worker resumes the best not yet
+        promoted trial of the highest rung it can, or starts a new trial at rung 0,
+        so no worker waits for a rung to fill up. trials that are not promoted are
+        never resumed, which stops the poor ones after the first rungs]
+
+        Arguments:
+            n_trials {int} -- [number of hyperparameter settings to try]
+            rungs {[List]} -- [epoch budget of every rung]
+            reduction_factor {int} -- [1 / reduction_factor of every rung is promoted]
+
+        Keyword Arguments:
+            records {[List]} -- [trial records of a previous run of the search] (default: {()})
+        """
+        self.n_trials = n_trials
+        self.rungs = rungs
+        self.reduction_factor = reduction_factor
+        self.results = {}
+        self.running = set()
+        for record in records:
+            self.record(record)
+
+    def record(self, record):
+        self.results[(record["trial"], record["rung"])] = record["val_auroc"]
+
+    def next_job(self):
+        """[(trial id, rung) to run next, or None when nothing can run right now]
+        """
+        for rung in reversed(range(len(self.rungs) - 1)):
+            completed = sorted(((auroc, trial) for ((trial, r), auroc) in self.results.items()
+                                if r == rung and auroc is not None), reverse=True)
+            for (_, trial) in completed[:len(completed) // self.reduction_factor]:
+                if (trial, rung + 1) not in self.results and trial not in self.running:
+                    return (trial, rung + 1)
+        for trial in range(self.n_trials):
+            if (trial, 0) not in self.results and trial not in self.running:
+                return (trial, 0)
+        return None
+
+    def best(self):
+        """[(trial id, rung, auroc) of every trial at its highest completed rung, best first]
+        """
+        reached = {}
+        for ((trial, rung), auroc) in self.results.items():
+            if auroc is not None and rung >= reached.get(trial, (-1, None))[0]:
+                reached[trial] = (rung, auroc)
+        return sorted(((trial, rung, auroc) for (trial, (rung, auroc)) in reached.items()),
+                      key=lambda item: (item[1], item[2]), reverse=True)
+
+
+def launch(spec):
+    """[start a trial process pinned to its cores, the output goes to the trial log]
+    """
+    os.makedirs(spec["trial_dir"], exist_ok=True)
+    if os.path.exists(spec["result_path"]):
+        os.remove(spec["result_path"])
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(spec["cpus"])))
+    # every trial trains on its own, not as a worker of a multi worker cluster
+    env.pop("TF_CONFIG", None)
+    cpus = set(spec["cpus"])
+    preexec_fn = (lambda: os.sched_setaffinity(0, cpus)) if hasattr(os, "sched_setaffinity") else None
+    with open(os.path.sep.join([spec["trial_dir"], "train.log"]), "a") as log:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--trial", json.dumps(spec)],
+                                stdout=log, stderr=subprocess.STDOUT, env=env, preexec_fn=preexec_fn)
+
+
+def search(settings, poll_seconds=5):
+    """[run the search until every trial is finished or stopped, appending a record
+    per trial and rung to the results file. records already in the file are kept,
+    so an interrupted search resumes where it stopped]
+    """
+    rungs = rung_epochs(settings["min_epochs"], settings["max_epochs"], settings["reduction_factor"])
+    records = []
+    if os.path.exists(config.SEARCH_RESULTS_PATH):
+        with open(config.SEARCH_RESULTS_PATH) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        print(f"[INFO] resuming the search, {len(records)} trial rungs done")
+    asha = ASHA(settings["trials"], rungs, settings["reduction_factor"], records)
+    slots = cpu_slots(settings["cores_per_trial"], settings["workers"])
+    print(f"[INFO] {len(slots)} concurrent trials of {len(slots[0])} cores, rungs of {rungs} epochs")
+
+    running = {}
+    try:
+        while True:
+            # collect the finished trials
+            for (slot, (process, spec)) in list(running.items()):
+                if process.poll() is None:
+                    continue
+                del running[slot]
+                asha.running.discard(spec["trial"])
+                record = {key: spec[key] for key in ["trial", "rung", "epochs", "hparams", "cpus"]}
+                if process.returncode == 0 and os.path.exists(spec["result_path"]):
+                    with open(spec["result_path"]) as f:
+                        record.update(json.load(f), status="completed")
+                else:
+                    record.update(val_auroc=None, status="failed", returncode=process.returncode)
+                asha.record(record)
+                with open(config.SEARCH_RESULTS_PATH, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+                print(f"[INFO] trial {record['trial']} rung {record['rung']} ({record['epochs']} epochs): "
+                      f"{record['status']}, val auroc {record['val_auroc']}")
+
+            # fill the free slots
+            for slot in range(len(slots)):
+                if slot in running:
+                    continue
+                job = asha.next_job()
+                if job is None:
+                    break
+                (trial, rung) = job
+                trial_dir = os.path.sep.join([config.SEARCH_DIR, f"trial-{trial:03d}"])
+                spec = {
+                    "trial": trial,
+                    "rung": rung,
+                    "epochs": rungs[rung],
+                    "hparams": sample_hparams(trial, config.SEARCH_SPACE),
+                    "cpus": slots[slot],
+                    "trial_dir": trial_dir,
+                    "result_path": os.path.sep.join([trial_dir, f"result-{rungs[rung]}.json"])
+                }
+                running[slot] = (launch(spec), spec)
+                asha.running.add(trial)
+                print(f"[INFO] trial {trial} rung {rung} ({rungs[rung]} epochs) on cores {slots[slot]}: {spec['hparams']}")
+
+            if not running:
+                break
+            time.sleep(poll_seconds)
+    finally:
+        # an interrupted search stops its trials, they resume from their checkpoints
+        for (process, _) in running.values():
+            process.terminate()
+            process.wait()
+
+    # with no trial through the first rung the search cannot rank anything, it is
+    # broken (data, dependencies) rather than unlucky
+    if not asha.best():
+        raise RuntimeError(f"every trial of the first rung failed, see the train.log of the trials in {config.SEARCH_DIR}")
+    return asha
+
+
+if __name__ == "__main__":
+    # define argument parser and parse the arguments
+    ap = argparse.ArgumentParser(description="parallel hyperparameter search with asynchronous successive halving")
+    ap.add_argument("--trials", type=int, default=config.SEARCH_TRIALS)
+    ap.add_argument("--cores-per-trial", type=int, default=config.SEARCH_CORES_PER_TRIAL)
+    ap.add_argument("--workers", type=int, default=None, help="concurrent trials, all core sets if not given")
+    ap.add_argument("--min-epochs", type=int, default=config.SEARCH_MIN_EPOCHS)
+    ap.add_argument("--max-epochs", type=int, default=config.SEARCH_MAX_EPOCHS)
+    ap.add_argument("--reduction-factor", type=int, default=config.SEARCH_REDUCTION_FACTOR)
+    ap.add_argument("--trial", help=argparse.SUPPRESS)
+    args = vars(ap.parse_args())
+
+    if args["trial"]:
+        run_trial(json.loads(args["trial"]))
+        sys.exit(0)
+
+    # the rungs of a resumed search have to stay the same, its settings are kept
+    os.makedirs(config.SEARCH_DIR, exist_ok=True)
+    settings_path = os.path.sep.join([config.SEARCH_DIR, "search.json"])
+    settings = {key: value for (key, value) in args.items() if key != "trial"}
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            settings = json.load(f)
+        print(f"[INFO] using the settings of the search in {config.SEARCH_DIR}: {settings}")
+    else:
+        with open(settings_path, "w") as f:
+            json.dump(settings, f, indent=2)
+
+    asha = search(settings)
+
+    ranking = asha.best()
+    print(f"{'trial':>5} {'epochs':>6} {'val auroc':>10}  hyperparameters")
+    for (trial, rung, auroc) in ranking:
+        print(f"{trial:>5} {asha.rungs[rung]:>6} {auroc:>10.4f}  {sample_hparams(trial, config.SEARCH_SPACE)}")
+    if ranking:
+        (trial, rung, auroc) = ranking[0]
+        best = {
+            "trial": trial,
+            "epochs": asha.rungs[rung],
+            "val_auroc": auroc,
+            "hparams": sample_hparams(trial, config.SEARCH_SPACE),
+            "model_path": os.path.sep.join([config.SEARCH_DIR, f"trial-{trial:03d}", "LuNet.h5"])
+        }
+        with open(os.path.sep.join([config.SEARCH_DIR, "best.json"]), "w") as f:
+            json.dump(best, f, indent=2)
+        print(f"[INFO] best trial {trial}, val auroc {auroc:.4f}: {best['hparams']}")
@@ -5,9 +5,10 @@ import matplotlib.pyplot as plt
 import os
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.models import load_model
-from sklearn.metrics import roc_auc_score, accuracy_score, classification_report, confusion_matrix
+from sklearn.metrics import classification_report
 from helper import utils
 from helper import config
+from helper import evaluation
 
 
 class Test():
@@ -28,29 +29,26 @@ class Test():
         """
         test_aug = ImageDataGenerator(rescale=1./255)
 
-        test_datagen = test_aug.flow_from_datafram(self.test_df,
-                                                   directory=config.TEST_PATH,
-                                                   x_col="Image Index",
-                                                   y_col=config.CLASS_NAMES,
-                                                   target_size=(
-                                                       224, 224),
-                                                   class_mode='categorical',
-                                                   batch_size=config.BATCH_SIZE,
-                                                   shuffle=False)
+        test_datagen = test_aug.flow_from_dataframe(self.test_df,
+                                                    directory=config.TEST_PATH,
+                                                    x_col="Image Index",
+                                                    y_col=config.CLASS_NAMES,
+                                                    target_size=(
+                                                        224, 224),
+                                                    class_mode='categorical',
+                                                    batch_size=config.BATCH_SIZE,
+                                                    shuffle=False)
 
         return test_datagen
 
     # TODO: is it necessary to calculate auroc score?
-    def calculate_auroc(self, y_pred, y):
-        test_log_path = os.path.join(config.OUTPUT_PATH, "test.log")
-        aurocs = []
+    def calculate_auroc(self, y_pred, y, test_log_path=None):
+        test_log_path = test_log_path or os.path.join(config.OUTPUT_PATH, "test.log")
+        # all classes at once, nan for classes with a single label value
+        class_aurocs = evaluation.roc_auc(np.asarray(y_pred), np.asarray(y))
+        aurocs = [float(auroc) for auroc in class_aurocs if not np.isnan(auroc)]
         with open(test_log_path, "w") as f:
-            for idx, class_name in enumerate(config.CLASS_NAMES):
-                try:
-                    auroc_score = roc_auc_score(y[:, idx], y_pred[:, idx])
-                    aurocs.append(auroc_score)
-                except ValueError:
-                    auroc_score = 0
+            for (class_name, auroc_score) in zip(config.CLASS_NAMES, np.nan_to_num(class_aurocs)):
                 f.write(f"{class_name}: {auroc_score}\n")
             mean_auroc = np.mean(aurocs)
             f.write("-------------------------\n")
@@ -58,50 +56,46 @@ class Test():
 
         return (aurocs, mean_auroc)
 
-    def test(self, model, test_datagen):
-        """[test model performance for the given test data generator]
+    def test(self, model, test_datagen, n_bootstrap=config.BOOTSTRAP_RESAMPLES, workers=None):
+        """[test model performance for the given test data generator
+
+            predictions are streamed batch by batch into a StreamingEvaluator,
+            the bootstrap confidence intervals are computed across processes and
+            everything is written as json next to test.log.
+            ]
 
         Arguments:
             test_generator {[ImageDatagenrator]} -- [test image data generator]
 
+        Keyword Arguments:
+            n_bootstrap {int} -- [number of bootstrap resamples, 0 disables them] (default: {config.BOOTSTRAP_RESAMPLES})
+            workers {[int]} -- [number of bootstrap processes, all cores if None] (default: {None})
+
         Returns:
-            [tuple] -- [mean accuracy and mean auroc score]
+            [dict] -- [evaluation result]
         """
+        evaluator = evaluation.StreamingEvaluator(config.CLASS_NAMES)
+
+        # use the trained model to make predictions on the test data, one batch at a time
+        for idx in range(len(test_datagen)):
+            (images, y) = test_datagen[idx]
+            evaluator.update(model.predict_on_batch(images), y)
+        evaluation_result = evaluator.finalize()
+
+        # compute the multilabel classification report
+        (scores, labels) = (evaluator.scores[:evaluator.n], evaluator.labels[:evaluator.n])
+        evaluation_result["report"] = classification_report(
+            labels, scores > evaluator.threshold, target_names=config.CLASS_NAMES, zero_division=0)
+
+        # write the per class auroc to test.log
+        self.calculate_auroc(scores, labels)
+
+        if n_bootstrap:
+            print(f"[INFO] computing {n_bootstrap} bootstrap resamples...")
+            evaluation_result["ci"] = evaluation.bootstrap_ci(evaluator, n_bootstrap, workers=workers)
 
-        # use the trained model to  make predictions on the test data
-        preds = model.predict(test_datagen, verbose=1)
-
-        # for each image in the testing set we need to find the index of the
-        # label with corresponding largest predicted probability
-        predIdxs = np.argmax(preds, axis=1)
-
-        # compute the classification report
-        # TODO: write classification report to a file.
-        report = classification_report(
-            test_datagen.classes, predIdxs, target_names=test_datagen.class_indices.keys())
-
-        # compute the confusion matrix and and use it to derive the raw
-        # accuracy, sensitivity, and specificity
-        cm = confusion_matrix(test_datagen.classes, predIdxs)
-        total = sum(sum(cm))
-        accuracy = (cm[0, 0] + cm[1, 1]) / total
-        sensitivity = cm[0, 0] / (cm[0, 0] + cm[0, 1])
-        specificity = cm[1, 1] / (cm[1, 0] + cm[1, 1])
-
-        # calcualte auroc score
-        y = np.array(test_datagen.labels)
-        aurocs, mean_auroc = self.calculate_auroc(preds, y)
-
-        # evaluation result dictionary
-        evaluation_result = {
-            "report": report,
-            "cm": cm,
-            "accuracy": accuracy,
-            "sensitivity": sensitivity,
-            "specificity": specificity,
-            "aurocs": aurocs,
-            "mean_auroc": mean_auroc
-        }
+        evaluation_result["class_names"] = config.CLASS_NAMES
+        evaluation.write_results(evaluation_result, config.TEST_RESULTS_PATH)
 
         return evaluation_result
 
@@ -124,13 +118,20 @@ if __name__ == "__main__":
     # show the classification report
     print(evaluation_result["report"])
 
-    # show the confusion matrix, accuracy, sensitivity, and specificity
+    # show the confusion matrix, and the per class accuracy, sensitivity, specificity and auroc
     print(evaluation_result["cm"])
-    print("accuracy: {:.4f}".format(evaluation_result["accuracy"]))
-    print("sensitivity: {:.4f}".format(evaluation_result["sensitivity"]))
-    print("specificity: {:.4f}".format(evaluation_result["specificity"]))
+    ci = evaluation_result.get("ci")
+    for (idx, class_name) in enumerate(config.CLASS_NAMES):
+        line = f"{class_name:<14}"
+        for metric in ["accuracy", "sensitivity", "specificity", "aurocs"]:
+            line += f" {metric}: {evaluation_result[metric][idx]:.4f}"
+            if ci is not None:
+                line += " [{:.4f}, {:.4f}]".format(*ci[metric][:, idx])
+        print(line)
 
     # show the mean auroc score
-    print(evaluation_result["aurocs"])
     print("-----------------------------------------------------")
     print("mean_auroc {}".format(evaluation_result["mean_auroc"]))
+    if ci is not None:
+        print("mean_auroc {:.0%} ci [{:.4f}, {:.4f}]".format(ci["confidence"], *ci["mean_auroc"]))
+    print(f"[INFO] results written to {config.TEST_RESULTS_PATH}")
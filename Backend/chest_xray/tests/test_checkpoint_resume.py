@@ -0,0 +1,145 @@
+# import the necessary packages
+import os
+import sys
+import json
+import signal
+import subprocess
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+CHEST_XRAY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Train.train on a tiny dataset of synthetic images, with the callbacks of
+# Train.callbacks and a small model in place of the densenet. with KILL_AT_EPOCH set
+# the process kills itself right after that epoch's checkpoint
+TRAINING_SCRIPT = """
+import os
+import sys
+import json
+import signal
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback, EarlyStopping
+from helper.checkpoint import TrainingCheckpoint, seed_everything
+from train import Train
+
+tf.config.threading.set_intra_op_parallelism_threads(1)
+tf.config.threading.set_inter_op_parallelism_threads(1)
+(output_dir, log_path, epochs, kill_at_epoch) = (sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+
+
+class TinyTrain(Train):
+    def __init__(self):
+        super(TinyTrain, self).__init__()
+        self.image_size = 32
+        self.epochs = epochs
+        self.model_path = os.path.join(output_dir, "model.h5")
+        self.checkpoint_dir = os.path.join(output_dir, "checkpoints")
+        self.log_dir = os.path.join(output_dir, "logs")
+        self.set_batch_size(4)
+
+    def build_model(self, show_summary=False, weights=None, input_size=None):
+        seed_everything(42)
+        size = input_size or (None if self.progressive_schedule else self.image_size)
+        images = tf.keras.layers.Input(shape=(size, size, 3))
+        x = tf.keras.layers.Conv2D(4, 3, activation="relu")(images)
+        x = tf.keras.layers.GlobalAveragePooling2D()(x)
+        return tf.keras.Model(images, tf.keras.layers.Dense(5, activation="sigmoid", dtype="float32")(x))
+
+
+class LossLog(Callback):
+    def on_epoch_end(self, epoch, logs=None):
+        with open(log_path, "a") as f:
+            f.write(json.dumps({"epoch": epoch, "loss": logs["loss"], "val_loss": logs["val_loss"]}) + "\\n")
+
+
+class Kill(Callback):
+    def on_epoch_end(self, epoch, logs=None):
+        if epoch + 1 == kill_at_epoch:
+            os.kill(os.getpid(), signal.SIGKILL)
+
+
+train = TinyTrain()
+model = train.build_model()
+(train_datagen, val_datagen) = train.data_generator()
+callbacks = train.callbacks(train_datagen)
+# the training checkpoint has to stay last of the stateful callbacks, Kill after its save
+index = next(i for (i, callback) in enumerate(callbacks) if isinstance(callback, TrainingCheckpoint))
+callbacks.insert(index, LossLog())
+callbacks.append(Kill())
+train.train(model, train_datagen, val_datagen, callbacks)
+
+earlyStop = next(callback for callback in callbacks if isinstance(callback, EarlyStopping))
+with open(log_path, "a") as f:
+    best = [float(np.sum(w)) for w in earlyStop.best_weights] if earlyStop.best_weights else None
+    f.write(json.dumps({"final_weights": [float(np.sum(w)) for w in model.get_weights()],
+                        "best_weights": best}) + "\\n")
+"""
+
+
+def make_dataset(workdir):
+    """[a dataset/ of synthetic images and the train and validation csv files the
+        config points to, relative to workdir]
+    """
+    import pandas as pd
+    from PIL import Image
+
+    rng = np.random.RandomState(0)
+    os.makedirs(os.path.join(workdir, "dataset", "images"))
+    for (split, count) in [("train", 24), ("validation", 8)]:
+        rows = []
+        for i in range(count):
+            labels = (rng.rand(5) < 0.4).astype(int)
+            path = os.path.join(workdir, "dataset", "images", f"{split}{i}.png")
+            Image.fromarray((rng.rand(32, 32, 3) * 80 + labels[0] * 120).astype("uint8")).save(path)
+            rows.append([path, *labels])
+        columns = ["Image Path", "Atelectasis", "Effusion", "Pneumonia", "Pneumothorax", "Tuberculosis"]
+        pd.DataFrame(rows, columns=columns).to_csv(os.path.join(workdir, "dataset", f"{split}.csv"), index=False)
+
+
+def run(tmp_path, name, epochs, kill_at_epoch=0):
+    workdir = tmp_path / name
+    if not (workdir / "dataset").exists():
+        make_dataset(str(workdir))
+    output_dir = str(workdir / "output")
+    log_path = str(workdir / "log.jsonl")
+    os.makedirs(output_dir, exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([CHEST_XRAY_PATH, os.getenv("PYTHONPATH", "")]))
+    result = subprocess.run([sys.executable, "-c", TRAINING_SCRIPT, output_dir, log_path,
+                             str(epochs), str(kill_at_epoch)], cwd=str(workdir), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return (result.returncode, os.path.join(output_dir, "checkpoints"), log_path)
+
+
+def read_log(log_path):
+    with open(log_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_killed_and_resumed_run_matches_uninterrupted_run(tmp_path):
+    epochs = 6
+    (returncode, _, reference_log) = run(tmp_path, "reference", epochs)
+    assert returncode == 0
+
+    # killed right after the checkpoint of epoch 3, then resumed from it
+    (returncode, checkpoint_dir, resumed_log) = run(tmp_path, "resumed", epochs, kill_at_epoch=3)
+    assert returncode == -signal.SIGKILL
+    assert [entry["epoch"] for entry in read_log(resumed_log)] == [0, 1, 2]
+    (returncode, _, _) = run(tmp_path, "resumed", epochs)
+    assert returncode == 0
+
+    reference = read_log(reference_log)
+    resumed = read_log(resumed_log)
+    # early stopping may end both runs before the last epoch, at the same one
+    assert len(reference) - 1 > 3
+    assert [entry["epoch"] for entry in resumed[:-1]] == [entry["epoch"] for entry in reference[:-1]]
+    for (expected, actual) in zip(reference[:-1], resumed[:-1]):
+        np.testing.assert_allclose(actual["loss"], expected["loss"], rtol=1e-6)
+        np.testing.assert_allclose(actual["val_loss"], expected["val_loss"], rtol=1e-6)
+
+    # the early stopping best weights from before the kill survive the resume
+    np.testing.assert_allclose(resumed[-1]["best_weights"], reference[-1]["best_weights"], rtol=1e-6)
+    np.testing.assert_allclose(resumed[-1]["final_weights"], reference[-1]["final_weights"], rtol=1e-6)
+    assert any(name.endswith(".best_weights.npz") for name in os.listdir(checkpoint_dir))
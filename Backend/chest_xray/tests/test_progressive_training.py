@@ -0,0 +1,125 @@
+# import the necessary packages
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from test_checkpoint_resume import CHEST_XRAY_PATH, make_dataset
+
+# Train.train with a progressive schedule of two stages (16x16 for the first two
+# epochs, then 32x32) on the synthetic dataset, with a small model in place of the
+# densenet. every fit logs the generator it starts from; with STOP_AT_EPOCH set a
+# callback stops the training after that epoch like early stopping would
+TRAINING_SCRIPT = """
+import os
+import sys
+import json
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback
+from helper.checkpoint import TrainingCheckpoint, seed_everything
+from train import Train
+
+tf.config.threading.set_intra_op_parallelism_threads(1)
+tf.config.threading.set_inter_op_parallelism_threads(1)
+(output_dir, log_path, stop_at_epoch) = (sys.argv[1], sys.argv[2], int(sys.argv[3]))
+
+
+class TinyTrain(Train):
+    def __init__(self):
+        super(TinyTrain, self).__init__()
+        self.image_size = 32
+        self.epochs = 4
+        self.progressive_schedule = [(16, 2), (32, 4)]
+        self.model_path = os.path.join(output_dir, "model.h5")
+        self.checkpoint_dir = os.path.join(output_dir, "checkpoints")
+        self.log_dir = os.path.join(output_dir, "logs")
+        self.set_batch_size(4)
+
+    def build_model(self, show_summary=False, weights=None, input_size=None):
+        seed_everything(42)
+        size = input_size or (None if self.progressive_schedule else self.image_size)
+        images = tf.keras.layers.Input(shape=(size, size, 3))
+        x = tf.keras.layers.Conv2D(4, 3, activation="relu")(images)
+        x = tf.keras.layers.GlobalAveragePooling2D()(x)
+        return tf.keras.Model(images, tf.keras.layers.Dense(5, activation="sigmoid", dtype="float32")(x))
+
+
+class StageLog(Callback):
+    def __init__(self, trainingCheckpoint, first_datagen):
+        super(StageLog, self).__init__()
+        self.trainingCheckpoint = trainingCheckpoint
+        self.first_datagen = first_datagen
+
+    def log(self, entry):
+        with open(log_path, "a") as f:
+            f.write(json.dumps(entry) + "\\n")
+
+    def on_train_begin(self, logs=None):
+        # the generator is not read yet, its position is the one the stage starts from
+        datagen = self.trainingCheckpoint.datagen
+        self.log({"stage_target_size": list(datagen.target_size),
+                  "rebuilt": datagen is not self.first_datagen,
+                  "datagen_batches_seen": int(datagen.total_batches_seen),
+                  "trained_batches": int(self.trainingCheckpoint.batches_seen)})
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.log({"epoch": epoch})
+        if epoch + 1 == stop_at_epoch:
+            self.model.stop_training = True
+
+
+train = TinyTrain()
+model = train.build_model()
+(train_datagen, val_datagen) = train.data_generator()
+callbacks = train.callbacks(train_datagen)
+trainingCheckpoint = next(callback for callback in callbacks if isinstance(callback, TrainingCheckpoint))
+callbacks.insert(callbacks.index(trainingCheckpoint), StageLog(trainingCheckpoint, train_datagen))
+train.train(model, train_datagen, val_datagen, callbacks)
+"""
+
+
+def run(tmp_path, name, stop_at_epoch=0):
+    workdir = tmp_path / name
+    make_dataset(str(workdir))
+    output_dir = str(workdir / "output")
+    log_path = str(workdir / "log.jsonl")
+    os.makedirs(output_dir, exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([CHEST_XRAY_PATH, os.getenv("PYTHONPATH", "")]))
+    result = subprocess.run([sys.executable, "-c", TRAINING_SCRIPT, output_dir, log_path, str(stop_at_epoch)],
+                            cwd=str(workdir), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    assert result.returncode == 0, result.stdout.decode()[-2000:]
+    with open(log_path) as f:
+        log = [json.loads(line) for line in f]
+    stages = [entry for entry in log if "stage_target_size" in entry]
+    epochs = [entry["epoch"] for entry in log if "epoch" in entry]
+    return (stages, epochs, os.path.join(output_dir, "model.h5"))
+
+
+def test_stage_switch_rebuilds_the_generator_at_the_position_trained_up_to(tmp_path):
+    (stages, epochs, model_path) = run(tmp_path, "progressive")
+
+    # 24 training images in batches of 4 make 6 steps per epoch
+    assert epochs == [0, 1, 2, 3]
+    assert [stage["stage_target_size"] for stage in stages] == [[16, 16], [32, 32]]
+    assert [stage["rebuilt"] for stage in stages] == [True, True]
+    # the second stage continues the shuffling after the 12 batches trained at 16x16,
+    # not after the ones tf.data had prefetched from the first generator
+    assert stages[0]["datagen_batches_seen"] == 0
+    assert stages[1]["trained_batches"] == 12
+    assert stages[1]["datagen_batches_seen"] == 12
+    assert os.path.exists(model_path)
+
+
+def test_early_stop_in_a_stage_ends_the_schedule(tmp_path):
+    import tensorflow as tf
+
+    (stages, epochs, model_path) = run(tmp_path, "stopped", stop_at_epoch=1)
+
+    # stopped after the first epoch at 16x16, the 32x32 stage never starts
+    assert epochs == [0]
+    assert [stage["stage_target_size"] for stage in stages] == [[16, 16]]
+    # the trained model is still exported at full resolution
+    assert tf.keras.models.load_model(model_path, compile=False).input_shape == (None, 32, 32, 3)
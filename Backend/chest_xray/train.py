@@ -2,6 +2,7 @@
 import numpy as np
 import pandas as pd
 import os
+import argparse
 import tensorflow as tf
 from tensorflow.keras.layers import Dense, Input
 from tensorflow.keras.models import Model, load_model
@@ -9,85 +10,155 @@ from tensorflow.keras.applications.densenet import DenseNet121
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.callbacks import ModelCheckpoint, ReduceLROnPlateau, TensorBoard, EarlyStopping
-from tensorflow.keras.utils import multi_gpu_model
-from sklearn.model_selection import roc_auc_score
 from helper import utils, config
+from helper.checkpoint import TrainingCheckpoint, rebase_callbacks
+from helper import distribute
+from helper import precision
 
 
 class Train():
-    def __init__(self):
+    def __init__(self, strategy=None):
         """[train the model with the given train configurations.]
+
+        Keyword Arguments:
+            strategy {[tf.distribute.Strategy]} -- [distribution strategy] (default: {None})
         """
+        self.strategy = strategy or tf.distribute.get_strategy()
+        self.model_path = config.MODEL_PATH
+        self.checkpoint_dir = config.CHECKPOINT_DIR
+        self.log_dir = config.LOG_DIR
+        self.epochs = config.EPOCHS
+        self.initial_lr = config.INTIAL_LR
+        self.min_lr = config.MIN_LR
+        self.image_size = 224
+        # (image size, last epoch) stages of progressive resizing, None trains at full resolution
+        self.progressive_schedule = None
         self.train_df = pd.read_csv(config.TRAIN_METADATA_PATH)
         self.val_df = pd.read_csv(config.VAL_METADATA_PATH)
 
-        self.train_steps = int(len(self.train_df) // config.BATCH_SIZE)
-        self.val_steps = int(len(self.val_df) // config.BATCH_SIZE)
+        self.set_batch_size(config.BATCH_SIZE)
+
+    def set_batch_size(self, per_replica_batch_size):
+        """[batch size of this worker and the steps of an epoch over its shard of the data]
+
+        Arguments:
+            per_replica_batch_size {[int]} -- [batch size of a single replica]
+        """
+        # every worker feeds only its local replicas, from its own part of the data.
+        # the shards can differ by a row, the steps come from the global counts so
+        # every worker runs the same number of them and meets the others in the all-reduce
+        self.per_replica_batch_size = per_replica_batch_size
+        self.batch_size = per_replica_batch_size * distribute.local_replicas(self.strategy)
+        global_batch_size = per_replica_batch_size * self.strategy.num_replicas_in_sync
+        self.train_steps = int(len(self.train_df) // global_batch_size)
+        self.val_steps = int(len(self.val_df) // global_batch_size)
+
+    def stages(self):
+        """[(image size, last epoch) training stages, a single full resolution stage
+            unless progressive resizing trains the first epochs at lower resolutions]
+
+        Returns:
+            [List] -- [stages in training order, the last one ends at self.epochs]
+        """
+        if not self.progressive_schedule:
+            return [(self.image_size, self.epochs)]
+        stages = [(image_size, min(last_epoch, self.epochs))
+                  for (image_size, last_epoch) in self.progressive_schedule[:-1]]
+        return stages + [(self.progressive_schedule[-1][0], self.epochs)]
 
-    def build_model(self, show_summary=False):
+    def build_model(self, show_summary=False, weights="imagenet", input_size=None):
         """[Finetune a pre-trained densenet model]
 
         Keyword Arguments:
             show_summary {bool} -- [show model summary] (default: {False})
+            weights {[str]} -- [initial weights of the densenet] (default: {"imagenet"})
+            input_size {[int]} -- [fixed input size, variable when training progressively] (default: {None})
         """
-        img_input = Input(shape=(224, 224, 3))
-        base_model = DenseNet121(include_top=False,
-                                 weights="imagenet",
-                                 input_tensor=img_input,
-                                 input_shape=(224, 224, 3),
-                                 pooling="avg"
-                                 )
-        # TODO: add additional dense layers.
-        output = Dense(len(config.CLASS_NAMES),
-                       activation="sigmoid", name="output")(base_model.output)
-
-        model = Model(inputs=img_input, outputs=output)
+        if input_size is None and not self.progressive_schedule:
+            input_size = self.image_size
+        input_shape = (input_size, input_size, 3)
+
+        # variables have to be created under the strategy scope to be mirrored
+        with self.strategy.scope():
+            img_input = Input(shape=input_shape)
+            base_model = DenseNet121(include_top=False,
+                                     weights=weights,
+                                     input_tensor=img_input,
+                                     input_shape=input_shape,
+                                     pooling="avg"
+                                     )
+            # TODO: add additional dense layers.
+            # the sigmoid outputs stay float32 under a mixed precision policy
+            output = Dense(len(config.CLASS_NAMES),
+                           activation="sigmoid", name="output", dtype="float32")(base_model.output)
+
+            model = Model(inputs=img_input, outputs=output)
         if show_summary:
             print(model.summary())
 
         return model
 
-    def data_generator(self):
+    def data_generator(self, image_size=None):
         """[Generate train and val data generators]
 
+        Keyword Arguments:
+            image_size {[int]} -- [size the images are resized to, full resolution if None] (default: {None})
+
         Returns:
             [tuple(ImageDataGenerator)] -- [train and val image datagenerator]
         """
+        image_size = image_size or self.image_size
         train_aug = ImageDataGenerator(rescale=1./255,
                                        shear_range=0.2,
                                        zoom_range=0.2,
                                        horizontal_flip=False)  # TODO: do we need apply imagenet mean and std.
         val_aug = ImageDataGenerator(rescale=1./255)
 
-        train_datagen = train_aug.flow_from_dataframe(self.train_df,
+        # every worker reads its own part of the data in batches for its local replicas
+        train_datagen = train_aug.flow_from_dataframe(distribute.shard_dataframe(self.train_df),
                                                      directory=None,  # can be none if x_col is full image path
-                                                     x_col=self.train_df["Image Path"],
+                                                     x_col="Image Path",
                                                      y_col=config.CLASS_NAMES,
                                                      target_size=(
-                                                         224, 224),
-                                                     class_mode='categorical',
-                                                     batch_size=config.BATCH_SIZE,
-                                                     shuffle=True)
+                                                         image_size, image_size),
+                                                     class_mode='raw',
+                                                     batch_size=self.batch_size,
+                                                     shuffle=True,
+                                                     seed=config.SEED + distribute.get_cluster_spec()[0])
 
-        val_datagen = val_aug.flow_from_dataframe(self.val_df,
+        val_datagen = val_aug.flow_from_dataframe(distribute.shard_dataframe(self.val_df),
                                                  directory=None,
-                                                 x_col=self.train_df["Image Path"],
+                                                 x_col="Image Path",
                                                  y_col=config.CLASS_NAMES,
                                                  target_size=(
-                                                     224, 224),
-                                                 class_mode='categorical',
-                                                 batch_size=config.BATCH_SIZE,
+                                                     image_size, image_size),
+                                                 class_mode='raw',
+                                                 batch_size=self.batch_size,
                                                  shuffle=False)
 
         return (train_datagen, val_datagen)
 
-    def callbacks(self):
+    def prepare_dataset(self, dataset):
+        """[hook to transform the training dataset before fitting, e.g. to replace the targets]
+
+        Arguments:
+            dataset {[tf.data.Dataset]} -- [training dataset of (images, labels) batches]
+
+        Returns:
+            [tf.data.Dataset] -- [training dataset]
+        """
+        return dataset
+
+    def callbacks(self, train_datagen=None):
         """[Configure training callbacks]
 
+        Keyword Arguments:
+            train_datagen {[ImageDatagenerator]} -- [train data generator, its position is checkpointed] (default: {None})
+
         Returns:
             [List] -- [list of callbacks]
         """
-        checkpoint = ModelCheckpoint(config.MODEL_PATH,
+        checkpoint = ModelCheckpoint(distribute.worker_path(self.model_path),
                                      monitor='val_loss',
                                      verbose=1,
                                      save_best_only=True,
@@ -99,9 +170,9 @@ class Train():
                                      patience=1,
                                      verbose=1,
                                      mode="min",
-                                     min_lr=config.MIN_LR)
+                                     min_lr=self.min_lr)
 
-        tensorboard = TensorBoard(log_dir=config.LOG_DIR)
+        tensorboard = TensorBoard(log_dir=distribute.worker_path(self.log_dir))
 
         earlyStop = EarlyStopping(monitor='val_loss',
                                   min_delta=0,
@@ -109,13 +180,23 @@ class Train():
                                   verbose=1,
                                   restore_best_weights=True)
 
-        callbacks = [checkpoint, reduceLR, tensorboard, earlyStop]
+        # must stay last so it can reload the state of the callbacks above
+        trainingCheckpoint = TrainingCheckpoint(distribute.worker_path(self.checkpoint_dir),
+                                                datagen=train_datagen,
+                                                callbacks=[checkpoint, reduceLR, earlyStop],
+                                                every=config.CHECKPOINT_EVERY,
+                                                max_to_keep=config.CHECKPOINT_MAX_TO_KEEP,
+                                                seed=config.SEED)
+
+        callbacks = [checkpoint, reduceLR, tensorboard, earlyStop, trainingCheckpoint]
 
         return callbacks
 
     def train(self, model, train_datagen, val_datagen, callbacks):
         """[Train a with the given train configurations,
-            if there is an existed trained model, resume training from where it has stop training.
+            if there is a full training checkpoint, resume training from the epoch it was saved at
+            with the optimizer, callback and data generator state restored.
+            if there is only an existed trained model, resume training from its weights.
             if not create new model and compile it.
             compute class weights to solve the data imbalance.
             fit the train and val generator to the model.
@@ -127,11 +208,30 @@ class Train():
             val_datagen {[ImageDatagenerator]} -- [val data generator]
             callbacks {[List]} -- [list of callbacks]
         """
-        # resume training if prevously trained model exists
-        if os.path.exists(config.MODEL_PATH):
+        trainingCheckpoint = next(
+            (callback for callback in callbacks if isinstance(callback, TrainingCheckpoint)), None)
+        initial_epoch = 0
+
+        # resume training if a full training checkpoint or a prevously trained model exists
+        if trainingCheckpoint is not None and tf.train.latest_checkpoint(trainingCheckpoint.checkpoint_dir):
+            print("[INFO] compile the model")
+            with self.strategy.scope():
+                model.compile(optimizer=Adam(learning_rate=self.initial_lr),
+                              loss="binary_crossentropy",
+                              metrics=["accuracy"])
+            initial_epoch = trainingCheckpoint.restore(model)
+        elif os.path.exists(self.model_path):
             # load trained model
             print("[INFO] load trained model...")
-            model = load_model(config.MODEL_PATH)
+            with self.strategy.scope():
+                if self.progressive_schedule or tf.keras.mixed_precision.global_policy().name != "float32":
+                    # the saved model is the exported float32 224x224 one, only its weights fit
+                    model.set_weights(load_model(self.model_path, compile=False).get_weights())
+                    model.compile(optimizer=Adam(learning_rate=self.initial_lr),
+                                  loss="binary_crossentropy",
+                                  metrics=["accuracy"])
+                else:
+                    model = load_model(self.model_path)
         else:
             print("[INFO] create new model...")
             # make directories to store the training outputs,.
@@ -140,47 +240,117 @@ class Train():
             #     os.makedirs(ouput_path)
 
             # model = self.build_model()
+            # under a strategy keras scales the loss by the global batch size,
+            # so the per-replica gradients sum up to the global gradient
             print("[INFO] compile the model")
-            model.compile(optimizer=Adam(lr=config.INTIAL_LR),
-                          loss="binary_crossentropy",
-                          metrics=["accuracy"])
+            with self.strategy.scope():
+                model.compile(optimizer=Adam(learning_rate=self.initial_lr),
+                              loss="binary_crossentropy",
+                              metrics=["accuracy"])
 
-        # compute class weights
+        # compute class weights, applied as sample weights of the training dataset
         class_weight = utils.compute_class_weight(
             self.train_df, config.CLASS_NAMES)
 
-        # check multiple gpu availability
-        # TODO: how to train model on multiple gpu?
-        # gpus = os.getenv("CUDA_VISIBLE_DEVICES", "1").split(",")
-        gpus = tf.config.experimental.list_physical_devices("GPU")
-        if len(gpus) > 1:
-            print(f"[INFO] multi_gpu_model is used! gpus={gpus}")
-            model = multi_gpu_model(model, gpus)
-        else:
-            print("[INFO] there is no gpu in this device")
-
-        # fit the train and validation datagen to the model
-        print("[INFO] training the model..")
-        model.fit(train_datagen,
-                  epochs=config.EPOCHS,
-                  verbose=1,
-                  callbacks=callbacks,
-                  # TODO: need to be tuple (x_val, y_vall)
-                  validation_data=val_datagen,
-                  shuffle=True,
-                  class_weight=class_weight,
-                  steps_per_epoch=self.train_steps,
-                  validation_steps=self.val_steps
-                  )
-
-        # save trained model explicitly
+        # fit every stage of the schedule at its resolution, the epoch count and
+        # the position in the training data carry over from one stage to the next
+        trained_size = None
+        for (image_size, last_epoch) in self.stages():
+            if last_epoch <= initial_epoch:
+                continue
+            # the best val_loss of a lower resolution is not reachable at this one,
+            # checkpointing and early stopping start over from the first epoch of the stage
+            if trained_size is not None and trained_size != image_size:
+                rebase_callbacks(callbacks)
+            if trainingCheckpoint is not None:
+                trainingCheckpoint.image_size = image_size
+            if train_datagen.target_size != (image_size, image_size):
+                # the generator runs ahead of training by the batches tf.data prefetched,
+                # the training checkpoint counts the batches that were trained on
+                total_batches_seen = (trainingCheckpoint.batches_seen if trainingCheckpoint is not None
+                                      else train_datagen.total_batches_seen)
+                (train_datagen, val_datagen) = self.data_generator(image_size)
+                train_datagen.total_batches_seen = total_batches_seen
+                if trainingCheckpoint is not None:
+                    trainingCheckpoint.datagen = train_datagen
+
+            # feed the generators through tf.data so the strategy can distribute them
+            target_size = (image_size, image_size)
+            train_dataset = distribute.distribute_dataset(self.strategy, self.prepare_dataset(
+                distribute.to_dataset(train_datagen, len(config.CLASS_NAMES), target_size)),
+                self.per_replica_batch_size, class_weight=class_weight)
+            val_dataset = distribute.distribute_dataset(
+                self.strategy, distribute.to_dataset(val_datagen, len(config.CLASS_NAMES), target_size),
+                self.per_replica_batch_size)
+
+            # fit the train and validation datagen to the model
+            print(f"[INFO] training the model on {self.strategy.num_replicas_in_sync} replica(s), "
+                  f"worker batch size {self.batch_size}, {image_size}x{image_size} images "
+                  f"up to epoch {last_epoch}..")
+            model.fit(train_dataset,
+                      epochs=last_epoch,
+                      initial_epoch=initial_epoch,
+                      verbose=1,
+                      callbacks=callbacks,
+                      # TODO: need to be tuple (x_val, y_vall)
+                      validation_data=val_dataset,
+                      shuffle=True,
+                      steps_per_epoch=self.train_steps,
+                      validation_steps=self.val_steps
+                      )
+            initial_epoch = last_epoch
+            trained_size = image_size
+
+            # every fit starts with stop_training reset, an early stop has to end the schedule here
+            if model.stop_training:
+                print(f"[INFO] early stopping at {image_size}x{image_size}, skipping the remaining stages")
+                break
+
+        # save trained model explicitly, every worker has to take part in the save
         print("[INFO] save the trained model")
-        model.save(config.MODEL_PATH)
+        self.export_model(model).save(distribute.worker_path(self.model_path))
+
+    def export_model(self, model):
+        """[the model as it is served: float32 with a fixed full resolution input,
+            rebuilt with the trained weights when it was trained progressively or
+            under a mixed precision policy]
+
+        Arguments:
+            model {[Model]} -- [trained keras model]
+
+        Returns:
+            [Model] -- [model to save]
+        """
+        policy = tf.keras.mixed_precision.global_policy()
+        if not self.progressive_schedule and policy.name == "float32":
+            return model
+
+        tf.keras.mixed_precision.set_global_policy("float32")
+        export_model = self.build_model(weights=None, input_size=self.image_size)
+        export_model.set_weights(model.get_weights())
+        tf.keras.mixed_precision.set_global_policy(policy)
+        return export_model
 
 
 if __name__ == "__main__":
+    # define argument parser and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--progressive", action="store_true",
+                    help="train the first epochs at lower resolutions (config.PROGRESSIVE_SCHEDULE)")
+    ap.add_argument("--precision", default=config.PRECISION, choices=precision.PRECISIONS,
+                    help="mixed_bfloat16 falls back to float32 on cpus without bfloat16 support")
+    args = vars(ap.parse_args())
+
+    # pick the distribution strategy before tensorflow initializes its devices
+    strategy = distribute.get_strategy(cpu_replicas=config.CPU_REPLICAS)
+
+    # the precision policy has to be set before the model is built
+    precision.set_precision(args["precision"])
+
     # create and initialize Train object
-    train = Train()
+    train = Train(strategy)
+    if args["progressive"]:
+        train.progressive_schedule = config.PROGRESSIVE_SCHEDULE
 
     # build the model
     model = train.build_model(show_summary=True)
@@ -189,7 +359,7 @@ if __name__ == "__main__":
     (train_datagen, val_datagen) = train.data_generator()
 
     # training callbacks
-    callbacks = train.callbacks()
+    callbacks = train.callbacks(train_datagen)
 
     # train the modela
     train.train(model, train_datagen, val_datagen, callbacks)
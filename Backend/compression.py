@@ -0,0 +1,44 @@
+import os
+import gzip
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response compression for JSON and text bodies: brotli when the client accepts it
+# and the brotli package is installed, gzip otherwise. Streamed responses (server-sent
+# events) and small bodies are left alone
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_MIMETYPES = {'application/json', 'text/plain', 'text/csv'}
+
+def accepted_encodings(header):
+    """Encodings of an Accept-Encoding header, without those refused with q=0"""
+    encodings = set()
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+def compress_response(response):
+    """after_request hook"""
+    if (response.direct_passthrough or response.is_streamed or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    encodings = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    if brotli is not None and 'br' in encodings:
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in encodings:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
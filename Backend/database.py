@@ -1,6 +1,11 @@
 import os
-from pymongo import MongoClient
+import datetime
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+from bson import ObjectId
+from bson.errors import InvalidId
 from dotenv import load_dotenv
+import scan_stats
 
 # Load environment variables
 load_dotenv()
@@ -15,6 +20,7 @@ class MongoDB:
         self.db = None
         self.users = None
         self.scans = None
+        self.scan_stats = None
         self.connect()
     
     def connect(self):
@@ -23,12 +29,22 @@ class MongoDB:
             self.db = self.client[MONGODB_DB]
             self.users = self.db.users
             self.scans = self.db.scans
+            self.scan_stats = self.db.scan_stats
             print(f"Connected to MongoDB at {MONGODB_URI}")
+            self.ensure_indexes()
             return True
         except Exception as e:
             print(f"MongoDB connection error: {e}")
             return False
     
+    def ensure_indexes(self):
+        """Indexes of the per-user scan queries, creating an existing index is a no-op"""
+        try:
+            # the user's scans in _id order: export, history events after a scan
+            self.scans.create_index([('user_email', 1), ('_id', -1)])
+        except Exception as e:
+            print(f"Error creating indexes: {e}")
+    
     def disconnect(self):
         if self.client:
             self.client.close()
@@ -67,15 +83,164 @@ class MongoDB:
             print(f"Error saving scan: {e}")
             return None
     
-    def get_user_scans(self, email, limit=10):
+    def get_user_scans(self, email, limit=10, projection=None):
         try:
             return list(self.scans.find(
-                {'user_email': email}
+                {'user_email': email}, projection
             ).sort('date', -1).limit(limit))
         except Exception as e:
             print(f"Error getting user scans: {e}")
             return []
     
+    def iter_user_scans(self, email, projection=None, batch_size=500):
+        """Cursor over all the user's scans, newest first, fetching batch_size at a time"""
+        # _id order is save order and comes from the {user_email, _id} index, sorting
+        # on date would read and sort every scan of the user before the first is returned
+        return self.scans.find({'user_email': email}, projection, batch_size=batch_size).sort('_id', -1)
+    
+    def get_user_scans_after(self, email, scan_id, limit=50, projection=None):
+        """The user's scans saved after scan_id, oldest first"""
+        try:
+            return list(self.scans.find(
+                {'user_email': email, '_id': {'$gt': ObjectId(scan_id)}}, projection
+            ).sort('_id', 1).limit(limit))
+        except InvalidId:
+            return []
+        except Exception as e:
+            print(f"Error getting user scans: {e}")
+            return []
+    
+    def watch_scans(self, pipeline, resume_after=None):
+        """Change stream of the scans collection, raises on a standalone server"""
+        return self.scans.watch(pipeline, resume_after=resume_after)
+    
+    def get_scan(self, scan_id, projection=None):
+        try:
+            return self.scans.find_one({'_id': ObjectId(scan_id)}, projection)
+        except InvalidId:
+            return None
+        except Exception as e:
+            print(f"Error getting scan: {e}")
+            return None
+    
+    def get_scans(self, scan_ids, projection=None):
+        """Scans by id, in the order of scan_ids"""
+        try:
+            ids = [ObjectId(scan_id) for scan_id in scan_ids]
+            scans = {scan['_id']: scan for scan in self.scans.find({'_id': {'$in': ids}}, projection)}
+            return [scans[scan_id] for scan_id in ids if scan_id in scans]
+        except InvalidId:
+            return []
+        except Exception as e:
+            print(f"Error getting scans: {e}")
+            return []
+    
+    def get_scan_embeddings(self, since=None):
+        """Embeddings of the scans saved since a POSIX timestamp, oldest first"""
+        query = {'embedding': {'$exists': True}}
+        if since is not None:
+            query['_id'] = {'$gte': ObjectId.from_datetime(datetime.datetime.fromtimestamp(since, datetime.timezone.utc))}
+        try:
+            return self.scans.find(query, {'embedding': 1, 'user_email': 1}).sort('_id', 1)
+        except Exception as e:
+            print(f"Error getting scan embeddings: {e}")
+            return []
+    
+    def update_scan(self, scan_id, update_data):
+        try:
+            return self.scans.update_one(
+                {'_id': ObjectId(scan_id)},
+                {'$set': update_data}
+            )
+        except Exception as e:
+            print(f"Error updating scan: {e}")
+            return False
+    
+    def record_scan_stats(self, email, date, increments):
+        """Add a scan to the user's daily and all-time rollups"""
+        try:
+            self.scan_stats.bulk_write([
+                UpdateOne({'_id': f'{email}|{day}'},
+                          {'$inc': increments, '$setOnInsert': {'user_email': email, 'day': day}},
+                          upsert=True)
+                for day in (scan_stats.day(date), 'all')
+            ], ordered=False)
+            return True
+        except Exception as e:
+            print(f"Error recording scan stats: {e}")
+            return False
+    
+    def get_scan_stats(self, email, first_day, last_day):
+        """The user's all-time rollup and daily rollups from first_day to last_day"""
+        try:
+            total = self.scan_stats.find_one({'_id': f'{email}|all'})
+            # the _id index serves the range, days sort as strings
+            daily = list(self.scan_stats.find(
+                {'_id': {'$gte': f'{email}|{first_day}', '$lte': f'{email}|{last_day}'}}
+            ).sort('_id', 1))
+            return total, daily
+        except Exception as e:
+            print(f"Error getting scan stats: {e}")
+            return None, []
+    
+    def backfill_scan_stats(self):
+        """Add the uncounted scans to the rollups, returns their number: the scans saved
+        before the rollups existed and those whose rollup update failed in /scan/save.
+        
+        Scans are claimed in batches with the id of the batch (stats_backfill), only the
+        claimed scans are grouped and added, then marked stats_counted. A scan is only
+        claimed once, so concurrent backfills do not count it twice. Batches claimed
+        longer ago than the lease are finished by the next run, live ones are left alone.
+        """
+        lease = datetime.timedelta(seconds=scan_stats.SCAN_STATS_BACKFILL_LEASE_SECONDS)
+        cutoff = ObjectId.from_datetime(datetime.datetime.now(datetime.timezone.utc) - lease)
+        counted = sum(self.apply_scan_stats_backfill(batch_id)
+                      for batch_id in self.scans.distinct('stats_backfill', {'stats_backfill': {'$lt': cutoff}}))
+        unclaimed = {'stats_counted': {'$ne': True}, 'stats_backfill': {'$exists': False}}
+        last = None
+        while True:
+            # walks the _id index once, each batch starts after the last one
+            ids = [scan['_id'] for scan in self.scans.find(
+                {**unclaimed, '_id': {'$lt': cutoff, **({'$gt': last} if last else {})}}, {'_id': 1}
+            ).sort('_id', 1).limit(scan_stats.SCAN_STATS_BACKFILL_BATCH)]
+            if not ids:
+                return counted
+            last = ids[-1]
+            batch_id = ObjectId()
+            self.scans.update_many({**unclaimed, '_id': {'$in': ids}}, {'$set': {'stats_backfill': batch_id}})
+            counted += self.apply_scan_stats_backfill(batch_id)
+    
+    def apply_scan_stats_backfill(self, batch_id):
+        """Add the scans claimed by a backfill batch to the rollups and mark them counted"""
+        rollups = {}
+        for group in self.scans.aggregate(scan_stats.backfill_pipeline({'stats_backfill': batch_id}), allowDiskUse=True):
+            key = group['_id']
+            increments = scan_stats.increments(key.get('disease'), key.get('status'), key['bucket'],
+                                               group['count'], group['confidence_sum'])
+            for day in (key['day'], 'all'):
+                rollup = rollups.setdefault((key.get('user_email'), day), {})
+                for name, value in increments.items():
+                    rollup[name] = rollup.get(name, 0) + value
+        
+        if rollups:
+            # a rollup remembers the batches added to it, a batch that is applied again is skipped
+            try:
+                self.scan_stats.bulk_write([
+                    UpdateOne({'_id': f'{email}|{day}', 'backfills': {'$ne': batch_id}},
+                              {'$inc': increments,
+                               '$push': {'backfills': {'$each': [batch_id],
+                                                       '$slice': -scan_stats.SCAN_STATS_BACKFILL_HISTORY}},
+                               '$setOnInsert': {'user_email': email, 'day': day}},
+                              upsert=True)
+                    for (email, day), increments in rollups.items()
+                ], ordered=False)
+            except BulkWriteError as e:
+                # the upsert of an already updated rollup collides with its _id
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+        return self.scans.update_many({'stats_backfill': batch_id},
+                                      {'$set': {'stats_counted': True}, '$unset': {'stats_backfill': ''}}).modified_count
+    
     def get_health_status(self):
         try:
             # Check if we can connect to MongoDB
@@ -0,0 +1,255 @@
+import io
+import os
+import time
+import numpy as np
+from PIL import Image
+from uploads import UploadError
+
+try:
+    import pydicom
+    from pydicom.encaps import generate_pixel_data_frame
+    from pydicom.multival import MultiValue
+except ImportError:
+    pydicom = None
+
+# DICOM ingestion: the header is parsed without the pixel data, then the stored
+# values are reduced straight to the 224x224 model input. Native 16-bit pixels are
+# block-averaged from a zero-copy view of the pixel data, JPEG frames are decoded
+# by Pillow at a reduced scale (JPEG 2000 at a lower resolution level), and the
+# rescale slope/intercept and the VOI window are applied on the small array only.
+# Other transfer syntaxes (RLE, JPEG-LS...) go through the pydicom pixel handlers
+# that are installed.
+JPEG_BASELINE = {'1.2.840.10008.1.2.4.50', '1.2.840.10008.1.2.4.51'}
+JPEG_2000 = {'1.2.840.10008.1.2.4.90', '1.2.840.10008.1.2.4.91'}
+DEFER_SIZE = '64 KB'  # elements larger than this, the pixel data, are read when used
+
+def is_dicom(fileobj):
+    """True for a DICOM Part 10 file: 'DICM' after the 128 byte preamble"""
+    position = fileobj.tell()
+    fileobj.seek(128)
+    magic = fileobj.read(4)
+    fileobj.seek(position)
+    return magic == b'DICM'
+
+def require_pydicom():
+    if pydicom is None:
+        raise ValueError('DICOM support needs the pydicom package')
+
+def read_header(fileobj):
+    """Header of a DICOM file, the pixel data is not read"""
+    require_pydicom()
+    dataset = pydicom.dcmread(fileobj, stop_before_pixels=True)
+    return describe(dataset)
+
+def first_value(value):
+    return float(value[0] if isinstance(value, MultiValue) else value)
+
+def describe(dataset):
+    header = {
+        'modality': dataset.get('Modality'),
+        'transfer_syntax': str(dataset.file_meta.TransferSyntaxUID),
+        'rows': int(dataset.Rows),
+        'columns': int(dataset.Columns),
+        'bits_stored': int(dataset.get('BitsStored', dataset.BitsAllocated)),
+        'photometric_interpretation': dataset.get('PhotometricInterpretation', 'MONOCHROME2'),
+        'frames': int(dataset.get('NumberOfFrames', 1) or 1),
+        'rescale_slope': float(dataset.get('RescaleSlope', 1) or 1),
+        'rescale_intercept': float(dataset.get('RescaleIntercept', 0) or 0)
+    }
+    if 'WindowCenter' in dataset and 'WindowWidth' in dataset:
+        header['window_center'] = first_value(dataset.WindowCenter)
+        header['window_width'] = first_value(dataset.WindowWidth)
+    return header
+
+def block_mean(pixels, size):
+    """Average integer blocks down to at most 2x the target size without a full size float copy"""
+    factor_y = max(1, pixels.shape[0] // (2 * size[1]))
+    factor_x = max(1, pixels.shape[1] // (2 * size[0]))
+    rows = pixels.shape[0] // factor_y * factor_y
+    columns = pixels.shape[1] // factor_x * factor_x
+    blocks = pixels[:rows, :columns].reshape(rows // factor_y, factor_y, columns // factor_x, factor_x)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+def native_pixels(dataset, header):
+    """Zero-copy view of the first frame of uncompressed pixel data"""
+    signed = int(dataset.get('PixelRepresentation', 0)) == 1
+    dtypes = {8: np.int8 if signed else np.uint8, 16: np.int16 if signed else np.uint16}
+    if int(dataset.BitsAllocated) not in dtypes:
+        raise UploadError(f"Unsupported DICOM BitsAllocated {int(dataset.BitsAllocated)}, expected 8 or 16", 415)
+    dtype = dtypes[int(dataset.BitsAllocated)]
+    if int(dataset.get('SamplesPerPixel', 1)) != 1:
+        return None
+    count = header['rows'] * header['columns']
+    pixels = np.frombuffer(dataset.PixelData, dtype=dtype, count=count).reshape(header['rows'], header['columns'])
+    if not dataset.file_meta.TransferSyntaxUID.is_little_endian:
+        pixels = pixels.byteswap()
+    if not signed and header['bits_stored'] < pixels.dtype.itemsize * 8:
+        pixels = pixels & np.array((1 << header['bits_stored']) - 1, dtype=pixels.dtype)
+    return pixels
+
+def compressed_pixels(dataset, header, size):
+    """First frame of a JPEG or JPEG 2000 encoded file, decoded by Pillow at a reduced scale"""
+    frame = next(generate_pixel_data_frame(dataset.PixelData, header['frames']))
+    image = Image.open(io.BytesIO(frame))
+    if header['transfer_syntax'] in JPEG_2000:
+        # each resolution level halves the size, stop at twice the target size
+        levels = 0
+        while min(image.size) >> (levels + 1) >= 2 * min(size):
+            levels += 1
+        image.reduce = levels
+    else:
+        image.draft(None, (2 * size[0], 2 * size[1]))
+    image.load()
+    pixels = np.asarray(image)
+    return pixels.mean(axis=2, dtype=np.float32) if pixels.ndim == 3 else pixels
+
+def load(fileobj, size=(224, 224)):
+    """Model input (1, h, w, 3) float32 in [0, 1] of a DICOM file and its header"""
+    require_pydicom()
+    # pydicom reads deferred elements by reopening the file, which needs a path
+    name = getattr(fileobj, 'name', None)
+    deferrable = isinstance(name, str) and os.path.isfile(name)
+    dataset = pydicom.dcmread(fileobj, defer_size=DEFER_SIZE if deferrable else None)
+    header = describe(dataset)
+
+    pixels = None
+    if header['transfer_syntax'] in JPEG_BASELINE | JPEG_2000:
+        try:
+            pixels = compressed_pixels(dataset, header, size)
+        except (OSError, ValueError):
+            pixels = None  # e.g. 12-bit JPEG, left to the pydicom handlers
+    elif not dataset.file_meta.TransferSyntaxUID.is_compressed:
+        pixels = native_pixels(dataset, header)
+    if pixels is None:
+        try:
+            pixels = dataset.pixel_array
+        except (NotImplementedError, RuntimeError) as e:
+            raise ValueError(f"No decoder for transfer syntax {header['transfer_syntax']}: {e}")
+        pixels = pixels[0] if header['frames'] > 1 else pixels
+        pixels = pixels.mean(axis=2, dtype=np.float32) if pixels.ndim == 3 else pixels
+
+    # reduce first: rescale and window are per pixel and cheaper on the small array
+    # (averaging before the window clip only differs on edges crossing the window bounds)
+    reduced = block_mean(pixels, size)
+    values = reduced * header['rescale_slope'] + header['rescale_intercept']
+    if 'window_center' in header:
+        low = header['window_center'] - header['window_width'] / 2
+        high = header['window_center'] + header['window_width'] / 2
+    else:
+        low, high = np.percentile(values, [0.5, 99.5])
+    values = np.clip((values - low) / max(high - low, 1e-6), 0., 1.)
+    if header['photometric_interpretation'] == 'MONOCHROME1':
+        values = 1. - values
+
+    resized = np.asarray(Image.fromarray(values.astype(np.float32)).resize(size, Image.BILINEAR))
+    x = np.repeat(np.clip(resized, 0., 1.)[None, :, :, None], 3, axis=3)
+    return x, header
+
+def to_image(x):
+    """8-bit RGB image of a model input, for the quality check and previews"""
+    return Image.fromarray((x[0] * 255).round().astype(np.uint8))
+
+def synthetic_study(path, size, transfer_syntax, seed_path='test_image.jpg'):
+    """Write a 12-bit CR-like DICOM file made from the seed image, for the benchmark"""
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid
+
+    seed = Image.open(seed_path).convert('L').resize((size, size), Image.BILINEAR)
+    pixels = (np.asarray(seed, dtype=np.uint16) * 16).astype(np.uint16)  # 12-bit stored values
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1'  # computed radiography
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.SOPClassUID, ds.SOPInstanceUID = meta.MediaStorageSOPClassUID, meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'CR'
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+    ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+    ds.WindowCenter, ds.WindowWidth = 1000, 3600
+    ds.PixelData = pixels.tobytes()
+
+    if transfer_syntax == 'rle':
+        ds.compress(RLELossless)
+    elif transfer_syntax == 'jpeg2000':
+        from pydicom.encaps import encapsulate
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format='JPEG2000', irreversible=False)
+        ds.PixelData = encapsulate([buffer.getvalue()])
+        ds.BitsStored, ds.HighBit = 16, 15  # Pillow writes a 16-bit codestream
+        ds['PixelData'].is_undefined_length = True
+        ds.file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.4.90'
+    ds.save_as(path, write_like_original=False)
+
+def png_path(path, size=(224, 224)):
+    """The current path: convert the study to an 8-bit PNG upstream, then decode it like /predict"""
+    dataset = pydicom.dcmread(path)
+    header = describe(dataset)
+    values = dataset.pixel_array * header['rescale_slope'] + header['rescale_intercept']
+    low = header['window_center'] - header['window_width'] / 2
+    values = np.clip((values - low) / header['window_width'] * 255, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(values).save(buffer, format='PNG')
+    converted = time.perf_counter()
+
+    buffer.seek(0)
+    image = Image.open(buffer).convert('RGB').resize(size)
+    x = np.expand_dims(np.array(image) / 255.0, axis=0)
+    return x, converted
+
+if __name__ == "__main__":
+    import json
+    import tempfile
+    import argparse
+    ap = argparse.ArgumentParser(description='direct DICOM decoding versus converting to PNG first')
+    ap.add_argument('--sizes', type=int, nargs='+', default=[2048, 3000, 4096], help='study sides in pixels')
+    ap.add_argument('--syntaxes', nargs='+', default=['native', 'rle', 'jpeg2000'])
+    ap.add_argument('--runs', type=int, default=5)
+    ap.add_argument('--output', default='output/dicom_benchmark.json')
+    args = ap.parse_args()
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix='dicom-')
+    for size in args.sizes:
+        for syntax in args.syntaxes:
+            path = os.path.join(workdir, f'{syntax}_{size}.dcm')
+            try:
+                synthetic_study(path, size, syntax)
+            except Exception as e:
+                print(f"{syntax} {size}: cannot encode ({e}), skipped")
+                continue
+
+            (direct, convert, png) = ([], [], [])
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                with open(path, 'rb') as f:
+                    x_direct, _ = load(f)
+                direct.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                x_png, converted = png_path(path)
+                convert.append(converted - start)
+                png.append(time.perf_counter() - start)
+
+            result = {
+                'size': size,
+                'transfer_syntax': syntax,
+                'file_mb': os.path.getsize(path) / 2 ** 20,
+                'direct_ms': float(np.median(direct) * 1000),
+                'png_convert_ms': float(np.median(convert) * 1000),
+                'png_total_ms': float(np.median(png) * 1000),
+                # difference to the 8-bit PNG path, which loses the 12-bit precision
+                'max_abs_difference': float(np.abs(x_direct - x_png).max())
+            }
+            results.append(result)
+            print(f"{syntax:<9} {size:>5}px {result['file_mb']:6.1f} MB direct: {result['direct_ms']:7.1f} ms "
+                  f"png: {result['png_total_ms']:7.1f} ms (convert {result['png_convert_ms']:.1f} ms) "
+                  f"speedup: {result['png_total_ms'] / result['direct_ms']:.1f}x")
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,57 @@
+import os
+import gc
+import sys
+import signal
+
+# Pre-fork serving: gunicorn -c gunicorn.conf.py app_mongodb:app
+#   PREFORK_MODE=model   the master imports the app, so TensorFlow and the model
+#                        weights are loaded once and shared copy-on-write by the workers
+#   PREFORK_MODE=import  the master only imports tensorflow, every worker loads the model
+#   PREFORK_MODE=off     every worker imports everything itself
+PREFORK_MODE = os.getenv('PREFORK_MODE', 'model')
+PREFORK_CHECK_TIMEOUT = int(os.getenv('PREFORK_CHECK_TIMEOUT', '30'))
+os.environ['PREFORK_MODE'] = PREFORK_MODE  # read by the app to defer its threads
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+preload_app = PREFORK_MODE == 'model'
+
+if PREFORK_MODE == 'import':
+    # importing does not start the TensorFlow runtime, so this is always fork safe
+    import tensorflow
+
+def app_module(server):
+    return sys.modules[server.app.app_uri.split(':')[0]]
+
+def check_fork_safety(model):
+    """Run one prediction in a forked child: TensorFlow thread pools started in the
+    master do not exist in a child, which then hangs or crashes instead of predicting"""
+    import numpy as np
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)  # kills the child even inside TensorFlow
+        signal.alarm(PREFORK_CHECK_TIMEOUT)
+        try:
+            model.predict(np.zeros((1, *model.input_shape[1:]), dtype=np.float32))
+            os._exit(0)
+        except Exception:
+            os._exit(1)
+    _, status = os.waitpid(pid, 0)
+    return os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+def when_ready(server):
+    if not preload_app:
+        return
+    if not check_fork_safety(app_module(server).model):
+        server.log.error("TensorFlow is not usable after fork with this build, "
+                         "run with PREFORK_MODE=import or PREFORK_MODE=off")
+        server.halt(exit_status=1)
+    # keep the garbage collector from writing to (and so copying) the shared objects
+    gc.freeze()
+    server.log.info("Model loaded in the master, workers share it copy-on-write")
+
+def post_fork(server, worker):
+    if preload_app:
+        app_module(server).after_fork()
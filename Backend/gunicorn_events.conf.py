@@ -0,0 +1,21 @@
+import os
+
+# The dashboards' event stream: gunicorn -c gunicorn_events.conf.py scan_events_app:app
+# An open stream waits on its connection for as long as the dashboard is open. On the
+# thread workers of gunicorn.conf.py each would hold one of the workers * threads
+# request slots (16 by default), so a few dashboards would starve /predict. gevent
+# workers hold a stream as a greenlet, up to worker_connections of them per worker.
+# Route /scan/events of the public address here (see README-SETUP.md); the new scans
+# reach this server through the MongoDB change stream, so it needs a replica set
+bind = os.getenv('EVENTS_BIND', '0.0.0.0:5001')
+workers = int(os.getenv('EVENTS_WORKERS', '1'))
+worker_class = 'gevent'
+worker_connections = int(os.getenv('EVENTS_WORKER_CONNECTIONS', '1000'))
+# the keep-alive comments of an idle stream are the only traffic, a stream is not a slow request
+timeout = int(os.getenv('EVENTS_TIMEOUT', '60'))
+
+def post_worker_init(worker):
+    # after the gevent patching of the worker, so the change stream thread is a greenlet
+    import scan_events_app
+    from database import db
+    scan_events_app.scan_events.start(db.watch_scans)
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
+# the augmented views are shared with the training scripts (chest_xray/benchmark_tta.py)
+from chest_xray.helper.tta import TTA_BOXES, tta_views
+
+# Cascade configuration: a small fast model (e.g. the distilled student from
+# chest_xray/distill.py) scores every image first, and the full model only runs
+# when one of the fast model's probabilities falls inside the uncertainty band
+CASCADE_MODEL_PATH = os.getenv('CASCADE_MODEL_PATH', '')
+CASCADE_LOW = float(os.getenv('CASCADE_LOW', '0.2'))
+CASCADE_HIGH = float(os.getenv('CASCADE_HIGH', '0.8'))
+
+def load_cascade_model():
+    if CASCADE_MODEL_PATH and os.path.exists(CASCADE_MODEL_PATH):
+        cascade_model = tf.keras.models.load_model(CASCADE_MODEL_PATH, compile=False)
+        print(f"Cascade model loaded from {CASCADE_MODEL_PATH}")
+        return cascade_model
+    if CASCADE_MODEL_PATH:
+        print("Warning: cascade disabled - cascade model not found at", CASCADE_MODEL_PATH)
+    return None
+
+cascade_model = load_cascade_model()
+
+# Ensemble: ENSEMBLE_MODEL_PATHS is a comma separated list of extra models (e.g. a
+# retrained variant of LuNet.h5) that score the same preprocessed input as the full
+# model. The members run concurrently on threads, TensorFlow releases the GIL while
+# a model runs, and their probabilities are combined with ENSEMBLE_WEIGHTS, one
+# weight per model starting with the full model (equal weights by default)
+ENSEMBLE_MODEL_PATHS = [path.strip() for path in os.getenv('ENSEMBLE_MODEL_PATHS', '').split(',') if path.strip()]
+ENSEMBLE_WEIGHTS = [float(weight) for weight in os.getenv('ENSEMBLE_WEIGHTS', '').split(',') if weight.strip()]
+ENSEMBLE_PARALLEL = os.getenv('ENSEMBLE_PARALLEL', '1') != '0'
+
+def load_ensemble_models():
+    members = []
+    for path in ENSEMBLE_MODEL_PATHS:
+        if os.path.exists(path):
+            members.append((os.path.splitext(os.path.basename(path))[0],
+                            tf.keras.models.load_model(path, compile=False)))
+            print(f"Ensemble model loaded from {path}")
+        else:
+            print("Warning: ensemble member skipped - model not found at", path)
+    return members
+
+ensemble_models = load_ensemble_models()
+if ensemble_models and len(ENSEMBLE_WEIGHTS) not in (0, len(ensemble_models) + 1):
+    print(f"Warning: {len(ENSEMBLE_WEIGHTS)} ensemble weights for {len(ensemble_models) + 1} models, "
+          "using equal weights")
+
+def ensemble_weights(count):
+    """Normalized member weights, equal weights when ENSEMBLE_WEIGHTS does not match"""
+    weights = np.array(ENSEMBLE_WEIGHTS if len(ENSEMBLE_WEIGHTS) == count else [1.] * count)
+    return weights / weights.sum()
+
+ensemble_executor = None
+ensemble_executor_pid = None
+
+def get_ensemble_executor(workers):
+    """The member thread pool of this process; threads do not survive a fork, so a
+    pre-forked worker makes its own"""
+    global ensemble_executor, ensemble_executor_pid
+    if ensemble_executor is None or ensemble_executor_pid != os.getpid():
+        ensemble_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ensemble')
+        ensemble_executor_pid = os.getpid()
+    return ensemble_executor
+
+def timed_predict(model, x):
+    start = time.perf_counter()
+    preds = model.predict(x, batch_size=len(x))
+    return preds, time.perf_counter() - start
+
+def full_predict(model, x, members=None, parallel=None):
+    """Predictions of the full model, or of the weighted ensemble of the full model
+    and the ensemble members when they are configured, for a batch x.
+
+    The members share the preprocessed x. Returns the predictions and the ensemble
+    metadata with the timing of every member (None without members).
+    """
+    members = ensemble_models if members is None else members
+    parallel = ENSEMBLE_PARALLEL if parallel is None else parallel
+    if not members:
+        return model.predict(x, batch_size=len(x)), None
+
+    models = [("full", model)] + list(members)
+    start = time.perf_counter()
+    if parallel:
+        executor = get_ensemble_executor(len(models))
+        results = [future.result() for future in
+                   [executor.submit(timed_predict, member, x) for _, member in models]]
+    else:
+        results = [timed_predict(member, x) for _, member in models]
+    wall = time.perf_counter() - start
+
+    weights = ensemble_weights(len(models))
+    preds = sum(weight * member_preds for weight, (member_preds, _) in zip(weights, results))
+    return preds, {
+        "execution": "parallel" if parallel else "sequential",
+        "wall_seconds": wall,
+        "members": [{
+            "name": name,
+            "weight": float(weight),
+            "seconds": seconds,
+            "probabilities": [float(p) for p in member_preds[0]]
+        } for (name, _), weight, (member_preds, seconds) in zip(models, weights, results)]
+    }
+
+# Test-time augmentation: K views of the image run through the full model as a
+# single batch. TTA runs when a request asks for it (tta=K) or, if
+# TTA_CONFIDENCE_THRESHOLD is set, when the top probability is below it
+TTA_MAX_K = int(os.getenv('TTA_MAX_K', '8'))
+TTA_DEFAULT_K = int(os.getenv('TTA_DEFAULT_K', '4'))
+TTA_CONFIDENCE_THRESHOLD = float(os.getenv('TTA_CONFIDENCE_THRESHOLD', '0'))
+
+# Output classes of the served model, in the order of its probabilities
+CLASS_NAMES = ["Normal", "Pneumonia", "Tuberculosis"]
+
+# Calibration file written by chest_xray/calibrate.py: per-class temperatures,
+# decision thresholds and confidence cutoffs fitted on the validation split
+CALIBRATION_PATH = os.getenv('CALIBRATION_PATH', 'output/calibration.json')
+
+def load_calibration():
+    if os.path.exists(CALIBRATION_PATH):
+        with open(CALIBRATION_PATH) as f:
+            calibration = json.load(f)
+        if calibration.get("class_names") != CLASS_NAMES:
+            print(f"Calibration {CALIBRATION_PATH} ignored: fitted for classes "
+                  f"{calibration.get('class_names')}, the model predicts {CLASS_NAMES}")
+            return None
+        print(f"Calibration loaded from {CALIBRATION_PATH}")
+        return {
+            "temperature": np.array(calibration["temperature"]),
+            "thresholds": np.array(calibration["thresholds"]),
+            "confidence_cutoffs": calibration.get("confidence_cutoffs", [0.4, 0.7])
+        }
+    return None
+
+calibration = load_calibration()
+
+def calibrate(pred):
+    """Apply the per-class temperatures, when a calibration for the model classes is loaded"""
+    if calibration is None:
+        return pred
+    p = np.clip(pred, 1e-7, 1 - 1e-7)
+    return 1 / (1 + np.exp(-np.log(p / (1 - p)) / calibration["temperature"]))
+
+def decide(pred):
+    """Pick the predicted class and its confidence level.
+
+    With a calibration the class with the largest margin over its own threshold
+    wins, otherwise the most probable class (argmax) with fixed 0.4/0.7 cutoffs.
+    """
+    if calibration is not None:
+        predicted_class_idx = int(np.argmax(pred - calibration["thresholds"]))
+        (medium, high) = calibration["confidence_cutoffs"]
+    else:
+        predicted_class_idx = int(np.argmax(pred))
+        (medium, high) = (0.4, 0.7)
+    confidence = float(pred[predicted_class_idx])
+    confidence_level = "High" if confidence > high else "Medium" if confidence > medium else "Low"
+    return predicted_class_idx, confidence, confidence_level
+
+def is_uncertain(pred, low=CASCADE_LOW, high=CASCADE_HIGH):
+    """True when any class probability is inside the [low, high] uncertainty band"""
+    return bool(np.any((pred >= low) & (pred <= high)))
+
+def tta_predict(model, x, k, base_pred=None):
+    """Average the predictions over k views, run as a single batch.
+
+    base_pred is the full model prediction on the unmodified image when it is
+    already known, then only the k-1 augmented views are run.
+    """
+    if base_pred is not None and k <= 1:
+        return base_pred, {"views": 1, "probability_std": [0.] * len(base_pred)}, {}
+    views = tta_views(x, k, first_view=0 if base_pred is None else 1)
+    preds, ensemble_metadata = full_predict(model, views)
+    if base_pred is not None:
+        preds = np.concatenate([base_pred[None], preds])
+    return preds.mean(axis=0), {
+        "views": k,
+        "probability_std": [float(p) for p in preds.std(axis=0)]
+    }, ensemble_metadata
+
+def run_model(model, x, use_cascade=True, tta=None):
+    """Run the full model, or the cascade when a fast model is configured,
+    followed by test-time augmentation when requested or when unconfident.
+
+    The full model is the weighted ensemble when ENSEMBLE_MODEL_PATHS is set.
+    Returns the probabilities of the first image in the batch and the metadata
+    describing the decision path, to be merged into analysis_metadata.
+    """
+    if tta and tta > 1:
+        pred, tta_metadata, ensemble_metadata = tta_predict(model, x, min(tta, TTA_MAX_K, len(TTA_BOXES)))
+        metadata = {"inference_path": ["tta"], "tta": tta_metadata}
+        if ensemble_metadata:
+            metadata["ensemble"] = ensemble_metadata
+        return pred, metadata
+
+    metadata = {}
+    if cascade_model is None or not use_cascade:
+        preds, metadata["ensemble"] = full_predict(model, x)
+        pred = preds[0]
+        metadata["inference_path"] = ["full"]
+    else:
+        fast_pred = cascade_model.predict(x)[0]
+        escalated = is_uncertain(fast_pred)
+        if escalated:
+            preds, metadata["ensemble"] = full_predict(model, x)
+            pred = preds[0]
+        else:
+            pred = fast_pred
+        metadata["inference_path"] = ["fast", "full"] if escalated else ["fast"]
+        metadata["cascade"] = {
+            "escalated": escalated,
+            "uncertainty_band": [CASCADE_LOW, CASCADE_HIGH],
+            "fast_probabilities": [float(p) for p in fast_pred]
+        }
+
+    if TTA_CONFIDENCE_THRESHOLD and float(np.max(pred)) < TTA_CONFIDENCE_THRESHOLD:
+        base_pred = pred if metadata["inference_path"][-1] == "full" else None
+        k = min(TTA_DEFAULT_K, TTA_MAX_K, len(TTA_BOXES))
+        pred, metadata["tta"], _ = tta_predict(model, x, k, base_pred=base_pred)
+        metadata["inference_path"].append("tta")
+
+    if not metadata.get("ensemble"):
+        metadata.pop("ensemble", None)
+    return pred, metadata
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import threading
+
+# Job queue configuration: a SQLite file stands in for a message broker, so
+# queued jobs and results survive a restart of the server
+JOBS_DB_PATH = os.getenv('JOBS_DB_PATH', 'output/jobs.sqlite3')
+JOBS_SPOOL_DIR = os.getenv('JOBS_SPOOL_DIR', 'output/jobs')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', '600'))
+
+# lower runs first; suspected diseases jump the queue
+PRIORITIES = {'urgent': 0, 'high': 1, 'normal': 2, 'low': 3}
+SUSPECTED_PRIORITY = {'Tuberculosis': 0, 'Pneumonia': 1}
+
+def job_priority(form):
+    """Priority of a new job from the 'priority' and 'suspected' form fields"""
+    priority = PRIORITIES.get(form.get('priority', 'normal'), PRIORITIES['normal'])
+    return min(priority, SUSPECTED_PRIORITY.get(form.get('suspected'), priority))
+
+class JobQueue:
+    def __init__(self, handler, db_path=JOBS_DB_PATH, spool_dir=JOBS_SPOOL_DIR, workers=JOB_WORKERS):
+        """handler(fileobj, options) analyzes one image and returns a JSON serializable dict"""
+        self.handler = handler
+        self.db_path = db_path
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.condition = threading.Condition()
+        self.threads = []
+        self.init_db()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def init_db(self):
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL,
+            payload TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            owner TEXT)''')
+        # tables created before jobs had an owner
+        if 'owner' not in [row['name'] for row in conn.execute('PRAGMA table_info(jobs)')]:
+            conn.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created)')
+        conn.close()
+
+    def enqueue(self, files, options, priority=PRIORITIES['normal'], owner=None):
+        """Spool the uploaded files to disk and queue one job for all of them,
+        owner is the user allowed to read it (None: anyone with the job id)"""
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.spool_dir, job_id)
+        os.makedirs(job_dir)
+        paths = []
+        for i, file in enumerate(files):
+            path = os.path.join(job_dir, str(i))
+            file.save(path)
+            paths.append(path)
+
+        payload = json.dumps({'files': paths, 'filenames': [file.filename for file in files], 'options': options})
+        conn = self.connect()
+        conn.execute("INSERT INTO jobs (id, status, priority, created, payload, owner) VALUES (?, 'queued', ?, ?, ?, ?)",
+                     (job_id, priority, time.time(), payload, owner))
+        conn.close()
+        with self.condition:
+            self.condition.notify_all()
+        return job_id
+
+    def claim(self):
+        """Atomically take the most urgent, oldest queued job"""
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # jobs left running by a crashed worker, or a crashed server, go back to the
+            # queue once they have run for JOB_STALE_SECONDS, checked on every claim
+            conn.execute("UPDATE jobs SET status = 'queued', started = NULL WHERE status = 'running' AND started < ?",
+                         (time.time() - JOB_STALE_SECONDS,))
+            row = conn.execute("SELECT id, payload FROM jobs WHERE status = 'queued' "
+                               "ORDER BY priority, created LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), row['id']))
+            conn.execute('COMMIT')
+            return row
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def finish(self, job_id, result=None, error=None):
+        conn = self.connect()
+        conn.execute('UPDATE jobs SET status = ?, finished = ?, result = ?, error = ? WHERE id = ?',
+                     ('failed' if error is not None else 'done', time.time(),
+                      json.dumps(result) if result is not None else None, error, job_id))
+        conn.close()
+        shutil.rmtree(os.path.join(self.spool_dir, job_id), ignore_errors=True)
+        with self.condition:
+            self.condition.notify_all()
+
+    def run(self, row):
+        payload = json.loads(row['payload'])
+        try:
+            results = []
+            for path, filename in zip(payload['files'], payload['filenames']):
+                with open(path, 'rb') as f:
+                    result = self.handler(f, payload['options'])
+                results.append({'filename': filename, **result})
+            self.finish(row['id'], result={'results': results})
+        except Exception as e:
+            self.finish(row['id'], error=str(e))
+
+    def worker(self):
+        while True:
+            row = self.claim()
+            if row is None:
+                # woken up by enqueue, the timeout picks up jobs queued by other processes
+                with self.condition:
+                    self.condition.wait(timeout=1.0)
+                continue
+            self.run(row)
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def get(self, job_id, owner=None):
+        """The job and its result, None when it does not exist or owner did not submit it"""
+        conn = self.connect()
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None or (owner is not None and row['owner'] != owner):
+            conn.close()
+            return None
+
+        now = time.time()
+        job = {
+            'jobId': row['id'],
+            'status': row['status'],
+            'priority': row['priority'],
+            'created': row['created'],
+            'wait_time': (row['started'] or now) - row['created'],
+        }
+        if row['status'] == 'queued':
+            job['queue_position'] = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND (priority < ? OR (priority = ? AND created < ?))",
+                (row['priority'], row['priority'], row['created'])).fetchone()[0]
+        if row['finished']:
+            job['processing_time'] = row['finished'] - row['started']
+        if row['result']:
+            job.update(json.loads(row['result']))
+        if row['error'] is not None:
+            job['error'] = row['error']
+        conn.close()
+        return job
+
+    def depth(self):
+        """Number of jobs waiting for a worker"""
+        conn = self.connect()
+        depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        conn.close()
+        return depth
+
+    def drain_time(self):
+        """Seconds until the queued jobs should have been picked up, from recent processing times"""
+        conn = self.connect()
+        depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        times = [row[0] for row in conn.execute(
+            'SELECT finished - started FROM jobs WHERE finished IS NOT NULL ORDER BY finished DESC LIMIT 100')]
+        conn.close()
+        return depth * (sum(times) / len(times) if times else 1.0) / max(self.workers, 1)
+
+    def stats(self):
+        """Queue depth per priority and wait times of the recently started jobs"""
+        conn = self.connect()
+        now = time.time()
+        depth = {str(row['priority']): row['count'] for row in conn.execute(
+            "SELECT priority, COUNT(*) AS count FROM jobs WHERE status = 'queued' GROUP BY priority")}
+        running = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+        oldest = conn.execute("SELECT MIN(created) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        waits = [row[0] for row in conn.execute(
+            'SELECT started - created FROM jobs WHERE started IS NOT NULL ORDER BY started DESC LIMIT 100')]
+        conn.close()
+        return {
+            'queue_depth': sum(depth.values()),
+            'queue_depth_by_priority': depth,
+            'running': running,
+            'workers': self.workers,
+            'oldest_queued_age': now - oldest if oldest else 0,
+            'avg_wait_time': sum(waits) / len(waits) if waits else 0,
+            'max_wait_time': max(waits) if waits else 0
+        }
+
+    def events(self, job_id, owner=None, keepalive=15):
+        """Server-sent events stream, one event per status change until the job ends"""
+        last_status = None
+        while True:
+            job = self.get(job_id, owner)
+            if job is None:
+                yield 'event: error\ndata: {"error": "Job not found"}\n\n'
+                return
+            if job['status'] != last_status:
+                last_status = job['status']
+                yield f"event: {last_status}\ndata: {json.dumps(job)}\n\n"
+            if last_status in ('done', 'failed'):
+                return
+            with self.condition:
+                if not self.condition.wait(timeout=keepalive):
+                    yield ': keep-alive\n\n'
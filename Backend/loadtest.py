@@ -0,0 +1,328 @@
+import os
+import io
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from PIL import Image
+
+# Load test configuration: synthetic X-rays derived from test_image.jpg are sent
+# to /predict, /scan/save and /scan/history of a local app_mongodb.py server
+SEED_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')
+IMAGE_SIZES = [(512, 512), (1024, 1024), (2048, 2048), (2500, 2048), (3000, 2500)]
+IMAGE_FORMATS = ['JPEG', 'PNG']
+DEFAULT_MIX = 'predict=0.6,save=0.2,history=0.2'
+PERCENTILES = [50, 90, 95, 99]
+
+def synthesize_images(count=16, seed_path=SEED_IMAGE_PATH, sizes=IMAGE_SIZES, formats=IMAGE_FORMATS, seed=42):
+    """Variants of the seed image at X-ray resolutions: grayscale, random crop, contrast and noise"""
+    rng = np.random.default_rng(seed)
+    base = Image.open(seed_path).convert('L')
+    images = []
+    for i in range(count):
+        width, height = sizes[i % len(sizes)]
+        image_format = formats[(i // len(sizes)) % len(formats)]
+
+        crop = rng.uniform(0.8, 1.0)
+        left = rng.uniform(0, 1 - crop) * base.width
+        top = rng.uniform(0, 1 - crop) * base.height
+        image = base.crop((int(left), int(top), int(left + crop * base.width), int(top + crop * base.height)))
+        pixels = np.asarray(image.resize((width, height), Image.BILINEAR), dtype=np.float32)
+        pixels = (pixels - 128) * rng.uniform(0.8, 1.2) + 128 + rng.normal(0, 4, pixels.shape)
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, **({'quality': 90} if image_format == 'JPEG' else {}))
+        extension = 'jpg' if image_format == 'JPEG' else 'png'
+        images.append({
+            'filename': f'xray_{i}_{width}x{height}.{extension}',
+            'mimetype': f'image/{extension.replace("jpg", "jpeg")}',
+            'data': buffer.getvalue()
+        })
+    return images
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_until_ready(check, timeout, what):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        time.sleep(0.25)
+    raise RuntimeError(f'{what} did not start within {timeout}s')
+
+def start_mongod(workdir, timeout=30):
+    """Throwaway mongod on a free port with its data in workdir"""
+    if shutil.which('mongod') is None:
+        raise RuntimeError('mongod not found on PATH, pass --mongodb-uri instead')
+    port = free_port()
+    dbpath = os.path.join(workdir, 'mongod')
+    os.makedirs(dbpath)
+    process = subprocess.Popen(['mongod', '--dbpath', dbpath, '--port', str(port), '--bind_ip', '127.0.0.1'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_until_ready(lambda: socket.create_connection(('127.0.0.1', port), timeout=1).close() or True,
+                     timeout, 'mongod')
+    return process, f'mongodb://127.0.0.1:{port}'
+
+def start_server(workdir, mongodb_uri, timeout=120, overrides=None):
+    """app_mongodb.py with the dummy model, a fresh database and a private job queue,
+    overrides replace environment variables of its configuration"""
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'MONGODB_URI': mongodb_uri,
+        'MONGODB_DB': f'loadtest_{port}',
+        'JOBS_DB_PATH': os.path.join(workdir, 'jobs.sqlite3'),
+        'JOBS_SPOOL_DIR': os.path.join(workdir, 'jobs'),
+        **(overrides or {})
+    })
+    env.setdefault('MODEL_PATH', os.path.join(workdir, 'missing.h5'))  # dummy model
+    env.setdefault('BCRYPT_ROUNDS', '4')  # setup logs in every synthetic user
+    env.setdefault('RATE_LIMIT_PER_MINUTE', '0')  # the users are synthetic, keep admission control only
+    code = f'from app_mongodb import app; app.run(host="127.0.0.1", port={port}, threaded=True)'
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    wait_until_ready(lambda: requests.get(url + '/health', timeout=2).ok, timeout, 'server')
+    return process, url
+
+def login_users(url, count):
+    """Register and log in `count` users, one HTTP session with its token each"""
+    sessions = []
+    suffix = int(time.time())
+    for i in range(count):
+        session = requests.Session()
+        credentials = {'email': f'loadtest{i}_{suffix}@example.com', 'password': 'loadtest-password'}
+        session.post(url + '/register', json={**credentials, 'firstName': 'Load', 'lastName': f'Test {i}'}, timeout=30)
+        response = session.post(url + '/login', json=credentials, timeout=30)
+        response.raise_for_status()
+        session.headers['Authorization'] = response.json()['token']
+        session.last_result = None
+        sessions.append(session)
+    return sessions
+
+def do_predict(url, session, image):
+    files = {'file': (image['filename'], image['data'], image['mimetype'])}
+    response = session.post(url + '/predict', files=files, timeout=60)
+    if response.ok:
+        session.last_result = response.json()
+    return response
+
+def do_save(url, session, image):
+    result = session.last_result or {'prediction': 'Normal', 'confidence': 0.9}
+    scan = {
+        'prediction': result['prediction'],
+        'confidence': result['confidence'],
+        'disease': result['prediction'],
+        'status': 'completed',
+        'precaution': result.get('disease_info', {}).get('precaution', ''),
+        # the web app stores the uploaded image as a data URL
+        'image_url': f"data:{image['mimetype']};base64,{base64.b64encode(image['data']).decode('ascii')}",
+        'explanation': result.get('explanation', ''),
+        'heatmap_regions': result.get('heatmap_regions', []),
+        'all_probabilities': result.get('all_probabilities', {}),
+        'analysis_metadata': result.get('analysis_metadata', {})
+    }
+    return session.post(url + '/scan/save', json=scan, timeout=60)
+
+def do_history(url, session, image):
+    return session.get(url + '/scan/history', params={'limit': 10}, timeout=60)
+
+OPERATIONS = {'predict': do_predict, 'save': do_save, 'history': do_history}
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, weight = part.split('=')
+        if name not in OPERATIONS:
+            raise ValueError(f'unknown operation {name}, expected one of {", ".join(OPERATIONS)}')
+        weights[name] = float(weight)
+    return weights
+
+class LoadTest:
+    def __init__(self, url, sessions, images, mix, seed=42):
+        self.url = url
+        self.sessions = sessions
+        self.images = images
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.samples = []  # (operation, status, latency seconds)
+
+    def pick(self):
+        with self.lock:
+            return (self.random.choices(self.names, self.weights)[0], self.random.choice(self.sessions),
+                    self.random.choice(self.images))
+
+    def request(self, scheduled=None):
+        """One request; latency counts from the scheduled arrival so queueing in the client is included"""
+        name, session, image = self.pick()
+        start = scheduled or time.perf_counter()
+        try:
+            status = OPERATIONS[name](self.url, session, image).status_code
+        except requests.RequestException:
+            status = 0
+        with self.lock:
+            self.samples.append((name, status, time.perf_counter() - start))
+
+    def closed_loop(self, concurrency, duration):
+        """`concurrency` clients each sending their next request when the previous one returns"""
+        deadline = time.perf_counter() + duration
+
+        def client():
+            while time.perf_counter() < deadline:
+                self.request()
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def open_loop(self, rate, concurrency, duration):
+        """Poisson arrivals at `rate` req/s whatever the response times, on up to `concurrency` connections"""
+        rng = random.Random(self.random.random())
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            begin = time.perf_counter()
+            arrival = begin
+            while arrival < begin + duration:
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.request, arrival)
+                arrival += rng.expovariate(rate)
+
+    def run(self, duration, concurrency, rate=0, warmup=0):
+        if warmup:
+            self.closed_loop(concurrency, warmup)
+            self.samples = []
+        start = time.perf_counter()
+        if rate:
+            self.open_loop(rate, concurrency, duration)
+        else:
+            self.closed_loop(concurrency, duration)
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        def summarize(samples):
+            latencies = np.array([latency for _, _, latency in samples]) * 1000
+            statuses = [status for _, status, _ in samples]
+            errors = sum(1 for status in statuses if not 200 <= status < 300)
+            summary = {
+                'requests': len(samples),
+                'errors': errors,
+                'error_rate': errors / len(samples) if samples else 0,
+                'throughput': len(samples) / elapsed,
+                'status_codes': {str(code): statuses.count(code) for code in sorted(set(statuses))}
+            }
+            if len(latencies):
+                summary['latency_ms'] = {
+                    'mean': float(latencies.mean()),
+                    **{f'p{p}': float(np.percentile(latencies, p)) for p in PERCENTILES},
+                    'max': float(latencies.max())
+                }
+            return summary
+
+        return {
+            'duration': elapsed,
+            'total': summarize(self.samples),
+            'operations': {name: summarize([s for s in self.samples if s[0] == name]) for name in self.names}
+        }
+
+def compare(report, baseline, tolerance):
+    """Regressions of report against a baseline report: p95 latency, throughput and error rate"""
+    regressions = []
+    for name, current in [('total', report['total']), *report['operations'].items()]:
+        previous = baseline['total'] if name == 'total' else baseline['operations'].get(name)
+        if not previous or not previous['requests']:
+            continue
+        if 'latency_ms' in current and 'latency_ms' in previous and \
+                current['latency_ms']['p95'] > previous['latency_ms']['p95'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['latency_ms']['p95']:.1f} -> {current['latency_ms']['p95']:.1f} ms")
+        if current['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {previous['throughput']:.1f} -> {current['throughput']:.1f} req/s")
+        if current['error_rate'] > previous['error_rate'] + 0.01:
+            regressions.append(f"{name}: error rate {previous['error_rate']:.2%} -> {current['error_rate']:.2%}")
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description='load test /predict, /scan/save and /scan/history with synthetic X-rays')
+    ap.add_argument('--url', help='running server to test, by default a local one is started with the dummy model')
+    ap.add_argument('--mongodb-uri', help='database for the local server, by default a throwaway mongod is started')
+    ap.add_argument('--duration', type=float, default=30, help='seconds of measured load')
+    ap.add_argument('--warmup', type=float, default=5, help='seconds of unmeasured load first')
+    ap.add_argument('--concurrency', type=int, default=8, help='concurrent clients (connections in open loop)')
+    ap.add_argument('--rate', type=float, default=0, help='open loop arrival rate in req/s, 0 for a closed loop')
+    ap.add_argument('--mix', default=DEFAULT_MIX, help='operation weights')
+    ap.add_argument('--users', type=int, default=4, help='synthetic users the requests are spread over')
+    ap.add_argument('--images', type=int, default=16, help='synthetic images to cycle through')
+    ap.add_argument('--seed', type=int, default=42)
+    ap.add_argument('--output', default='output/loadtest.json', help='json report')
+    ap.add_argument('--baseline', help='earlier json report, exit with 1 when this run regressed')
+    ap.add_argument('--tolerance', type=float, default=0.1, help='allowed relative p95/throughput change')
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    processes = []
+    try:
+        url = args.url
+        if url is None:
+            mongodb_uri = args.mongodb_uri
+            if mongodb_uri is None:
+                mongod, mongodb_uri = start_mongod(workdir)
+                processes.append(mongod)
+            server, url = start_server(workdir, mongodb_uri)
+            processes.append(server)
+
+        images = synthesize_images(args.images, seed=args.seed)
+        sessions = login_users(url, args.users)
+        test = LoadTest(url, sessions, images, parse_mix(args.mix), seed=args.seed)
+        report = test.run(args.duration, args.concurrency, args.rate, args.warmup)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report['config'] = {**vars(args), 'url': url, 'revision': git_revision()}
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, summary in [('total', report['total']), *report['operations'].items()]:
+        latency = summary.get('latency_ms', {})
+        print(f"{name:<8} requests: {summary['requests']:<6} {summary['throughput']:7.1f} req/s "
+              f"errors: {summary['error_rate']:6.2%} p50: {latency.get('p50', 0):7.1f} ms "
+              f"p95: {latency.get('p95', 0):7.1f} ms p99: {latency.get('p99', 0):7.1f} ms")
+    print(f"Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+
+# Password hashing configuration: bcrypt runs on its own small pool so that a
+# burst of logins can only use AUTH_WORKERS cores and never the request threads
+# serving /predict. Hashes with a different cost are upgraded on the next login.
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+AUTH_WORKERS = int(os.getenv('AUTH_WORKERS', '2'))
+AUTH_MAX_PENDING = int(os.getenv('AUTH_MAX_PENDING', '32'))
+AUTH_TIMEOUT_SECONDS = float(os.getenv('AUTH_TIMEOUT_SECONDS', '10'))
+
+class AuthBusyError(Exception):
+    """Raised when too many hashing jobs are already pending"""
+
+class PasswordHasher:
+    def __init__(self, rounds=BCRYPT_ROUNDS, workers=AUTH_WORKERS, max_pending=AUTH_MAX_PENDING,
+                 timeout=AUTH_TIMEOUT_SECONDS):
+        self.rounds = rounds
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='auth')
+        self.pending = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args):
+        if not self.pending.acquire(blocking=False):
+            raise AuthBusyError('Too many authentication requests, retry later')
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self.pending.release())
+        return future
+
+    def hash(self, password):
+        future = self.submit(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+        return future.result(timeout=self.timeout).decode('utf-8')
+
+    def check(self, password, hashed):
+        future = self.submit(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+        return future.result(timeout=self.timeout)
+
+    def needs_rehash(self, hashed):
+        # bcrypt hashes look like $2b$<cost>$<salt and hash>
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return False
+
+    def rehash_later(self, password, on_hashed):
+        """Hash again with the current cost in the background and hand the result to on_hashed"""
+        def rehash():
+            on_hashed(bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(self.rounds)).decode('utf-8'))
+        try:
+            self.submit(rehash)
+        except AuthBusyError:
+            pass  # upgrade on a later login
+
+def benchmark(logins=40, concurrency=8, rounds=BCRYPT_ROUNDS, workers=AUTH_WORKERS):
+    """Login throughput and the latency of a concurrent CPU-bound 'prediction' loop,
+    with bcrypt on the request threads versus on the bounded auth pool"""
+    import numpy as np
+    hashed = bcrypt.hashpw(b'password', bcrypt.gensalt(rounds)).decode('utf-8')
+    hasher = PasswordHasher(rounds=rounds, workers=workers, max_pending=logins)
+    a = np.random.rand(384, 384).astype(np.float32)
+
+    def measure_predictions(stop, latencies):
+        while not stop.is_set():
+            start = time.perf_counter()
+            for _ in range(10):
+                a @ a
+            latencies.append(time.perf_counter() - start)
+
+    def percentiles(latencies):
+        latencies = sorted(latencies)
+        return latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000
+
+    def run(login):
+        stop, latencies = threading.Event(), []
+        predictor = threading.Thread(target=measure_predictions, args=(stop, latencies))
+        predictor.start()
+        start = time.perf_counter()
+        if login is None:
+            time.sleep(1.0)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(lambda _: login(), range(logins)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        predictor.join()
+        return (logins / elapsed if login else 0, *percentiles(latencies))
+
+    results = {}
+    for name, login in [('idle', None),
+                        ('request threads', lambda: bcrypt.checkpw(b'password', hashed.encode('utf-8'))),
+                        ('auth executor', lambda: hasher.check('password', hashed))]:
+        logins_per_sec, p50, p99 = run(login)
+        results[name] = {'logins_per_sec': logins_per_sec, 'predict_p50_ms': p50, 'predict_p99_ms': p99}
+    return results
+
+if __name__ == "__main__":
+    # login throughput versus /predict-like latency, 8 concurrent logins, 2 auth workers
+    for name, result in benchmark().items():
+        print(f"{name:<16} logins/s: {result['logins_per_sec']:6.1f} "
+              f"predict p50: {result['predict_p50_ms']:.1f} ms p99: {result['predict_p99_ms']:.1f} ms")
@@ -0,0 +1,198 @@
+import io
+import os
+import time
+import marshal
+import pstats
+import cProfile
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+# On-demand request profiling: an admin arms the profiler for the next N requests,
+# which run under cProfile one at a time (only one profiler may be active), and the
+# per-stage timings and cProfile stats of all sampled requests are aggregated.
+# When disarmed the wrapped routes only pay for one attribute read.
+PROFILE_MAX_REQUESTS = int(os.getenv('PROFILE_MAX_REQUESTS', '1000'))
+PROFILE_TF_LOGDIR = os.getenv('PROFILE_TF_LOGDIR', 'output/profile')
+
+class RequestProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sampling = threading.Lock()  # held by the request being profiled
+        self.local = threading.local()
+        self.remaining = 0
+        self.reset()
+
+    def reset(self):
+        self.stats = None
+        self.requests = 0
+        self.total_time = 0.0
+        self.stages = {}
+        self.started = None
+        self.tf_logdir = None
+
+    def start(self, requests, tf_trace=False):
+        """Profile the next `requests` requests, optionally with a TensorFlow profiler trace"""
+        with self.lock:
+            self.stop_tf_trace()
+            self.reset()
+            self.remaining = max(0, min(requests, PROFILE_MAX_REQUESTS))
+            self.started = time.time()
+            if tf_trace:
+                import tensorflow as tf
+                tf.profiler.experimental.start(PROFILE_TF_LOGDIR)
+                self.tf_logdir = PROFILE_TF_LOGDIR
+
+    def stop(self):
+        with self.lock:
+            self.remaining = 0
+            self.stop_tf_trace()
+
+    def stop_tf_trace(self):
+        if self.tf_logdir is not None:
+            import tensorflow as tf
+            tf.profiler.experimental.stop()
+            self.tf_logdir = None
+
+    def profile(self, f):
+        """Run the wrapped route under cProfile while the profiler is armed"""
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if self.remaining <= 0 or not self.sampling.acquire(blocking=False):
+                return f(*args, **kwargs)
+            try:
+                with self.lock:
+                    sampled = self.remaining > 0
+                    self.remaining -= sampled
+                if not sampled:
+                    return f(*args, **kwargs)
+
+                profile = cProfile.Profile()
+                self.local.stages = {}
+                start = time.perf_counter()
+                try:
+                    return profile.runcall(f, *args, **kwargs)
+                finally:
+                    self.record(profile, self.local.stages, time.perf_counter() - start)
+                    self.local.stages = None
+            finally:
+                self.sampling.release()
+        return decorated
+
+    @contextmanager
+    def stage(self, name):
+        """Time a named part of a profiled request (decode, quality, preprocess, inference...)"""
+        stages = getattr(self.local, 'stages', None)
+        if stages is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+    def record(self, profile, stages, elapsed):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.requests += 1
+            self.total_time += elapsed
+            for name, seconds in stages.items():
+                self.stages[name] = self.stages.get(name, 0.0) + seconds
+            if self.remaining == 0:
+                self.stop_tf_trace()
+
+    def status(self):
+        with self.lock:
+            return {
+                'armed': self.remaining > 0,
+                'remaining': self.remaining,
+                'started': self.started,
+                'requests': self.requests,
+                'mean_time': self.total_time / self.requests if self.requests else 0,
+                # mean seconds per sampled request and share of the request time
+                'stages': {name: {'mean_time': seconds / self.requests,
+                                  'share': seconds / self.total_time if self.total_time else 0}
+                           for name, seconds in self.stages.items()},
+                'tf_trace': self.tf_logdir
+            }
+
+    def text(self, sort='cumulative', limit=50):
+        """pstats report of the aggregated requests"""
+        with self.lock:
+            if self.stats is None:
+                return ''
+            stream = io.StringIO()
+            self.stats.stream = stream
+            self.stats.sort_stats(sort).print_stats(limit)
+            return stream.getvalue()
+
+    def dump(self):
+        """Aggregated stats in the binary format of pstats.Stats.dump_stats (snakeviz, gprof2dot...)"""
+        with self.lock:
+            return marshal.dumps(self.stats.stats) if self.stats is not None else b''
+
+    def collapsed(self, max_depth=64, min_fraction=1e-4, max_lines=20000, time_budget=2.0):
+        """Folded stacks ("a;b;c microseconds" lines) for flamegraph.pl or speedscope.
+
+        cProfile only keeps caller/callee pairs, so the stacks are rebuilt from the
+        roots and the time of a function is split over its callers in proportion
+        to the cumulative time of each call edge. The number of paths grows
+        exponentially with the depth, so a path is only followed while it carries
+        at least min_fraction of the total time, and no further paths are opened
+        once max_lines stacks are visited or time_budget seconds are spent. The
+        time of the paths cut off stays on their caller, the widths of the frames
+        that are emitted do not change.
+        """
+        with self.lock:
+            if self.stats is None:
+                return ''
+            stats = self.stats.stats
+
+        labels = {}
+        for func in stats:
+            filename, line, name = func
+            labels[func] = f"{os.path.basename(filename)}:{line}:{name}" if line else name
+
+        callees = {}
+        for func, (_, _, _, _, callers) in stats.items():
+            for caller, (_, _, _, ct) in callers.items():
+                callees.setdefault(caller, []).append((func, ct))
+
+        roots = [(func, ct) for func, (_, _, _, ct, callers) in stats.items() if not callers]
+        min_time = sum(ct for _, ct in roots) * min_fraction
+        deadline = time.perf_counter() + time_budget
+        lines = {}
+        on_stack = set()
+        visits = [0]
+
+        def visit(func, prefix, depth, path_time):
+            visits[0] += 1
+            (_, _, tt, ct, _) = stats[func]
+            fraction = path_time / ct if ct else 0
+            key = f"{prefix};{labels[func]}" if prefix else labels[func]
+            own_time = tt * fraction
+            if depth < max_depth and visits[0] < max_lines and time.perf_counter() < deadline:
+                on_stack.add(func)
+                for callee, edge_time in callees.get(func, []):
+                    if callee in on_stack:
+                        continue
+                    callee_time = edge_time * fraction
+                    if callee_time >= min_time and visits[0] < max_lines:
+                        visit(callee, key, depth + 1, callee_time)
+                    else:
+                        own_time += callee_time
+                on_stack.discard(func)
+            else:
+                own_time = path_time
+            if int(own_time * 1e6):
+                lines[key] = lines.get(key, 0) + int(own_time * 1e6)
+
+        for func, ct in roots:
+            visit(func, '', 1, ct)
+        return ''.join(f"{stack} {count}\n" for stack, count in lines.items())
+
+profiler = RequestProfiler()
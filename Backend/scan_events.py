@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import queue
+import threading
+import collections
+
+# Push updates for the dashboard: /scan/events is a server-sent events stream of the
+# user's new scans, so the dashboard no longer refetches /scan/history to see them.
+# With a replica set (a single-node one is enough) every process watches a MongoDB
+# change stream on the scans collection and so also sees the scans saved by other
+# processes. On a standalone server, or while the change stream is down, /scan/save
+# publishes to the subscribers of its own process instead.
+# SCAN_EVENTS_MODE=local skips the change stream
+SCAN_EVENTS_MODE = os.getenv('SCAN_EVENTS_MODE', 'auto')
+SCAN_EVENTS_KEEPALIVE = int(os.getenv('SCAN_EVENTS_KEEPALIVE', '15'))
+SCAN_EVENTS_QUEUE_SIZE = 100
+SCAN_EVENTS_RETRY_SECONDS = 5
+SUMMARY_FIELDS = ['user_email', 'prediction', 'disease', 'status', 'confidence', 'date']
+# error code of $changeStream on a standalone server
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+class ScanEvents:
+    def __init__(self, summarize):
+        """summarize(scan) makes the JSON serializable event of a saved scan document"""
+        self.summarize = summarize
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.mode = 'local'
+        self.thread = None
+        self.counts = collections.Counter()
+
+    def subscribe(self, email):
+        subscription = queue.Queue(SCAN_EVENTS_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.setdefault(email, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, email, subscription):
+        with self.lock:
+            subscriptions = self.subscribers.get(email, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscribers.pop(email, None)
+
+    def publish(self, scan):
+        """Deliver a saved scan to its user's subscribers in this process"""
+        with self.lock:
+            subscriptions = list(self.subscribers.get(scan.get('user_email'), ()))
+        if not subscriptions:
+            return
+        event = self.summarize(scan)
+        delivered = 0
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait(event)
+                delivered += 1
+            except queue.Full:
+                pass  # a stalled client misses events, it catches up when it reconnects
+        with self.lock:
+            self.counts['delivered'] += delivered
+            self.counts['dropped'] += len(subscriptions) - delivered
+
+    def saved(self, scan):
+        """Called by /scan/save, the change stream publishes the scan when it runs"""
+        if self.mode != 'change_stream':
+            self.publish(scan)
+
+    def start(self, watch):
+        """Publish the scans of watch(pipeline, resume_after), a change stream opener"""
+        if SCAN_EVENTS_MODE == 'local' or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.follow, args=(watch,), name='scan-events', daemon=True)
+        self.thread.start()
+
+    def follow(self, watch):
+        pipeline = [
+            {'$match': {'operationType': 'insert'}},
+            # leave the images and embeddings out of the events
+            {'$project': {'fullDocument._id': 1, **{f'fullDocument.{name}': 1 for name in SUMMARY_FIELDS}}}
+        ]
+        resume_token = None
+        while True:
+            try:
+                with watch(pipeline, resume_token) as stream:
+                    self.mode = 'change_stream'
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self.publish(change['fullDocument'])
+            except Exception as e:
+                self.mode = 'local'
+                if getattr(e, 'code', None) == CHANGE_STREAMS_UNSUPPORTED:
+                    print("Scan events: no replica set, publishing the scans saved by this process only")
+                    return
+                print(f"Scan events: change stream failed ({e}), retrying")
+                time.sleep(SCAN_EVENTS_RETRY_SECONDS)
+
+    def stream(self, email, subscription, backlog=(), keepalive=SCAN_EVENTS_KEEPALIVE):
+        """Server-sent events of a subscription, after the backlog of scans missed while
+        disconnected. The subscription is made before the backlog is read, so events
+        delivered twice are dropped by their id"""
+        sent = collections.deque(maxlen=SCAN_EVENTS_QUEUE_SIZE)
+        try:
+            yield f'retry: {SCAN_EVENTS_RETRY_SECONDS * 1000}\n\n'
+            events = (self.summarize(scan) for scan in backlog)
+            while True:
+                event = next(events, None)
+                if event is None:
+                    try:
+                        event = subscription.get(timeout=keepalive)
+                    except queue.Empty:
+                        yield ': keep-alive\n\n'
+                        continue
+                if event['_id'] in sent:
+                    continue
+                sent.append(event['_id'])
+                yield f"id: {event['_id']}\nevent: scan\ndata: {json.dumps(event)}\n\n"
+        finally:
+            self.unsubscribe(email, subscription)
+
+    def stats(self):
+        with self.lock:
+            connections = sum(len(subscriptions) for subscriptions in self.subscribers.values())
+            return {'mode': self.mode, 'connections': connections, **self.counts}
+
+if __name__ == "__main__":
+    import random
+    import argparse
+    import datetime
+
+    # Dashboards refetching a 10-scan history every --poll-interval seconds versus
+    # connected to the event stream, while scans are saved at --rate per second.
+    # The store counts the queries and the response bytes a MongoDB server would serve
+    ap = argparse.ArgumentParser(description='polling versus pushed scan updates')
+    ap.add_argument('--dashboards', type=int, default=500)
+    ap.add_argument('--poll-interval', type=float, default=10)
+    ap.add_argument('--rate', type=float, default=2, help='scans saved per second, over all users')
+    ap.add_argument('--duration', type=float, default=60)
+    ap.add_argument('--output', default='output/scan_events_benchmark.json')
+    args = ap.parse_args()
+
+    class Store:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.scans = collections.defaultdict(list)
+            self.queries = self.bytes = 0
+
+        def save(self, scan):
+            with self.lock:
+                self.scans[scan['user_email']].append(scan)
+
+        def history(self, email, limit=10):
+            with self.lock:
+                self.queries += 1
+                scans = sorted(self.scans[email], key=lambda scan: scan['date'], reverse=True)[:limit]
+                self.bytes += len(json.dumps([{**scan, 'date': scan['date'].isoformat()} for scan in scans]))
+            return scans
+
+    def summarize(scan):
+        return {'_id': scan['_id'], 'prediction': scan['prediction'], 'disease': scan['disease'],
+                'status': scan['status'], 'confidence': scan['confidence'], 'date': scan['date'].isoformat()}
+
+    def make_scan(i):
+        return {'_id': f'{i:024x}', 'user_email': f'user{random.randrange(args.dashboards)}',
+                'prediction': 'Pneumonia', 'disease': 'Pneumonia', 'status': 'Detected', 'confidence': 0.87,
+                'precaution': 'Start antibiotic therapy as prescribed.', 'date': datetime.datetime.utcnow(),
+                'explanation': 'Consolidation in the lower right lobe.', 'saved_at': time.monotonic()}
+
+    def writer(store, events, stop):
+        i = 0
+        while not stop.is_set():
+            scan = make_scan(i)
+            store.save(scan)
+            if events is not None:
+                events.saved(scan)
+            i += 1
+            stop.wait(random.expovariate(args.rate))
+        return i
+
+    def run(mode):
+        store, stop, delays = Store(), threading.Event(), []
+        events = ScanEvents(summarize) if mode == 'push' else None
+        if events is not None:
+            # delays measured from the save, the summary keeps the save time for it
+            events.summarize = lambda scan: {**summarize(scan), 'saved_at': scan['saved_at']}
+
+        def dashboard(user):
+            email = f'user{user}'
+            if mode == 'poll':
+                seen = {scan['_id'] for scan in store.history(email)}
+                stop.wait(random.uniform(0, args.poll_interval))
+                while not stop.is_set():
+                    for scan in store.history(email):
+                        if scan['_id'] not in seen:
+                            seen.add(scan['_id'])
+                            delays.append(time.monotonic() - scan['saved_at'])
+                    stop.wait(args.poll_interval)
+            else:
+                # one history load when the dashboard opens, then the stream
+                store.history(email)
+                subscription = events.subscribe(email)
+                for message in events.stream(email, subscription, keepalive=1):
+                    if stop.is_set():
+                        return
+                    if message.startswith('id:'):
+                        event = json.loads(message.split('data: ', 1)[1])
+                        delays.append(time.monotonic() - event['saved_at'])
+
+        threads = [threading.Thread(target=dashboard, args=(user,), daemon=True) for user in range(args.dashboards)]
+        for thread in threads:
+            thread.start()
+        time.sleep(1)
+        opened = store.queries
+        start = time.monotonic()
+        saved = [0]
+        thread = threading.Thread(target=lambda: saved.__setitem__(0, writer(store, events, stop)))
+        thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        thread.join()
+        for dashboard_thread in threads:
+            dashboard_thread.join(timeout=2)
+        elapsed = time.monotonic() - start
+        return {
+            'mode': mode,
+            'scans_saved': saved[0],
+            'history_queries_per_second': (store.queries - opened) / elapsed,
+            'history_bytes_per_second': store.bytes / elapsed,
+            'updates_seen': len(delays),
+            'update_delay_p50': float(sorted(delays)[len(delays) // 2]) if delays else None,
+            'update_delay_max': max(delays) if delays else None
+        }
+
+    results = []
+    for mode in ('poll', 'push'):
+        result = run(mode)
+        results.append(result)
+        print(f"{mode}: {args.dashboards} dashboards, {result['scans_saved']} scans saved, "
+              f"{result['history_queries_per_second']:.1f} history queries/s "
+              f"({result['history_bytes_per_second'] / 1024:.0f} KB/s), {result['updates_seen']} updates seen, "
+              f"delay p50 {result['update_delay_p50'] or 0:.3f} s max {result['update_delay_max'] or 0:.3f} s")
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+    print(f"Results written to {args.output}")
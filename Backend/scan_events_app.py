@@ -0,0 +1,81 @@
+from flask import Flask, request, jsonify, Response
+from flask_cors import CORS
+import os
+import time
+import jwt
+import thumbnails
+from scan_events import ScanEvents
+from database import db
+
+# Server-sent events of the dashboards, apart from the inference app: an open stream
+# holds its connection for as long as the dashboard is open, which would take one of
+# the few request threads of app_mongodb.py each. Served on its own by
+#   gunicorn -c gunicorn_events.conf.py scan_events_app:app
+# with gevent workers, where a waiting stream costs a greenlet instead of a thread.
+# app_mongodb.py serves the same route for single-process runs (python app_mongodb.py)
+app = Flask(__name__)
+CORS(app)
+
+JWT_SECRET = os.getenv('JWT_SECRET', 'your_jwt_secret_key_here')
+# EventSource cannot send the Authorization header, so the stream URL carries a token.
+# It is a short-lived one only good for opening an event stream (/scan/events and
+# /jobs/<id>/events of app_mongodb.py), from POST /scan/events/token, since URLs end
+# up in access and proxy logs
+STREAM_TOKEN_SECONDS = int(os.getenv('STREAM_TOKEN_SECONDS', '60'))
+STREAM_TOKEN_PURPOSE = 'event_stream'
+
+def stream_token(email):
+    """Token for ?token= of the event streams, valid for STREAM_TOKEN_SECONDS"""
+    return jwt.encode({'email': email, 'purpose': STREAM_TOKEN_PURPOSE,
+                       'exp': int(time.time()) + STREAM_TOKEN_SECONDS}, JWT_SECRET, algorithm='HS256')
+
+def stream_user():
+    """Email of the caller from a stream token (?token=) or the Authorization header, else None"""
+    try:
+        token = request.args.get('token')
+        if token:
+            decoded = jwt.decode(token, JWT_SECRET, algorithms=['HS256'], options={'require': ['exp']})
+            return decoded['email'] if decoded.get('purpose') == STREAM_TOKEN_PURPOSE else None
+        token = request.headers.get('Authorization')
+        return jwt.decode(token, JWT_SECRET, algorithms=['HS256'])['email'] if token else None
+    except Exception:
+        return None
+
+def scan_event(scan):
+    """Summary of a saved scan pushed to the dashboard"""
+    scan_id = str(scan['_id'])
+    return {
+        '_id': scan_id,
+        'prediction': scan.get('prediction'),
+        'disease': scan.get('disease'),
+        'status': scan.get('status'),
+        'confidence': scan.get('confidence'),
+        'date': scan['date'].isoformat() if scan.get('date') else None,
+        'thumbnail_url': thumbnails.thumbnail_url(scan_id, scan['user_email'], JWT_SECRET)
+    }
+
+# New scans pushed to the connected dashboards of this process, see scan_events.py
+scan_events = ScanEvents(scan_event)
+
+def event_stream():
+    email = stream_user()
+    if email is None:
+        return jsonify({'error': 'Token is invalid or expired'}), 401
+
+    # subscribed before the scans missed since the browser's Last-Event-ID are read,
+    # ?last_event_id= when the dashboard opens a new stream with a new token
+    subscription = scan_events.subscribe(email)
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    backlog = db.get_user_scans_after(email, last_event_id, projection={
+        name: 1 for name in ['user_email', 'prediction', 'disease', 'status', 'confidence', 'date']
+    }) if last_event_id else []
+    return Response(scan_events.stream(email, subscription, backlog), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/scan/events", methods=["GET"])
+def scan_event_stream():
+    return event_stream()
+
+@app.route("/health", methods=["GET"])
+def health():
+    return jsonify({'status': 'healthy', 'scan_events': scan_events.stats()})
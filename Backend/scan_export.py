@@ -0,0 +1,157 @@
+import io
+import os
+import csv
+import json
+
+# Bulk export of a user's scans for /scan/export: the rows are read from a MongoDB
+# cursor EXPORT_BATCH_SIZE documents at a time and written to the response as they
+# come, in chunks of about EXPORT_CHUNK_BYTES, so memory does not grow with the
+# number of scans. The full-resolution images are only included with images=1
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '500'))
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# nested fields are flattened to these CSV columns
+CSV_COLUMNS = [
+    ('id', ('_id',)),
+    ('date', ('date',)),
+    ('prediction', ('prediction',)),
+    ('disease', ('disease',)),
+    ('status', ('status',)),
+    ('confidence', ('confidence',)),
+    ('confidence_level', ('analysis_metadata', 'confidence_level')),
+    ('probability_normal', ('all_probabilities', 'Normal')),
+    ('probability_pneumonia', ('all_probabilities', 'Pneumonia')),
+    ('probability_tuberculosis', ('all_probabilities', 'Tuberculosis')),
+    ('quality_score', ('quality_check', 'quality_score')),
+    ('model_version', ('analysis_metadata', 'model_version')),
+    ('precaution', ('precaution',)),
+    ('explanation', ('explanation',))
+]
+
+def projection(images=False):
+    """Fields left out of the export; thumbnails and embeddings are server-side data"""
+    excluded = {'thumbnail': 0, 'embedding': 0, 'stats_counted': 0}
+    if not images:
+        excluded['image_url'] = 0
+    return excluded
+
+def encode(value):
+    """JSON encoding of ObjectIds and dates"""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+def chunked(lines):
+    """Join small encoded rows into chunks of about EXPORT_CHUNK_BYTES"""
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+def ndjson_rows(scans):
+    for scan in scans:
+        yield (json.dumps(scan, default=encode, separators=(',', ':')) + '\n').encode('utf-8')
+
+def csv_value(scan, path):
+    for key in path:
+        scan = scan.get(key) if isinstance(scan, dict) else None
+    return encode(scan) if scan is not None and not isinstance(scan, (str, int, float)) else scan
+
+def csv_rows(scans, images=False):
+    columns = CSV_COLUMNS + ([('image_url', ('image_url',))] if images else [])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        line = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writerow([name for name, _ in columns])
+    yield flush()
+    for scan in scans:
+        writer.writerow([csv_value(scan, path) for _, path in columns])
+        yield flush()
+
+def export(scans, export_format, images=False):
+    """Response body generator of the scans in one of EXPORT_FORMATS"""
+    rows = csv_rows(scans, images) if export_format == 'csv' else ndjson_rows(scans)
+    return chunked(rows)
+
+if __name__ == "__main__":
+    import time
+    import base64
+    import argparse
+    import datetime
+    import threading
+    from flask import Flask, Response, jsonify
+
+    # Peak memory of exporting synthetic scans through a Flask response, streamed
+    # versus built from a list like /scan/history
+    ap = argparse.ArgumentParser(description='streamed versus buffered scan export')
+    ap.add_argument('--scans', type=int, default=100000)
+    ap.add_argument('--image-bytes', type=int, default=0, help='size of an image_url payload per scan')
+    ap.add_argument('--format', default='ndjson', choices=list(EXPORT_FORMATS))
+    ap.add_argument('--mode', default='both', choices=['both', 'streamed', 'buffered'])
+    args = ap.parse_args()
+
+    image_url = 'data:image/jpeg;base64,' + base64.b64encode(os.urandom(args.image_bytes)).decode('ascii')
+
+    def cursor():
+        """Documents made one at a time, like a cursor reading batches"""
+        start = datetime.datetime(2024, 1, 1)
+        for i in range(args.scans):
+            yield {
+                '_id': f'{i:024x}', 'user_email': 'doctor@example.com', 'prediction': 'Pneumonia',
+                'confidence': 0.87, 'disease': 'Pneumonia', 'status': 'Detected',
+                'precaution': 'Start antibiotic therapy as prescribed.',
+                'date': start + datetime.timedelta(minutes=i),
+                'explanation': 'Consolidation in the lower right lobe.',
+                'all_probabilities': {'Normal': 0.05, 'Pneumonia': 0.87, 'Tuberculosis': 0.08},
+                'quality_check': {'quality_score': 0.9, 'issues': [], 'acceptable': True},
+                'analysis_metadata': {'model_version': 'LuNet-v1.0', 'confidence_level': 'High'},
+                **({'image_url': image_url} if args.image_bytes else {})
+            }
+
+    app = Flask(__name__)
+
+    @app.route('/streamed')
+    def streamed():
+        return Response(export(cursor(), args.format, images=bool(args.image_bytes)),
+                        mimetype=EXPORT_FORMATS[args.format])
+
+    @app.route('/buffered')
+    def buffered():
+        scans = list(cursor())
+        return jsonify({'scans': scans, 'total': len(scans)})
+
+    def rss():
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+
+    client = app.test_client()
+    for mode in ['streamed', 'buffered'] if args.mode == 'both' else [args.mode]:
+        baseline, peak, running = rss(), [0], [True]
+
+        def sample():
+            while running[0]:
+                peak[0] = max(peak[0], rss())
+                time.sleep(0.01)
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        start = time.perf_counter()
+        response = client.get(f'/{mode}', buffered=False)
+        size = sum(len(chunk) for chunk in response.response)
+        elapsed = time.perf_counter() - start
+        running[0] = False
+        sampler.join()
+        response.close()
+        print(f"{mode:<9} {args.scans} scans: {size / 2 ** 20:8.1f} MB in {elapsed:5.1f} s, "
+              f"peak memory +{(peak[0] - baseline) / 2 ** 20:7.1f} MB")
@@ -0,0 +1,102 @@
+import os
+import datetime
+
+# Scan statistics rollups for /scan/stats: one document per user and UTC day plus one
+# per user for all time (day 'all'), each counting scans by disease, status and
+# confidence bucket. /scan/save adds to them with $inc, so a stats query reads the
+# user's total and at most `days` daily documents, however many scans there are.
+# Scans saved before the rollups existed are added by `python scan_stats.py backfill`
+STATS_MAX_DAYS = 365
+# The backfill claims scans in batches. A batch still claimed after the lease belongs
+# to a run that stopped, the next run finishes it. Scans younger than the lease are
+# left to /scan/save, which counts them itself. A rollup remembers the last
+# SCAN_STATS_BACKFILL_HISTORY batches added to it, so a batch is not added twice
+SCAN_STATS_BACKFILL_BATCH = int(os.getenv('SCAN_STATS_BACKFILL_BATCH', '10000'))
+SCAN_STATS_BACKFILL_LEASE_SECONDS = int(os.getenv('SCAN_STATS_BACKFILL_LEASE_SECONDS', '600'))
+SCAN_STATS_BACKFILL_HISTORY = 100
+# same cutoffs as the confidence levels of the dashboard
+CONFIDENCE_BUCKETS = [(0.4, 'Low'), (0.7, 'Medium'), (None, 'High')]
+
+def confidence_bucket(confidence):
+    for limit, name in CONFIDENCE_BUCKETS:
+        if limit is None or confidence < limit:
+            return name
+
+def confidence_bucket_expression():
+    """confidence_bucket() as an aggregation expression"""
+    branches = [{'case': {'$lt': ['$confidence', limit]}, 'then': name}
+                for limit, name in CONFIDENCE_BUCKETS if limit is not None]
+    return {'$switch': {'branches': branches, 'default': CONFIDENCE_BUCKETS[-1][1]}}
+
+def field(name):
+    """Disease and status names as document keys"""
+    return str(name or 'Unknown').replace('.', '_').replace('$', '_')
+
+def day(date):
+    return date.strftime('%Y-%m-%d')
+
+def increments(disease, status, bucket, count=1, confidence_sum=0.0):
+    """$inc of a rollup document for count scans of one disease, status and bucket"""
+    return {
+        'total': count,
+        f'by_disease.{field(disease)}': count,
+        f'by_status.{field(status)}': count,
+        f'confidence.{bucket}': count,
+        'confidence_sum': float(confidence_sum)
+    }
+
+def scan_increments(scan):
+    return increments(scan['disease'], scan['status'], confidence_bucket(scan['confidence']),
+                      confidence_sum=scan['confidence'])
+
+def backfill_pipeline(match):
+    """Counts of the matched scans grouped by user, day, disease, status and bucket"""
+    return [
+        {'$match': match},
+        {'$group': {
+            '_id': {
+                'user_email': '$user_email',
+                'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': {'$ifNull': ['$date', {'$toDate': '$_id'}]}}},
+                'disease': '$disease',
+                'status': '$status',
+                'bucket': confidence_bucket_expression()
+            },
+            'count': {'$sum': 1},
+            'confidence_sum': {'$sum': '$confidence'}
+        }}
+    ]
+
+def summarize(total, daily, days):
+    """/scan/stats response from the user's all-time and daily rollup documents"""
+    total = total or {}
+    count = total.get('total', 0)
+    return {
+        'total': count,
+        'by_disease': total.get('by_disease', {}),
+        'by_status': total.get('by_status', {}),
+        'confidence': total.get('confidence', {}),
+        'average_confidence': total.get('confidence_sum', 0) / count if count else 0,
+        'abnormality_rate': total.get('by_status', {}).get('Detected', 0) / count if count else 0,
+        'days': days,
+        'daily': [{
+            'day': rollup['day'],
+            'total': rollup.get('total', 0),
+            'by_disease': rollup.get('by_disease', {}),
+            'by_status': rollup.get('by_status', {}),
+            'confidence': rollup.get('confidence', {})
+        } for rollup in daily]
+    }
+
+def first_day(days, today=None):
+    today = today or datetime.datetime.utcnow()
+    return day(today - datetime.timedelta(days=days - 1))
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description='scan statistics rollups')
+    ap.add_argument('command', choices=['backfill'])
+    args = ap.parse_args()
+
+    from database import db
+    counted = db.backfill_scan_stats()
+    print(f"Added {counted} scans to the statistics rollups")
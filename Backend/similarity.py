@@ -0,0 +1,442 @@
+import os
+import time
+import threading
+import numpy as np
+
+# Similar-case retrieval: every saved scan gets an embedding, the DenseNet121 pooled
+# features feeding the 'output' layer. They are indexed with IVF-PQ: vectors are
+# L2-normalized and PCA-reduced to SIMILAR_INDEX_DIM, assigned to the nearest of
+# nlist k-means cells and stored as 8-bit product quantization codes. A query scans
+# the SIMILAR_NPROBE closest cells and re-scores the best PQ candidates exactly.
+# Until SIMILAR_TRAIN_SIZE vectors are in, the index searches them exhaustively
+SIMILAR_INDEX_PATH = os.getenv('SIMILAR_INDEX_PATH', 'output/similar_index.npz')
+SIMILAR_INDEX_DIM = int(os.getenv('SIMILAR_INDEX_DIM', '128'))
+SIMILAR_TRAIN_SIZE = int(os.getenv('SIMILAR_TRAIN_SIZE', '20000'))
+SIMILAR_NPROBE = int(os.getenv('SIMILAR_NPROBE', '16'))
+SIMILAR_RERANK = int(os.getenv('SIMILAR_RERANK', '50'))  # k * SIMILAR_RERANK candidates are re-scored
+SIMILAR_SYNC_SECONDS = float(os.getenv('SIMILAR_SYNC_SECONDS', '5'))
+# 'user' only searches the requesting user's own scans. 'all' is an explicit opt-in
+# to search every user's scans; matches owned by someone else are then returned
+# without their id, date and thumbnail, see ANONYMOUS_FIELDS
+SIMILAR_SCOPE = os.getenv('SIMILAR_SCOPE', 'user')
+ANONYMOUS_FIELDS = ['prediction', 'disease', 'confidence', 'similarity']
+SIMILAR_MAX_K = 50
+PQ_SUBVECTORS = 16
+PQ_CENTROIDS = 256
+
+def feature_extractor(model):
+    """Model sharing the classifier's layers and returning the input of its last Dense layer"""
+    import tensorflow as tf
+    names = [layer.name for layer in model.layers]
+    head = model.get_layer('output') if 'output' in names else model.layers[-1]
+    return tf.keras.Model(model.inputs, head.input)
+
+def pack(vector):
+    """float16 bytes of an embedding, stored with the scan"""
+    return np.asarray(vector, dtype=np.float16).tobytes()
+
+def unpack(data):
+    return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+def nearest(x, centroids, chunk=16384):
+    """Index of the nearest centroid of every row of x"""
+    norms = (centroids ** 2).sum(axis=1)
+    return np.concatenate([np.argmin(norms - 2 * x[i:i + chunk] @ centroids.T, axis=1)
+                           for i in range(0, len(x), chunk)]) if len(x) else np.zeros(0, dtype=np.int64)
+
+def kmeans(x, k, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(x, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        order = np.argsort(assignment, kind='stable')
+        empty = counts == 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        centroids[~empty] = np.add.reduceat(x[order], starts, axis=0) / counts[~empty, None]
+        # empty cells restart from random points
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+class Rows:
+    """Growable 2-D array with amortized appends"""
+    def __init__(self, width, dtype, data=None):
+        self.data = np.zeros((16, width), dtype=dtype) if data is None else data
+        self.size = 0 if data is None else len(data)
+
+    def append(self, rows):
+        if self.size + len(rows) > len(self.data):
+            grown = np.zeros((max(2 * len(self.data), self.size + len(rows)), self.data.shape[1]),
+                             dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+
+    def view(self):
+        return self.data[:self.size]
+
+class IVFPQIndex:
+    def __init__(self, dim=SIMILAR_INDEX_DIM, train_size=SIMILAR_TRAIN_SIZE, nprobe=SIMILAR_NPROBE,
+                 rerank=SIMILAR_RERANK, m=PQ_SUBVECTORS):
+        self.dim = dim
+        self.train_size = train_size
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.m = m
+        self.vectors = None  # float16 rows, raw until trained and PCA-reduced after
+        self.mean = self.components = None
+        self.centroids = self.codebooks = None
+        self.codes = self.lists = None
+
+    def __len__(self):
+        return 0 if self.vectors is None else self.vectors.size
+
+    @property
+    def input_dim(self):
+        if self.mean is not None:
+            return len(self.mean)
+        return None if self.vectors is None else self.vectors.data.shape[1]
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def project(self, x):
+        """Normalized vectors in the space the index searches"""
+        x = normalize(x)
+        if self.components is None:
+            return x
+        return normalize((x - self.mean) @ self.components.T)
+
+    @property
+    def needs_training(self):
+        return not self.trained and len(self) >= self.train_size
+
+    def add(self, x, train=True):
+        """Append vectors, returning their row numbers. With train=False reaching
+        train_size does not train the index, the caller trains it (see SimilarScans)"""
+        x = np.atleast_2d(np.asarray(x, dtype=np.float32))
+        if self.vectors is None:
+            self.vectors = Rows(x.shape[1], np.float16)
+        start = len(self)
+        if train and not self.trained and start + len(x) >= self.train_size:
+            # the pending rows train the index together with the stored ones
+            self.vectors.append(normalize(x).astype(np.float16))
+            self.train()
+        else:
+            z = self.project(x)
+            self.vectors.append(z.astype(np.float16))
+            if self.trained:
+                self.encode(z, np.arange(start, start + len(x)))
+        return np.arange(start, start + len(x))
+
+    def untrained_copy(self):
+        """Index with the same settings and a copy of the stored rows, to be trained apart"""
+        index = IVFPQIndex(dim=self.dim, train_size=self.train_size, nprobe=self.nprobe,
+                           rerank=self.rerank, m=self.m)
+        index.vectors = Rows(self.vectors.data.shape[1], np.float16, self.vectors.view().copy())
+        return index
+
+    def train(self, nlist=None, sample_size=100000, seed=0):
+        """Fit PCA, the coarse quantizer and the PQ codebooks, then encode every stored row"""
+        rng = np.random.default_rng(seed)
+        x = self.vectors.view().astype(np.float32)
+        sample = x[rng.choice(len(x), min(len(x), sample_size), replace=False)]
+        if self.components is None:
+            self.mean = sample.mean(axis=0)
+            if x.shape[1] > self.dim:
+                centered = sample[:20000] - self.mean
+                _, vectors = np.linalg.eigh(centered.T @ centered)
+                self.components = vectors[:, ::-1][:, :self.dim].T.copy()
+            else:
+                self.components = np.eye(x.shape[1], dtype=np.float32)
+            x = np.concatenate([self.project(x[i:i + 65536]) for i in range(0, len(x), 65536)])
+            sample = self.project(sample)
+            self.vectors = Rows(x.shape[1], np.float16, x.astype(np.float16))
+
+        nlist = nlist or int(np.clip(2 * np.sqrt(len(x)), 16, 4096))
+        self.centroids = kmeans(sample, min(nlist, len(sample)), seed=seed)
+        residuals = sample - self.centroids[nearest(sample, self.centroids)]
+        width = -(-x.shape[1] // self.m)
+        residuals = np.pad(residuals, ((0, 0), (0, width * self.m - x.shape[1])))
+        self.codebooks = np.stack([kmeans(residuals[:, j * width:(j + 1) * width],
+                                          min(PQ_CENTROIDS, len(sample)), seed=seed)
+                                   for j in range(self.m)])
+
+        self.codes = Rows(self.m, np.uint8)
+        self.lists = [Rows(1, np.int64) for _ in range(len(self.centroids))]
+        for i in range(0, len(x), 65536):
+            self.encode(x[i:i + 65536], np.arange(i, min(i + 65536, len(x))))
+
+    def encode(self, z, rows):
+        cells = nearest(z, self.centroids)
+        width = self.codebooks.shape[2]
+        residuals = np.pad(z - self.centroids[cells], ((0, 0), (0, width * self.m - z.shape[1])))
+        self.codes.append(np.stack([nearest(residuals[:, j * width:(j + 1) * width], self.codebooks[j])
+                                    for j in range(self.m)], axis=1).astype(np.uint8))
+        for cell in np.unique(cells):
+            self.lists[cell].append(rows[cells == cell, None])
+
+    def exact(self, query, k, rows=None):
+        """(rows, similarities) of the k nearest stored vectors, among rows when given"""
+        q = self.project(query)
+        vectors = self.vectors.view()
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            vectors = vectors[rows]
+        scores = np.concatenate([vectors[i:i + 65536].astype(np.float32) @ q
+                                 for i in range(0, len(vectors), 65536)]) if len(vectors) else np.zeros(0)
+        top = np.argsort(-scores)[:k] if k < len(scores) else np.argsort(-scores)
+        return (top if rows is None else rows[top]), scores[top]
+
+    def search(self, query, k, nprobe=None):
+        """(rows, similarities) of the approximate k nearest stored vectors"""
+        if not self.trained:
+            return self.exact(query, k)
+        q = self.project(query)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        cells = np.argsort(((self.centroids - q) ** 2).sum(axis=1))[:nprobe]
+
+        width = self.codebooks.shape[2]
+        candidates, distances = [], []
+        for cell in cells:
+            rows = self.lists[cell].view()[:, 0]
+            if not len(rows):
+                continue
+            # asymmetric distance: the query residual against every codebook entry
+            residual = np.pad(q - self.centroids[cell], (0, width * self.m - len(q))).reshape(self.m, 1, width)
+            table = ((self.codebooks - residual) ** 2).sum(axis=2)
+            distances.append(table[np.arange(self.m), self.codes.data[rows]].sum(axis=1))
+            candidates.append(rows)
+        if not candidates:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        candidates, distances = np.concatenate(candidates), np.concatenate(distances)
+        shortlist = min(k * self.rerank, len(candidates))
+        best = np.argpartition(distances, shortlist - 1)[:shortlist]
+        return self.exact(query, k, candidates[best])
+
+    def save(self, path, **extra):
+        arrays = {'dim': self.dim, 'train_size': self.train_size, 'vectors': self.vectors.view()}
+        if self.trained:
+            arrays.update(mean=self.mean, components=self.components, centroids=self.centroids,
+                          codebooks=self.codebooks, codes=self.codes.view(),
+                          list_sizes=[rows.size for rows in self.lists],
+                          list_rows=np.concatenate([rows.view()[:, 0] for rows in self.lists]))
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez(path, **arrays, **extra)
+
+    @classmethod
+    def load(cls, path):
+        """The index and the npz file, for the extra arrays saved with it"""
+        data = np.load(path)
+        index = cls(dim=int(data['dim']), train_size=int(data['train_size']))
+        index.vectors = Rows(data['vectors'].shape[1], np.float16, data['vectors'].copy())
+        if 'centroids' in data:
+            index.mean, index.components = data['mean'], data['components']
+            index.centroids, index.codebooks = data['centroids'], data['codebooks']
+            index.codes = Rows(index.m, np.uint8, data['codes'].copy())
+            ends = np.cumsum(data['list_sizes'])
+            index.lists = [Rows(1, np.int64, rows[:, None].copy())
+                           for rows in np.split(data['list_rows'], ends[:-1])]
+        return index, data
+
+class SimilarScans:
+    """Embedding index of the saved scans, caught up with MongoDB before each query,
+    so every server process also sees the scans saved by the others"""
+    def __init__(self, path=SIMILAR_INDEX_PATH):
+        self.lock = threading.Lock()
+        self.trainer = None
+        self.scan_ids, self.owners, self.rows = [], [], {}
+        self.by_owner = {}
+        self.index = IVFPQIndex()
+        self.newest = None
+        self.synced_at = 0
+        if os.path.exists(path):
+            self.index, data = IVFPQIndex.load(path)
+            for scan_id, owner in zip(data['scan_ids'].tolist(), data['owners'].tolist()):
+                self.track(scan_id, owner)
+            self.newest = float(data['newest'])
+            print(f"Similar scan index loaded from {path} ({len(self.index)} scans)")
+
+    def track(self, scan_id, owner):
+        row = len(self.scan_ids)
+        self.scan_ids.append(scan_id)
+        self.owners.append(owner)
+        self.rows[scan_id] = row
+        self.by_owner.setdefault(owner, []).append(row)
+
+    def add(self, scan_id, owner, embedding, created=None):
+        with self.lock:
+            if scan_id in self.rows:
+                return
+            if self.index.input_dim not in (None, len(embedding)):
+                return  # made by another model
+            self.index.add(embedding[None], train=False)
+            self.track(scan_id, owner)
+            if created is not None:
+                self.newest = max(self.newest or created, created)
+            if self.index.needs_training and self.trainer is None:
+                # k-means and the PQ codebooks take seconds to minutes, so they run on
+                # a copy of the rows, the exhaustive index serves until it is swapped
+                self.trainer = threading.Thread(target=self.train, name='similar-index-train', daemon=True)
+                self.trainer.start()
+
+    def train(self):
+        """Train a copy of the index without the lock, then swap it in with the rows added meanwhile"""
+        try:
+            with self.lock:
+                index = self.index.untrained_copy()
+            start = time.perf_counter()
+            index.train()
+            with self.lock:
+                if len(self.index) > len(index):
+                    index.add(self.index.vectors.view()[len(index):].astype(np.float32))
+                self.index = index
+            print(f"Similar scan index trained on {len(index)} scans in {time.perf_counter() - start:.1f}s")
+        except Exception as e:
+            print(f"Error training the similar scan index: {e}")
+        finally:
+            with self.lock:
+                self.trainer = None
+
+    def sync(self, db, force=False):
+        """Add the scans saved since the last sync, by this or another process"""
+        if not force and time.monotonic() - self.synced_at < SIMILAR_SYNC_SECONDS:
+            return
+        self.synced_at = time.monotonic()
+        # ObjectIds are only ordered by second across processes, so a minute is read again
+        since = None if self.newest is None else self.newest - 60
+        for scan in db.get_scan_embeddings(since):
+            self.add(str(scan['_id']), scan.get('user_email'), unpack(scan['embedding']),
+                     scan['_id'].generation_time.timestamp())
+
+    def search(self, embedding, k, owner=None, exclude=None):
+        """[(scan_id, similarity)] of the k most similar scans"""
+        with self.lock:
+            if not len(self.index):
+                return []
+            if owner is not None:
+                # one user's scans are few, they are compared exhaustively
+                rows, scores = self.index.exact(embedding, k + 1, self.by_owner.get(owner, []))
+            else:
+                rows, scores = self.index.search(embedding, k + 1)
+            results = [(self.scan_ids[row], float(score)) for row, score in zip(rows, scores)]
+        return [result for result in results if result[0] != exclude][:k]
+
+    def save(self, path=SIMILAR_INDEX_PATH):
+        with self.lock:
+            self.index.save(path, scan_ids=np.array(self.scan_ids, dtype=str), owners=np.array(self.owners, dtype=str),
+                            newest=self.newest or 0)
+
+def synthetic_embeddings(dim=1024, clusters=1000, latent=64, seed=0):
+    """Clustered, non-negative, low-rank vectors in chunks, like pooled CNN features"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 1, (clusters, latent)).astype(np.float32)
+    projection = rng.normal(0, 1 / np.sqrt(latent), (latent, dim)).astype(np.float32)
+
+    def generate(n, chunk_seed):
+        chunk_rng = np.random.default_rng(chunk_seed)
+        z = centers[chunk_rng.integers(0, clusters, n)] + chunk_rng.normal(0, 0.6, (n, latent)).astype(np.float32)
+        return np.maximum(z @ projection + chunk_rng.normal(0, 0.1, (n, dim)).astype(np.float32), 0)
+    return generate
+
+if __name__ == "__main__":
+    import sys
+    import json
+    import argparse
+    ap = argparse.ArgumentParser(description='similar scan index: rebuild from MongoDB, or benchmark')
+    ap.add_argument('command', choices=['build', 'benchmark'])
+    ap.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    ap.add_argument('--queries', type=int, default=200)
+    ap.add_argument('--k', type=int, default=10)
+    ap.add_argument('--nprobe', type=int, nargs='+', default=[8, 16, 32])
+    ap.add_argument('--rerank', type=int, nargs='+', default=[10, 50, 100])
+    ap.add_argument('--output', default='output/similar_benchmark.json')
+    args = ap.parse_args()
+
+    if args.command == 'build':
+        # retrains the cells and codebooks for the current number of scans,
+        # server processes load the file when they start
+        from database import db
+        scans = SimilarScans(path='')
+        scans.index = IVFPQIndex(train_size=sys.maxsize)
+        scans.sync(db, force=True)
+        if len(scans.index) >= 256:
+            scans.index.train()
+        scans.index.train_size = SIMILAR_TRAIN_SIZE
+        scans.save()
+        print(f"Indexed {len(scans.index)} scans into {SIMILAR_INDEX_PATH}")
+        sys.exit(0)
+
+    results = []
+    chunk = 50000
+    for size in args.sizes:
+        generate = synthetic_embeddings()
+        queries = generate(args.queries, chunk_seed=-1 % 2 ** 32)
+        q = normalize(queries)
+        index = IVFPQIndex(train_size=min(size, 100000))
+        # exact top-k in the original 1024-d space, kept while the vectors are made
+        truth_scores = np.full((len(q), args.k), -np.inf, dtype=np.float32)
+        truth_rows = np.zeros((len(q), args.k), dtype=np.int64)
+        build_time = 0
+        for start in range(0, size, chunk):
+            x = generate(min(chunk, size - start), chunk_seed=start)
+            scores = q @ normalize(x).T
+            all_scores = np.concatenate([truth_scores, scores], axis=1)
+            all_rows = np.concatenate([truth_rows, np.broadcast_to(np.arange(start, start + len(x)), scores.shape)], axis=1)
+            top = np.argsort(-all_scores, axis=1)[:, :args.k]
+            truth_scores = np.take_along_axis(all_scores, top, axis=1)
+            truth_rows = np.take_along_axis(all_rows, top, axis=1)
+            t = time.perf_counter()
+            index.add(x)
+            build_time += time.perf_counter() - t
+
+        # one at a time inserts after the index is built, as /scan/save does
+        t = time.perf_counter()
+        for vector in generate(200, chunk_seed=size):
+            index.add(vector)
+        insert_time = (time.perf_counter() - t) / 200
+
+        result = {'vectors': size, 'dim': 1024, 'index_dim': index.dim, 'nlist': len(index.centroids),
+                  'build_time': build_time, 'insert_time': insert_time,
+                  'index_bytes': index.vectors.view().nbytes + index.codes.view().nbytes + 8 * size,
+                  'settings': []}
+        # exhaustive search over the stored PCA-reduced vectors is the brute force
+        # baseline; recall@k is against the exact cosine neighbours in the original
+        # space, index_recall@k against the exhaustive search of the index
+        exhaustive = []
+        settings = [('exhaustive', None)] + [(nprobe, rerank) for nprobe in args.nprobe for rerank in args.rerank]
+        for nprobe, rerank in settings:
+            latencies, recall, index_recall = [], 0, 0
+            for i, (query, truth) in enumerate(zip(queries, truth_rows)):
+                t = time.perf_counter()
+                if nprobe == 'exhaustive':
+                    rows, _ = index.exact(query, args.k)
+                    exhaustive.append(set(rows.tolist()))
+                else:
+                    index.rerank = rerank
+                    rows, _ = index.search(query, args.k, nprobe=nprobe)
+                latencies.append(time.perf_counter() - t)
+                recall += len(set(rows.tolist()) & set(truth.tolist())) / args.k
+                index_recall += len(set(rows.tolist()) & exhaustive[i]) / args.k
+            result['settings'].append({'nprobe': nprobe, 'rerank': rerank,
+                                       f'recall@{args.k}': recall / len(q),
+                                       f'index_recall@{args.k}': index_recall / len(q),
+                                       'p50_latency': float(np.percentile(latencies, 50)),
+                                       'p95_latency': float(np.percentile(latencies, 95))})
+            print(f"{size:>8} vectors nprobe {nprobe:>10} rerank {rerank or '-':>4}: recall@{args.k} {recall / len(q):.3f} "
+                  f"(index {index_recall / len(q):.3f}) p50 {np.percentile(latencies, 50) * 1000:7.2f} ms "
+                  f"p95 {np.percentile(latencies, 95) * 1000:7.2f} ms")
+        print(f"{size:>8} vectors: build {build_time:.1f} s, insert {insert_time * 1000:.2f} ms, "
+              f"index {result['index_bytes'] / 2 ** 20:.0f} MB")
+        results.append(result)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,70 @@
+import io
+import os
+import hmac
+import time
+import base64
+import hashlib
+import numpy as np
+from PIL import Image, features
+
+# Scan thumbnails: made once at /scan/save and served by /scan/<id>/thumbnail, so the
+# history only transfers small images instead of the full resolution data URLs.
+# WebP when Pillow was built with it, JPEG otherwise
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', '256'))
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', '75'))
+THUMBNAIL_FORMAT = os.getenv('THUMBNAIL_FORMAT', 'WEBP' if features.check('webp') else 'JPEG')
+THUMBNAIL_MAX_AGE = int(os.getenv('THUMBNAIL_MAX_AGE', str(365 * 24 * 3600)))
+# Signed thumbnail URLs expire after one to two THUMBNAIL_URL_TTL windows; the
+# expiry is aligned to the window so the URL, and the browser cache, stay stable
+THUMBNAIL_URL_TTL = int(os.getenv('THUMBNAIL_URL_TTL', '3600'))
+
+def decode_data_url(url):
+    """Bytes of a base64 data: URL, None for anything else"""
+    if not url or not url.startswith('data:') or ';base64,' not in url[:100]:
+        return None
+    return base64.b64decode(url.split(',', 1)[1])
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE, image_format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY):
+    """Thumbnail bytes, mimetype and ETag of an encoded image"""
+    image = Image.open(io.BytesIO(data))
+    image.draft(None, (size, size))  # JPEG decodes directly at a reduced scale
+    if image.mode in ('I', 'I;16', 'I;16B', 'I;16L', 'F'):
+        # 16-bit and float pixels (e.g. DICOM) are scaled to 0-255, converting clips them
+        pixels = np.asarray(image, dtype=np.float32)
+        low, high = float(pixels.min()), float(pixels.max())
+        pixels = (pixels - low) * (255.0 / (high - low)) if high > low else np.zeros_like(pixels)
+        image = Image.fromarray(pixels.round().astype(np.uint8))
+    image = image.convert('L' if image.mode in ('1', 'L', 'LA') else 'RGB')
+    image.thumbnail((size, size), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality)
+    thumbnail = buffer.getvalue()
+    return {
+        'data': thumbnail,
+        'mimetype': f'image/{image_format.lower()}',
+        'etag': hashlib.sha256(thumbnail).hexdigest()[:32]
+    }
+
+def sign(scan_id, owner, expires, secret):
+    message = f'{scan_id}\n{owner}\n{expires}'.encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()[:32]
+
+def verify(scan_id, owner, expires, signature, secret, now=None):
+    """True for an unexpired signature made for this scan and its owner"""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < (time.time() if now is None else now):
+        return False
+    return hmac.compare_digest(sign(scan_id, owner, expires, secret), signature)
+
+def url_expiry(now=None, ttl=THUMBNAIL_URL_TTL):
+    return (int((time.time() if now is None else now) // ttl) + 2) * ttl
+
+def thumbnail_url(scan_id, owner, secret, now=None):
+    """<img> tags cannot send the Authorization header, so the URL carries a signature
+    of the scan, the user it belongs to and an expiry time"""
+    expires = url_expiry(now)
+    return f'/scan/{scan_id}/thumbnail?exp={expires}&sig={sign(scan_id, owner, expires, secret)}'
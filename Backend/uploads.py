@@ -0,0 +1,316 @@
+import os
+import time
+import hashlib
+import threading
+import tempfile
+from PIL import Image
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+# Streaming upload ingestion for /predict: the request body is read in chunks and
+# every chunk of the file goes at once to a spool file (in memory up to
+# UPLOAD_MEMORY_BYTES, on disk after) and a running SHA-256, while a decoder thread
+# reads the spool as it grows, so decoding overlaps the network receive. Oversized
+# bodies are refused from the Content-Length or as soon as they exceed it,
+# decompression bombs as soon as the image header is in.
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(64 * 2 ** 20)))
+UPLOAD_MEMORY_BYTES = int(os.getenv('UPLOAD_MEMORY_BYTES', str(4 * 2 ** 20)))
+UPLOAD_MAX_PIXELS = int(os.getenv('UPLOAD_MAX_PIXELS', str(Image.MAX_IMAGE_PIXELS or 89478485)))
+UPLOAD_SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR') or None
+UPLOAD_CHUNK_BYTES = 64 * 1024
+UPLOAD_FIELD_MAX_BYTES = 64 * 1024
+UPLOAD_MAX_PARTS = int(os.getenv('UPLOAD_MAX_PARTS', '100'))
+DICOM_MAGIC_END = 132  # 128 byte preamble + b'DICM'
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class SpoolReader:
+    """Read-only view of an upload spool, blocking until the requested bytes are received"""
+    def __init__(self, upload):
+        self.upload = upload
+        self.pos = 0
+
+    def read(self, size=-1):
+        upload = self.upload
+        with upload.received:
+            if size is None or size < 0:
+                upload.received.wait_for(lambda: upload.complete)
+            else:
+                upload.received.wait_for(lambda: upload.complete or upload.size >= self.pos + size)
+            upload.spool.seek(self.pos)
+            data = upload.spool.read(size)
+            upload.spool.seek(0, os.SEEK_END)
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            with self.upload.received:
+                self.upload.received.wait_for(lambda: self.upload.complete)
+            offset += self.upload.size
+        elif whence == os.SEEK_CUR:
+            offset += self.pos
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+class Upload:
+    def __init__(self, max_bytes=UPLOAD_MAX_BYTES, memory_bytes=UPLOAD_MEMORY_BYTES, max_pixels=UPLOAD_MAX_PIXELS):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.spool = tempfile.SpooledTemporaryFile(max_size=memory_bytes, dir=UPLOAD_SPOOL_DIR)
+        self.received = threading.Condition()
+        self.complete = False
+        self.sha256 = hashlib.sha256()
+        self.decoder = None
+        self.error = None
+        self.form = MultiDict()
+        self.filename = None
+        self.size = 0
+        self.image = None
+        self.is_dicom = False
+        self.head = b''
+
+    def write(self, data):
+        with self.received:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                raise UploadError(f'Upload larger than {self.max_bytes} bytes', 413)
+            self.spool.write(data)
+            self.received.notify_all()
+        self.sha256.update(data)
+        if len(self.head) < DICOM_MAGIC_END:
+            # hold the decoder back until the DICOM preamble and magic are in
+            self.head += data[:DICOM_MAGIC_END - len(self.head)]
+            if len(self.head) == DICOM_MAGIC_END:
+                self.is_dicom = self.head[128:] == b'DICM'  # decoded from the spool by dicom.load
+                if not self.is_dicom:
+                    self.start_decoding()
+        if self.error is not None and self.error.status == 413:
+            raise self.error
+
+    def start_decoding(self):
+        self.decoder = threading.Thread(target=self.decode, name='upload-decoder', daemon=True)
+        self.decoder.start()
+
+    def decode(self):
+        try:
+            image = Image.open(SpoolReader(self))
+            if image.width * image.height > self.max_pixels:
+                raise UploadError(f'Image of {image.width}x{image.height} pixels exceeds the '
+                                  f'{self.max_pixels} pixel limit', 413)
+            self.image = image.convert('RGB')
+        except UploadError as e:
+            self.error = e
+        except Image.DecompressionBombError as e:
+            self.error = UploadError(str(e), 413)
+        except Image.UnidentifiedImageError:
+            self.error = UploadError('Unsupported image format')
+        except Exception as e:
+            self.error = UploadError(f'Cannot decode image: {e}')
+
+    def finish(self):
+        """Wait for the decoder to complete"""
+        with self.received:
+            self.complete = True
+            self.received.notify_all()
+        if not self.is_dicom and self.decoder is None:
+            self.start_decoding()  # files shorter than a DICOM preamble
+        if self.decoder is not None:
+            self.decoder.join()
+        self.spool.seek(0)
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def digest(self):
+        return self.sha256.hexdigest()
+
+    def close(self):
+        # a decoder still waiting for data fails on the closed spool and exits
+        with self.received:
+            self.complete = True
+            self.spool.close()
+            self.received.notify_all()
+        if self.decoder is not None:
+            self.decoder.join()
+
+def receive_upload(stream, content_type, content_length=None, file_field='file'):
+    """Read a multipart/form-data (first `file_field` part) or raw image body from stream"""
+    upload = Upload()
+    try:
+        if content_length is not None and content_length > upload.max_bytes:
+            raise UploadError(f'Upload larger than {upload.max_bytes} bytes', 413)
+
+        mimetype, options = parse_options_header(content_type or '')
+        if mimetype == 'multipart/form-data':
+            receive_multipart(upload, stream, options.get('boundary', '').encode(), file_field)
+        else:
+            # raw body, e.g. Content-Type: image/png or application/dicom
+            upload.filename = 'upload'
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                upload.write(chunk)
+
+        if not upload.filename or upload.size == 0:
+            raise UploadError('No file provided')
+        upload.finish()
+        return upload
+    except Exception:
+        upload.close()
+        raise
+
+def receive_multipart(upload, stream, boundary, file_field):
+    if not boundary:
+        raise UploadError('Missing multipart boundary')
+    decoder = MultipartDecoder(boundary)
+    part, receiving, field_data = None, False, []
+    # every byte of the body counts against max_bytes, form fields and skipped
+    # parts too, since a chunked request has no Content-Length to check upfront
+    received, parts = 0, 0
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_BYTES)
+        received += len(chunk)
+        if received > upload.max_bytes:
+            raise UploadError(f'Upload larger than {upload.max_bytes} bytes', 413)
+        decoder.receive_data(chunk or None)
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, (Field, File)):
+                parts += 1
+                if parts > UPLOAD_MAX_PARTS:
+                    raise UploadError(f'More than {UPLOAD_MAX_PARTS} form parts', 413)
+                part, field_data = event, []
+                # only the first file of the field is analyzed, others are skipped
+                receiving = isinstance(event, File) and event.name == file_field and upload.filename is None
+                if receiving:
+                    upload.filename = event.filename or 'upload'
+            elif isinstance(event, Data):
+                if receiving:
+                    upload.write(event.data)
+                elif isinstance(part, Field):
+                    field_data.append(event.data)
+                    if sum(len(data) for data in field_data) > UPLOAD_FIELD_MAX_BYTES:
+                        raise UploadError(f'Form field {part.name} is too large', 413)
+                    if not event.more_data:
+                        upload.form.add(part.name, b''.join(field_data).decode('utf-8', 'replace'))
+            event = decoder.next_event()
+        if isinstance(event, Epilogue) or not chunk:
+            return
+
+class ThrottledStream:
+    """File read back at a fixed bandwidth, standing in for a client upload"""
+    def __init__(self, fileobj, bandwidth):
+        self.fileobj = fileobj
+        self.bandwidth = bandwidth
+        self.start = None
+        self.sent = 0
+
+    def read(self, size=-1):
+        if self.start is None:
+            self.start = time.perf_counter()
+        data = self.fileobj.read(size)
+        self.sent += len(data)
+        delay = self.start + self.sent / self.bandwidth - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        return data
+
+    def readline(self, size=-1):
+        return self.fileobj.readline(size)
+
+def make_upload(path, target_bytes, image_format='PNG', boundary='----upload'):
+    """Write a multipart body holding a noisy X-ray-like image of about target_bytes"""
+    import io
+    import numpy as np
+    seed = Image.open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_image.jpg')).convert('L')
+    rng = np.random.default_rng(42)
+
+    def encode(side):
+        pixels = np.asarray(seed.resize((side, side), Image.BILINEAR), dtype=np.float32)
+        pixels = np.clip(pixels + rng.normal(0, 6, pixels.shape), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format=image_format, **({'quality': 95} if image_format == 'JPEG' else {}))
+        return buffer.getvalue()
+
+    sample = encode(1000)
+    data = encode(int(1000 * (target_bytes / len(sample)) ** 0.5))
+    with open(path, 'wb') as f:
+        f.write(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="xray.{image_format.lower()}"\r\n'
+                f'Content-Type: image/{image_format.lower()}\r\n\r\n'.encode())
+        f.write(data)
+        f.write(f'\r\n--{boundary}--\r\n'.encode())
+    return f'multipart/form-data; boundary={boundary}'
+
+def run_case(path, content_type, mode, bandwidth):
+    """Time-to-result and peak memory growth of one upload, run in a fresh process"""
+    from werkzeug.formparser import parse_form_data
+    def memory(field):
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith(field))
+    rss_before = memory('VmRSS:')
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        stream = ThrottledStream(f, bandwidth)
+        start = time.perf_counter()
+        if mode == 'buffered':
+            # the current path: werkzeug parses the whole body, then PIL decodes the file
+            environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': content_type,
+                       'CONTENT_LENGTH': str(size), 'wsgi.input': stream}
+            _, _, files = parse_form_data(environ)
+            image = Image.open(files['file']).convert('RGB')
+        else:
+            image = receive_upload(stream, content_type, size).image
+        image.resize((224, 224))
+        elapsed = time.perf_counter() - start
+        received = stream.sent / bandwidth
+    peak = memory('VmHWM:')
+    return {'time_to_result': elapsed, 'receive_time': received, 'peak_memory_mb': (peak - rss_before) / 2 ** 20}
+
+if __name__ == "__main__":
+    import sys
+    import json
+    import argparse
+    import subprocess
+    ap = argparse.ArgumentParser(description='buffered versus streaming upload decoding')
+    ap.add_argument('--sizes', type=float, nargs='+', default=[5, 10, 25, 50], help='upload sizes in MB')
+    ap.add_argument('--format', default='PNG', choices=['PNG', 'JPEG'])
+    ap.add_argument('--bandwidth', type=float, default=100, help='client bandwidth in Mbit/s')
+    ap.add_argument('--output', default='output/upload_benchmark.json')
+    ap.add_argument('--case', nargs=3, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    bandwidth = args.bandwidth * 1e6 / 8
+
+    if args.case:
+        path, content_type, mode = args.case
+        print(json.dumps(run_case(path, content_type, mode, bandwidth)))
+        sys.exit(0)
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix='uploads-')
+    for size in args.sizes:
+        path = os.path.join(workdir, f'{size}.bin')
+        content_type = make_upload(path, size * 2 ** 20, args.format)
+        result = {'size_mb': os.path.getsize(path) / 2 ** 20, 'format': args.format, 'bandwidth_mbit': args.bandwidth}
+        for mode in ('buffered', 'streaming'):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', path, content_type, mode,
+                                     '--bandwidth', str(args.bandwidth)], stdout=subprocess.PIPE, check=True).stdout
+            result[mode] = json.loads(output)
+        results.append(result)
+        os.remove(path)
+        print(f"{result['size_mb']:5.1f} MB {args.format} receive: {result['streaming']['receive_time'] * 1000:6.0f} ms | "
+              f"buffered: {result['buffered']['time_to_result'] * 1000:6.0f} ms {result['buffered']['peak_memory_mb']:6.0f} MB | "
+              f"streaming: {result['streaming']['time_to_result'] * 1000:6.0f} ms {result['streaming']['peak_memory_mb']:6.0f} MB")
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
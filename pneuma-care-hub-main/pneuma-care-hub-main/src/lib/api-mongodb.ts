@@ -1,4 +1,4 @@
-const API_BASE_URL = 'http://localhost:5000';
+export const API_BASE_URL = 'http://localhost:5000';
 
 export interface DiseaseInfo {
   precaution: string;
@@ -65,6 +65,7 @@ export interface ScanRecord {
   status: string;
   precaution: string;
   image_url: string;
+  thumbnail_url?: string;
   date: string;
   explanation?: string;
   heatmap_regions?: HeatmapRegion[];
@@ -74,6 +75,30 @@ export interface ScanRecord {
   analysis_metadata?: any;
 }
 
+export interface ScanEvent {
+  _id: string;
+  prediction: string;
+  disease: string;
+  status: string;
+  confidence: number;
+  date: string;
+  thumbnail_url: string;
+}
+
+export interface ScanStatsCounts {
+  total: number;
+  by_disease: Record<string, number>;
+  by_status: Record<string, number>;
+  confidence: Record<string, number>;
+}
+
+export interface ScanStats extends ScanStatsCounts {
+  average_confidence: number;
+  abnormality_rate: number;
+  days: number;
+  daily: Array<ScanStatsCounts & { day: string }>;
+}
+
 class AuthAPI {
   private static getToken(): string | null {
     if (typeof window !== 'undefined') {
@@ -201,6 +226,69 @@ class ScanAPI {
 
     return response.json();
   }
+
+  // Short-lived token for the URL of the event stream, never the login token
+  static async getStreamToken(): Promise<string> {
+    const response = await fetch(`${API_BASE_URL}/scan/events/token`, {
+      method: 'POST',
+      headers: this.getAuthHeaders()
+    });
+
+    if (!response.ok) {
+      throw new Error('Failed to get stream token');
+    }
+
+    return (await response.json()).token;
+  }
+
+  // Scans saved from now on, pushed by the server; returns the unsubscribe function
+  static subscribeToScans(onScan: (scan: ScanEvent) => void): () => void {
+    let source: EventSource | null = null;
+    let lastEventId = '';
+    let closed = false;
+
+    const open = async () => {
+      // EventSource cannot send the Authorization header. The stream token expires
+      // within a minute, so once the browser gives up reconnecting open a new stream
+      // with a new token, continuing after the last scan received
+      const token = await this.getStreamToken().catch(() => null);
+      if (closed) return;
+      if (token === null) {
+        setTimeout(open, 5000);
+        return;
+      }
+      const after = lastEventId ? `&last_event_id=${encodeURIComponent(lastEventId)}` : '';
+      source = new EventSource(`${API_BASE_URL}/scan/events?token=${encodeURIComponent(token)}${after}`);
+      source.addEventListener('scan', (event) => {
+        lastEventId = (event as MessageEvent).lastEventId || lastEventId;
+        onScan(JSON.parse((event as MessageEvent).data));
+      });
+      source.onerror = () => {
+        if (source?.readyState === EventSource.CLOSED && !closed) {
+          setTimeout(open, 5000);
+        }
+      };
+    };
+
+    open();
+    return () => {
+      closed = true;
+      source?.close();
+    };
+  }
+
+  static async getScanStats(days: number = 30): Promise<ScanStats> {
+    const response = await fetch(`${API_BASE_URL}/scan/stats?days=${days}`, {
+      method: 'GET',
+      headers: this.getAuthHeaders()
+    });
+
+    if (!response.ok) {
+      throw new Error('Failed to get scan stats');
+    }
+
+    return response.json();
+  }
 }
 
 export const api = {
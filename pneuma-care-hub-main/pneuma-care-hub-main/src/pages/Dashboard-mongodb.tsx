@@ -3,7 +3,7 @@ import { useNavigate } from "react-router-dom";
 import { useAuth } from "@/contexts/AuthContext-mongodb";
 import logo from "@/assets/logo.png";
 import { Upload, LogOut, AlertCircle, CheckCircle, ShieldAlert, Image, ChevronDown, ChevronUp, Download, Activity, TrendingUp, Info } from "lucide-react";
-import { api, PredictionResponse, DiseaseInfo, HeatmapRegion } from "@/lib/api-mongodb";
+import { api, API_BASE_URL, PredictionResponse, DiseaseInfo, HeatmapRegion, ScanStats } from "@/lib/api-mongodb";
 
 interface PredictionResult {
   disease: string;
@@ -44,16 +44,37 @@ const Dashboard = () => {
   const [showDisclaimer, setShowDisclaimer] = useState(false);
   const [showExplanation, setShowExplanation] = useState(false);
   const [showQualityWarning, setShowQualityWarning] = useState(false);
-  const [history, setHistory] = useState<Array<{ image: string; result: PredictionResult; date: string }>>([]);
+  const [history, setHistory] = useState<Array<{ _id?: string; image: string; result: PredictionResult; date: string }>>([]);
   const [historyLoading, setHistoryLoading] = useState(false);
+  const [stats, setStats] = useState<ScanStats | null>(null);
 
   // Load scan history from MongoDB
   useEffect(() => {
     if (user) {
       loadScanHistory();
+      loadScanStats();
     }
   }, [user]);
 
+  // New scans are pushed by the server instead of refetching the history
+  useEffect(() => {
+    if (!user) return;
+    return api.scans.subscribeToScans((scan) => {
+      setHistory((current) => current.some((item) => item._id === scan._id) ? current : [{
+        _id: scan._id,
+        image: `${API_BASE_URL}${scan.thumbnail_url}`,
+        result: {
+          disease: scan.disease,
+          status: scan.status as PredictionResult["status"],
+          precaution: "",
+          confidence: scan.confidence
+        },
+        date: new Date(scan.date).toLocaleString()
+      }, ...current].slice(0, 10));
+      loadScanStats();
+    });
+  }, [user]);
+
   const loadScanHistory = async () => {
     try {
       setHistoryLoading(true);
@@ -62,7 +83,7 @@ const Dashboard = () => {
         // Transform MongoDB scans to Dashboard format
         const formattedHistory = response.scans.map((scan: any) => ({
           _id: scan._id,
-          image: scan.image_url,
+          image: scan.thumbnail_url ? `${API_BASE_URL}${scan.thumbnail_url}` : scan.image_url,
           result: {
             disease: scan.disease,
             status: scan.status,
@@ -86,6 +107,15 @@ const Dashboard = () => {
     }
   };
 
+  // Insights come from the server-side rollups, not from the history rows
+  const loadScanStats = async () => {
+    try {
+      setStats(await api.scans.getScanStats(30));
+    } catch (error) {
+      console.error('Failed to load scan stats:', error);
+    }
+  };
+
   const saveScanToMongoDB = async (predictionResult: PredictionResult, dataUrl: string) => {
     try {
       await api.scans.saveScan({
@@ -120,16 +150,15 @@ const Dashboard = () => {
   };
 
   const getHistoryInsights = () => {
-    const recentScans = history.slice(0, 30); // Last 30 scans
-    const abnormalScans = recentScans.filter(scan => scan.result.status === "Detected");
-    const normalScans = recentScans.filter(scan => scan.result.status === "Not Detected");
+    const totalScans = stats?.total ?? 0;
+    const abnormalCount = stats?.by_status["Detected"] ?? 0;
     
     return {
-      totalScans: recentScans.length,
-      abnormalCount: abnormalScans.length,
-      normalCount: normalScans.length,
-      abnormalityRate: recentScans.length > 0 ? (abnormalScans.length / recentScans.length * 100).toFixed(1) : "0",
-      hasRepeatAbnormality: abnormalScans.length > 1
+      totalScans,
+      abnormalCount,
+      normalCount: stats?.by_status["Not Detected"] ?? 0,
+      abnormalityRate: totalScans > 0 ? (abnormalCount / totalScans * 100).toFixed(1) : "0",
+      hasRepeatAbnormality: abnormalCount > 1
     };
   };
 
@@ -270,7 +299,7 @@ DISCLAIMER: This AI-assisted prediction is for informational purposes only and d
 
       <main className="max-w-6xl mx-auto px-4 sm:px-6 py-8 space-y-8">
         {/* History Insights */}
-        {history.length > 0 && (
+        {stats && stats.total > 0 && (
           <div className="bg-gradient-to-r from-blue-50 to-indigo-50 border border-blue-200 rounded-lg p-4">
             <div className="flex items-center gap-2 mb-3">
               <TrendingUp className="h-5 w-5 text-blue-600" />
@@ -529,7 +558,7 @@ DISCLAIMER: This AI-assisted prediction is for informational purposes only and d
             <div className="grid sm:grid-cols-2 lg:grid-cols-3 gap-4">
               {history.map((item, i) => (
                 <div key={i} className="bg-card rounded-xl border border-border p-4 shadow-card">
-                  <img src={item.image} alt="X-ray" className="h-32 w-full object-contain rounded-lg bg-muted mb-3" />
+                  <img src={item.image} alt="X-ray" loading="lazy" decoding="async" className="h-32 w-full object-contain rounded-lg bg-muted mb-3" />
                   <div className="flex items-center justify-between mb-1">
                     <p className="text-sm font-medium text-foreground">{item.result.disease}</p>
                     <span className={`text-xs font-medium px-2 py-0.5 rounded-full ${